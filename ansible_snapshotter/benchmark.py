@@ -0,0 +1,626 @@
+import argparse
+import contextlib
+import os
+import sys
+import json
+import time
+import zlib
+import random
+import shutil
+import tempfile
+import platform
+import subprocess
+import uuid
+try:
+    from ConfigParser import ConfigParser
+except:
+    from configparser import ConfigParser # python3
+
+import boto3
+import botocore
+
+try:
+    from moto import mock_aws as s3_mock # in-process S3 stand-in
+except ImportError:
+    try:
+        from moto import mock_s3 as s3_mock # moto < 5
+    except ImportError:
+        s3_mock = None
+
+# the node scripts import each other by name, as they do on the nodes
+sys.path.append(os.path.join(sys.path[0], 'snapshotter'))
+
+from utils import bundle_dir, extract_snapshot
+from snapshotter.transfer import (TransferEngine, get_s3_bucket,
+                                  get_transfer_settings)
+from snapshotter.snapshotter import copy_snapshot, run_snapshot
+from cass_functions import (check_host, get_data_dirs, get_schema_structure,
+                            set_yaml_path, table_directory)
+from archive import ArchiveReader, FORMATS, snapshot_members, write_archive
+from objects import check_digests
+from manifest import merge_node_manifests, node_manifest, node_manifest_name, \
+                     write_manifest
+from loader import LOADERS_PER_NODE, load_tables, table_size
+
+# Benchmarks the snapshot and restore pipelines on a synthetic cluster. The
+# fake nodes are data directories on this machine, each with its own
+# cassandra.yaml; nodetool, cqlsh and sstableloader are the stand-ins in
+# benchmark_shims.py, and S3 is an S3 compatible endpoint (--s3-endpoint,
+# such as MinIO) or moto's in-process mock. The stages run the same
+# functions as snapshotter.py, snapshot.py, restore.py and the node's
+# restore.py. Nodes run one after another, so each stage time is the total
+# over the cluster. The results are written as JSON; --compare reads an
+# earlier results file, such as the same cluster on another commit, and
+# shows the change of every stage.
+
+RESULTS_VERSION = 1
+STAGES = ['discovery', 'snapshot', 'copy', 'archive', 'bundle', 'upload',
+          'download', 'extract', 'load']
+BUCKET = 'cassandra-snapshotter-benchmark'
+
+_MB = 1024 * 1024
+_WORDS = ['alpha', 'bravo', 'charlie', 'delta', 'echo', 'foxtrot', 'golf',
+          'hotel', 'india', 'juliett', 'kilo', 'lima', 'mike', 'november']
+
+
+def parse_cmd():
+
+    parser = argparse.ArgumentParser(description='Snapshot and restore benchmark')
+    parser.add_argument('-d', '--path',
+                        required=False,
+                        help='Working directory; a cluster generated there ' +
+                             'with the same settings is reused (default temporary)'
+    )
+    parser.add_argument('--nodes',
+                        required=False,
+                        type=int,
+                        default=2,
+                        help='Fake nodes (default 2)'
+    )
+    parser.add_argument('--keyspaces',
+                        required=False,
+                        type=int,
+                        default=2,
+                        help='Keyspaces (default 2)'
+    )
+    parser.add_argument('--tables',
+                        required=False,
+                        type=int,
+                        default=3,
+                        help='Tables per keyspace (default 3)'
+    )
+    parser.add_argument('--sstables',
+                        required=False,
+                        type=int,
+                        default=2,
+                        help='SSTables per table on each node (default 2)'
+    )
+    parser.add_argument('--size',
+                        required=False,
+                        type=float,
+                        default=4,
+                        help='Size of each Data.db in MB (default 4)'
+    )
+    parser.add_argument('--compressible',
+                        required=False,
+                        type=float,
+                        default=0.5,
+                        help='Share of tables without compression, whose ' +
+                             'sstables compress well (default 0.5)'
+    )
+    parser.add_argument('--disks',
+                        required=False,
+                        type=int,
+                        default=1,
+                        help='data_file_directories per node (default 1)'
+    )
+    parser.add_argument('--formats',
+                        required=False,
+                        nargs='+',
+                        choices=FORMATS,
+                        default=['zip', 'tar'],
+                        help='Archive formats to benchmark (default zip tar)'
+    )
+    parser.add_argument('--repeat',
+                        required=False,
+                        type=int,
+                        default=3,
+                        help='Runs per format; the median is reported (default 3)'
+    )
+    parser.add_argument('--seed',
+                        required=False,
+                        type=int,
+                        default=1,
+                        help='Seed of the generated data (default 1)'
+    )
+    parser.add_argument('--s3-endpoint',
+                        required=False,
+                        help='S3 compatible endpoint such as MinIO; moto is ' +
+                             'used in-process without one'
+    )
+    parser.add_argument('--s3-access-key',
+                        required=False,
+                        default='benchmark',
+                        help='Access key for --s3-endpoint'
+    )
+    parser.add_argument('--s3-secret-key',
+                        required=False,
+                        default='benchmark',
+                        help='Secret key for --s3-endpoint'
+    )
+    parser.add_argument('-o', '--output',
+                        required=False,
+                        help='Results file (default benchmarks/<time>.json)'
+    )
+    parser.add_argument('--compare',
+                        required=False,
+                        help='Earlier results file to compare this run with'
+    )
+    return parser.parse_args()
+
+
+# Synthetic Cluster
+def cluster_settings(cmds):
+    # everything the generated data depends on
+
+    return {
+        'nodes': cmds.nodes,
+        'keyspaces': cmds.keyspaces,
+        'tables': cmds.tables,
+        'sstables': cmds.sstables,
+        'size': cmds.size,
+        'compressible': cmds.compressible,
+        'disks': cmds.disks,
+        'seed': cmds.seed
+    }
+
+
+def text_data(rng, size):
+    # rows of a table without compression; they compress several times over
+
+    rows = []
+    length = 0
+    while length < size:
+        row = 'row%012i|%s|%s|%i\n' % (rng.randint(0, 10 ** 12),
+                                       rng.choice(_WORDS), rng.choice(_WORDS),
+                                       rng.randint(0, 10 ** 6))
+        rows.append(row)
+        length += len(row)
+    return ''.join(rows)[:size].encode('ascii')
+
+
+def write_sstable(table_dir, generation, size, compressed, rng):
+    # Data.db and the components Cassandra writes next to it; tables with
+    # compression hold incompressible data and a CompressionInfo.db
+
+    prefix = '%s/mc-%i-big-' % (table_dir, generation)
+    data = os.urandom(size) if compressed else text_data(rng, size)
+    components = {
+        'Data.db': data,
+        'Index.db': os.urandom(max(size // 64, 1)),
+        'Filter.db': os.urandom(max(size // 256, 1)),
+        'Summary.db': os.urandom(1024),
+        'Statistics.db': os.urandom(4096),
+        'Digest.crc32': str(zlib.crc32(data) & 0xffffffff).encode('ascii'),
+        'TOC.txt': b'Data.db\nIndex.db\nFilter.db\nSummary.db\n' +
+                   b'Statistics.db\nDigest.crc32\nTOC.txt\n'
+    }
+    if compressed:
+        components['CompressionInfo.db'] = os.urandom(max(size // 1024, 1))
+    for component, content in components.items():
+        with open(prefix + component, 'wb') as f:
+            f.write(content)
+
+
+def generate_cluster(path, settings):
+    # Writes the schema and every node's cassandra.yaml and data directories
+    # under path; returns the cluster description
+
+    rng = random.Random(settings['seed'])
+    schema = {}
+    compressed = {}
+    for k in range(settings['keyspaces']):
+        ks = 'benchmark_ks%i' % k
+        schema[ks] = {}
+        for t in range(settings['tables']):
+            tb = 'table%i' % t
+            schema[ks][tb] = str(uuid.UUID(int=rng.getrandbits(128), version=4))
+            compressed[ks + '.' + tb] = rng.random() >= settings['compressible']
+
+    if os.path.isdir(path + '/nodes'):
+        shutil.rmtree(path + '/nodes')
+    hosts = ['127.0.1.%i' % (n + 1) for n in range(settings['nodes'])]
+    size = int(settings['size'] * _MB)
+    total = 0
+    for host in hosts:
+        print('Generating the data of %s . . .' % host)
+        node_dir = path + '/nodes/' + host
+        data_dirs = [node_dir + '/data%i' % d for d in range(settings['disks'])]
+        os.makedirs(node_dir)
+        with open(node_dir + '/cassandra.yaml', 'w') as f:
+            f.write('rpc_address: %s\n' % host)
+            f.write('data_file_directories:\n')
+            for data_dir in data_dirs:
+                f.write('    - %s\n' % data_dir)
+            f.write('commitlog_directory: %s/commitlog\n' % node_dir)
+            f.write('saved_caches_directory: %s/saved_caches\n' % node_dir)
+
+        generation = 1
+        for ks in sorted(schema):
+            for tb in sorted(schema[ks]):
+                for s in range(settings['sstables']):
+                    # sstables are spread over the disks like JBOD compaction
+                    table_dir = '%s/%s/%s' % (data_dirs[s % len(data_dirs)], ks,
+                                              table_directory(tb, schema[ks][tb]))
+                    if not os.path.isdir(table_dir):
+                        os.makedirs(table_dir)
+                    write_sstable(table_dir, generation, size,
+                                  compressed[ks + '.' + tb], rng)
+                    generation += 1
+                    total += size
+
+    with open(path + '/schema.json', 'w') as f:
+        json.dump(schema, f, indent=2, sort_keys=True)
+    cluster = {'settings': settings, 'hosts': hosts, 'data_bytes': total}
+    with open(path + '/cluster.json', 'w') as f:
+        json.dump(cluster, f, indent=2, sort_keys=True)
+    return cluster
+
+
+def load_cluster(path, settings):
+    # The cluster generated in path earlier with the same settings, or a
+    # new one
+
+    try:
+        with open(path + '/cluster.json', 'r') as f:
+            cluster = json.load(f)
+        if cluster['settings'] == settings:
+            print('Reusing the cluster in %s' % path)
+            return cluster
+    except (IOError, OSError, ValueError, KeyError):
+        pass
+    return generate_cluster(path, settings)
+
+
+def install_shims(path):
+    # nodetool, cqlsh and sstableloader stand-ins in path/bin; cqlsh and
+    # sstableloader are found through CASSANDRA_HOME, nodetool on the PATH
+
+    bin_dir = path + '/bin'
+    if not os.path.isdir(bin_dir):
+        os.makedirs(bin_dir)
+    shims = os.path.join(os.path.abspath(sys.path[0]), 'benchmark_shims.py')
+    for tool in ('nodetool', 'cqlsh', 'sstableloader'):
+        with open(bin_dir + '/' + tool, 'w') as f:
+            f.write('#!/bin/sh\nexec "%s" "%s" %s "$@"\n'
+                    % (sys.executable, shims, tool))
+        os.chmod(bin_dir + '/' + tool, 0o755)
+    os.environ['CASSANDRA_HOME'] = path
+    os.environ['PATH'] = bin_dir + os.pathsep + os.environ.get('PATH', '')
+    os.environ['BENCHMARK_SCHEMA'] = path + '/schema.json'
+
+
+def use_node(path, host):
+    # Points the node functions and the shims at one fake node
+
+    yaml_path = path + '/nodes/' + host + '/cassandra.yaml'
+    os.environ['CASSANDRA_YAML'] = yaml_path
+    set_yaml_path(yaml_path)
+
+
+# S3 Stand-in
+def s3_stand_in(cmds):
+    # (bucket, stop function) in the --s3-endpoint store, or in moto's mock
+    # of S3; None when neither is available
+
+    mock = None
+    if not cmds.s3_endpoint:
+        if s3_mock is None:
+            print('No --s3-endpoint and moto is not installed, ' +
+                  'skipping the upload and download stages')
+            return None
+        mock = s3_mock()
+        mock.start()
+    s3 = boto3.resource('s3',
+                        aws_access_key_id=cmds.s3_access_key,
+                        aws_secret_access_key=cmds.s3_secret_key,
+                        region_name='us-east-1',
+                        endpoint_url=cmds.s3_endpoint)
+    try:
+        s3.create_bucket(Bucket=BUCKET)
+    except botocore.exceptions.ClientError as e:
+        if e.response['Error']['Code'] not in ('BucketAlreadyOwnedByYou',
+                                               'BucketAlreadyExists'):
+            raise e
+    bucket = get_s3_bucket(cmds.s3_access_key, cmds.s3_secret_key, 'us-east-1',
+                           BUCKET, cmds.s3_endpoint)
+    return bucket, mock.stop if mock else lambda: None
+
+
+# Stages
+class StageTimer(object):
+    # Adds up the seconds, bytes and files of every stage over one run
+
+    def __init__(self):
+        self.stages = {}
+
+    @contextlib.contextmanager
+    def stage(self, name, size=0, files=0):
+        # times the with block; it gets the stage's entry to add to
+
+        entry = self.stages.setdefault(name, {'seconds': 0.0, 'bytes': 0,
+                                              'files': 0})
+        start = time.time()
+        yield entry
+        entry['seconds'] += time.time() - start
+        entry['bytes'] += size
+        entry['files'] += files
+
+
+def snapshot_node(path, host, run_path, fmt, timer):
+    # discovery, snapshot, copy and archive on one node, as in the node's
+    # snapshotter.py; the archive and its manifest are left in run_path
+
+    use_node(path, host)
+    cache_path = run_path + '/cache/' + host + '.json'
+    with timer.stage('discovery'):
+        if check_host(host) != 0:
+            raise Exception('cqlsh stand-in failed on %s' % host)
+        structure = get_schema_structure(host, cache_path)
+
+    subprocess.call(['nodetool', 'clearsnapshot'])
+    with timer.stage('snapshot'):
+        run_snapshot(host)
+
+    snapshot_dirs = []
+    for data_dir in get_data_dirs():
+        for ks in sorted(structure):
+            for tb, table_dir in sorted(structure[ks].items()):
+                load_dir = '%s/%s/%s/snapshots/%s' % (data_dir, ks, table_dir, host)
+                if os.path.isdir(load_dir):
+                    snapshot_dirs.append((load_dir, ks + '/' + tb))
+    members = snapshot_members(snapshot_dirs)
+    size = sum(os.path.getsize(member[0]) for member in members)
+
+    # the --stage copy
+    stage_path = run_path + '/stage/' + host
+    with timer.stage('copy', size, len(members)):
+        for load_dir, arcname in snapshot_dirs:
+            copy_snapshot(load_dir, stage_path + '/' + arcname + '/')
+    shutil.rmtree(stage_path)
+
+    index = []
+    fetched = run_path + '/fetched'
+    with timer.stage('archive', size, len(members)):
+        archive_path = write_archive(fetched + '/' + host + '.' + fmt, members,
+                                     fmt, index=index)
+    write_manifest(fetched + '/' + node_manifest_name(host),
+                   node_manifest(os.path.basename(archive_path), index))
+    subprocess.call(['nodetool', 'clearsnapshot'])
+
+
+def restore_node(path, host, archive_path, restore_path, timer):
+    # extract and load on one node, as in the node's restore.py
+
+    use_node(path, host)
+    size = os.path.getsize(archive_path)
+    reader = ArchiveReader(archive_path)
+    with timer.stage('extract', size) as entry:
+        extracted = reader.extract(restore_path)
+        checked, mismatched = check_digests(reader.checksums,
+                dict((name, restore_path + '/' + name) for name in extracted))
+        entry['files'] += len(extracted)
+    if mismatched:
+        raise Exception('Checksum mismatch for %s' % ', '.join(mismatched))
+
+    tables = []
+    for ks in sorted(os.listdir(restore_path)):
+        for tb in sorted(os.listdir(restore_path + '/' + ks)):
+            tables.append((ks + '.' + tb, restore_path + '/' + ks + '/' + tb))
+    with timer.stage('load', table_size(restore_path), len(extracted)):
+        results = load_tables([host], tables, LOADERS_PER_NODE)
+    failed = [r['table'] for r in results if r['returncode'] != 0]
+    if failed:
+        raise Exception('sstableloader stand-in failed for %s' % ', '.join(failed))
+
+
+def run_pipeline(path, cluster, fmt, transfer):
+    # One run of every stage for the cluster; returns the StageTimer
+
+    timer = StageTimer()
+    run_path = path + '/run'
+    if os.path.isdir(run_path):
+        shutil.rmtree(run_path)
+    fetched = run_path + '/fetched'
+    os.makedirs(fetched)
+
+    for host in cluster['hosts']:
+        snapshot_node(path, host, run_path, fmt, timer)
+
+    # snapshot.py: the schema and ring stand-ins, the merged manifest and
+    # the bundle of every node archive
+    title = 'benchmark'
+    with open(fetched + '/ring_info.txt', 'w') as f:
+        f.write('\n'.join(cluster['hosts']) + '\n')
+    shutil.copy(path + '/schema.json', fetched + '/schemas.zip')
+    merge_node_manifests(fetched, title, fmt)
+    size = table_size(fetched)
+    with timer.stage('bundle', size, len(os.listdir(fetched))):
+        bundle_path = bundle_dir(fetched, run_path, title, fmt)
+    shutil.rmtree(fetched)
+
+    if transfer is not None:
+        key = 'cassandra-snapshot-benchmark-' + os.path.basename(bundle_path)
+        size = os.path.getsize(bundle_path)
+        with timer.stage('upload', size, 1):
+            transfer.upload_file(bundle_path, key)
+        os.remove(bundle_path)
+        with timer.stage('download', size, 1):
+            transfer.download_file(key, bundle_path)
+        transfer.client.delete_object(Bucket=transfer.bucket.name, Key=key)
+
+    # restore.py unpacks the bundle, each node extracts and loads its archive
+    unpacked = run_path + '/unpacked'
+    with timer.stage('extract', os.path.getsize(bundle_path)):
+        extract_snapshot(bundle_path, unpacked)
+    for host in cluster['hosts']:
+        restore_node(path, host, '%s/%s.%s' % (unpacked, host, fmt),
+                     run_path + '/restore/' + host, timer)
+
+    shutil.rmtree(run_path)
+    return timer
+
+
+# Results
+def median(values):
+
+    values = sorted(values)
+    middle = len(values) // 2
+    if len(values) % 2:
+        return values[middle]
+    return (values[middle - 1] + values[middle]) / 2.0
+
+
+def summarize(runs):
+    # One entry per stage from the StageTimers of every run
+
+    summary = {}
+    for stage in STAGES:
+        timed = [timer.stages[stage] for timer in runs if stage in timer.stages]
+        if not timed:
+            continue
+        seconds = median([entry['seconds'] for entry in timed])
+        summary[stage] = {
+            'seconds': seconds,
+            'runs': [entry['seconds'] for entry in timed],
+            'bytes': timed[0]['bytes'],
+            'files': timed[0]['files'],
+            'mb_per_second': timed[0]['bytes'] / float(_MB) / seconds
+                             if seconds else None
+        }
+    return summary
+
+
+def git_commit():
+
+    try:
+        return subprocess.check_output(['git', 'rev-parse', 'HEAD'],
+                                       cwd=sys.path[0],
+                                       stderr=subprocess.STDOUT,
+                                       universal_newlines=True).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def report(results):
+
+    lines = ['%-8s %-10s %10s %10s %8s' % ('format', 'stage', 'seconds',
+                                           'MB/s', 'files')]
+    for fmt in sorted(results['results']):
+        for stage in STAGES:
+            entry = results['results'][fmt].get(stage)
+            if entry is None:
+                continue
+            lines.append('%-8s %-10s %10.3f %10s %8i'
+                         % (fmt, stage, entry['seconds'],
+                            '%.1f' % entry['mb_per_second']
+                            if entry['mb_per_second'] else '-',
+                            entry['files']))
+    return '\n'.join(lines)
+
+
+def compare(baseline, results):
+    # Change of every stage's median time from the baseline results
+
+    lines = []
+    if baseline.get('cluster', {}).get('settings') != \
+       results['cluster']['settings']:
+        lines.append('WARNING: the baseline ran on a different cluster')
+    lines.append('%-8s %-10s %10s %10s %8s' % ('format', 'stage', 'baseline',
+                                               'current', 'change'))
+    for fmt in sorted(results['results']):
+        for stage in STAGES:
+            current = results['results'][fmt].get(stage)
+            base = baseline.get('results', {}).get(fmt, {}).get(stage)
+            if current is None or base is None:
+                continue
+            change = '-'
+            if base['seconds']:
+                change = '%+.1f%%' % ((current['seconds'] - base['seconds']) /
+                                      base['seconds'] * 100)
+            lines.append('%-8s %-10s %10.3f %10.3f %8s'
+                         % (fmt, stage, base['seconds'], current['seconds'],
+                            change))
+    return '\n'.join(lines)
+
+
+def benchmark(cmds):
+
+    temporary = not cmds.path
+    path = os.path.abspath(cmds.path or tempfile.mkdtemp(prefix='snapshot-benchmark-'))
+    if not os.path.isdir(path):
+        os.makedirs(path)
+
+    s3 = None
+    try:
+        cluster = load_cluster(path, cluster_settings(cmds))
+        install_shims(path)
+
+        transfer = None
+        s3 = s3_stand_in(cmds)
+        if s3 is not None:
+            config = ConfigParser()
+            config.read(sys.path[0] + '/config.ini')
+            transfer = TransferEngine(s3[0], **get_transfer_settings(config))
+
+        results = {
+            'version': RESULTS_VERSION,
+            'created': int(time.time()),
+            'commit': git_commit(),
+            'python': platform.python_version(),
+            'platform': platform.platform(),
+            'cluster': cluster,
+            'repeat': cmds.repeat,
+            's3': cmds.s3_endpoint or ('moto' if transfer else None),
+            'results': {}
+        }
+        for fmt in cmds.formats:
+            runs = []
+            for run in range(cmds.repeat):
+                print('Running %s, %i of %i . . .' % (fmt, run + 1, cmds.repeat))
+                runs.append(run_pipeline(path, cluster, fmt, transfer))
+            results['results'][fmt] = summarize(runs)
+    finally:
+        if s3 is not None:
+            s3[1]()
+        if temporary:
+            shutil.rmtree(path)
+
+    output = cmds.output
+    if not output:
+        output_dir = sys.path[0] + '/benchmarks'
+        if not os.path.isdir(output_dir):
+            os.makedirs(output_dir)
+        output = output_dir + '/%i.json' % results['created']
+    with open(output, 'w') as f:
+        json.dump(results, f, indent=2, sort_keys=True)
+
+    print('')
+    print(report(results))
+    print('\nResults saved in %s' % output)
+    if cmds.compare:
+        with open(cmds.compare, 'r') as f:
+            baseline = json.load(f)
+        print('')
+        print(compare(baseline, results))
+
+
+if __name__ == '__main__':
+
+    cmds = parse_cmd()
+
+    start = time.time()
+    benchmark(cmds)
+    end = time.time()
+
+    print('Elapsed time: %s' % (end - start))
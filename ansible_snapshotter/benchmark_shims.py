@@ -0,0 +1,141 @@
+import os
+import sys
+import json
+import shutil
+
+import yaml
+
+# Stand-ins for nodetool, cqlsh and sstableloader used by benchmark.py. They
+# act on the synthetic data directories of the node whose cassandra.yaml is
+# in CASSANDRA_YAML and answer schema queries from the BENCHMARK_SCHEMA file:
+#
+#   python benchmark_shims.py nodetool snapshot -t <tag> [-cf <table>] [<keyspace> ...]
+#   python benchmark_shims.py cqlsh <host> < statements
+#   python benchmark_shims.py sstableloader -d <hosts> <table dir>
+
+_RELEASE_VERSION = '3.11.4'
+_REPLICATION = "{'class': 'org.apache.cassandra.locator.SimpleStrategy', " + \
+               "'replication_factor': '1'}"
+_CHUNK_SIZE = 1024 * 1024
+
+
+def data_dirs():
+
+    with open(os.environ['CASSANDRA_YAML'], 'r') as f:
+        return yaml.safe_load(f)['data_file_directories']
+
+
+def read_schema():
+    # {keyspace: {table: uuid}}
+
+    with open(os.environ['BENCHMARK_SCHEMA'], 'r') as f:
+        return json.load(f)
+
+
+def table_dirs(keyspaces=None, table=None):
+    # (keyspace, table directory) of every table in the data directories
+
+    for data_dir in data_dirs():
+        for ks in sorted(os.listdir(data_dir)):
+            if keyspaces and ks not in keyspaces:
+                continue
+            for tb_dir in sorted(os.listdir(data_dir + '/' + ks)):
+                if table and tb_dir.rsplit('-', 1)[0] != table:
+                    continue
+                yield ks, data_dir + '/' + ks + '/' + tb_dir
+
+
+# nodetool
+def nodetool(args):
+
+    command = args[0] if args else ''
+    if command == 'snapshot':
+        # hardlinks every sstable into snapshots/<tag>, like Cassandra
+        tag = args[args.index('-t') + 1]
+        table = args[args.index('-cf') + 1] if '-cf' in args else None
+        keyspaces = [arg for idx, arg in enumerate(args[1:], 1)
+                     if args[idx - 1] not in ('-t', '-cf') and
+                     arg not in ('-t', '-cf')]
+        for ks, path in table_dirs(keyspaces, table):
+            snapshot_dir = path + '/snapshots/' + tag
+            if not os.path.isdir(snapshot_dir):
+                os.makedirs(snapshot_dir)
+            for f in os.listdir(path):
+                if os.path.isfile(path + '/' + f):
+                    os.link(path + '/' + f, snapshot_dir + '/' + f)
+        print('Snapshot directory: %s' % tag)
+    elif command == 'clearsnapshot':
+        for ks, path in table_dirs():
+            if os.path.isdir(path + '/snapshots'):
+                shutil.rmtree(path + '/snapshots')
+    elif command in ('import', 'refresh', 'status', 'info', 'ring',
+                     'describecluster'):
+        pass
+    else:
+        print('nodetool: unknown command %s' % command)
+        return 1
+    return 0
+
+
+# cqlsh
+def print_rows(columns, rows):
+
+    print('')
+    print(' ' + ' | '.join(columns))
+    print('-' + '-+-'.join('-' * len(c) for c in columns))
+    for row in rows:
+        print(' ' + ' | '.join(row))
+    print('\n(%i rows)' % len(rows))
+
+
+def cqlsh(args):
+
+    statements = sys.stdin.read()
+    schema = read_schema()
+    if 'system.local' in statements:
+        print_rows(['schema_version', 'release_version'],
+                   [['benchmark-%i' % len(json.dumps(schema, sort_keys=True)),
+                     _RELEASE_VERSION]])
+    elif 'system_schema.keyspaces' in statements and 'replication' in statements:
+        print_rows(['replication'], [[_REPLICATION]])
+    elif 'system_schema.keyspaces' in statements:
+        print_rows(['keyspace_name'],
+                   [[ks] for ks in ['system', 'system_schema'] + sorted(schema)])
+    elif 'system_schema.tables' in statements:
+        print_rows(['keyspace_name', 'table_name', 'id'],
+                   [[ks, tb, schema[ks][tb]] for ks in sorted(schema)
+                    for tb in sorted(schema[ks])])
+    # schema statements and exit need no output
+    return 0
+
+
+# sstableloader
+def sstableloader(args):
+    # reads every file of the table like a stream session would
+
+    table_dir = args[-1]
+    streamed = 0
+    for f in sorted(os.listdir(table_dir)):
+        with open(table_dir + '/' + f, 'rb') as fin:
+            chunk = fin.read(_CHUNK_SIZE)
+            while chunk:
+                streamed += len(chunk)
+                chunk = fin.read(_CHUNK_SIZE)
+    print('Summary statistics:')
+    print('   Total bytes transferred : %i' % streamed)
+    return 0
+
+
+TOOLS = {
+    'nodetool': nodetool,
+    'cqlsh': cqlsh,
+    'sstableloader': sstableloader
+}
+
+
+if __name__ == '__main__':
+
+    if len(sys.argv) < 2 or sys.argv[1] not in TOOLS:
+        print('usage: benchmark_shims.py %s [args]' % '|'.join(sorted(TOOLS)))
+        sys.exit(2)
+    sys.exit(TOOLS[sys.argv[1]](sys.argv[2:]))
@@ -0,0 +1,148 @@
+import os
+import json
+import time
+import calendar
+
+import botocore
+
+from snapshotter.manifest import MANIFEST_FILE
+
+# Catalog of the snapshots in the S3 bucket:
+#
+#   cassandra-snapshot-<title>     bundle uploaded by snapshot.py --s3
+#   cassandra-snapshot-<title>/    uploaded by the nodes (--direct); complete
+#                                  once its manifest.json is written
+#
+# Only the cassandra-snapshot- prefix is listed, one level deep and a page at
+# a time, so the listing does not grow with the rest of the bucket or with
+# the objects inside --direct snapshots. The result is cached with every
+# snapshot's ETag and LastModified; while the cache is younger than max_age
+# it is shown without listing again, and the snapshot picked from it is
+# checked with a HEAD request before it is used.
+
+SNAPSHOT_PREFIX = 'cassandra-snapshot-'
+MAX_AGE = 300 # seconds a cached listing is used without listing again
+
+
+def _seconds(timestamp):
+    # LastModified is listed in milliseconds but HEAD returns whole seconds
+    return calendar.timegm(timestamp.utctimetuple())
+
+
+class SnapshotCatalog(object):
+
+    def __init__(self, bucket, cache_path, max_age=MAX_AGE):
+
+        self.bucket = bucket
+        self.client = bucket.meta.client
+        self.cache_path = cache_path
+        self.max_age = max_age
+        self._cache = self._load()
+
+    def _load(self):
+
+        try:
+            with open(self.cache_path, 'r') as f:
+                cache = json.load(f)
+            if cache.get('bucket') == self.bucket.name:
+                return cache
+        except (IOError, OSError, ValueError):
+            pass
+        return {'bucket': self.bucket.name, 'listed': 0, 'snapshots': {}}
+
+    def _save(self):
+
+        if not os.path.isdir(os.path.dirname(self.cache_path)):
+            os.makedirs(os.path.dirname(self.cache_path))
+        with open(self.cache_path + '.tmp', 'w') as f:
+            json.dump(self._cache, f, sort_keys=True)
+        os.rename(self.cache_path + '.tmp', self.cache_path)
+
+    def _marker(self, key):
+        # object that stands for a snapshot
+        return key + MANIFEST_FILE if key.endswith('/') else key
+
+    def head(self, key):
+        # ETag, LastModified and size of an object, or None if it is missing
+
+        try:
+            response = self.client.head_object(Bucket=self.bucket.name, Key=key)
+        except botocore.exceptions.ClientError as e:
+            if e.response['Error']['Code'] in ('404', 'NoSuchKey', 'NotFound'):
+                return None
+            raise e
+        return {
+            'etag': response['ETag'],
+            'modified': _seconds(response['LastModified']),
+            'size': response['ContentLength']
+        }
+
+    def exists(self, key):
+        # True if anything is stored under key; a prefix counts even before
+        # its manifest is written
+
+        if not key.endswith('/'):
+            return self.head(key) is not None
+        response = self.client.list_objects_v2(Bucket=self.bucket.name,
+                                               Prefix=key, MaxKeys=1)
+        return response.get('KeyCount', 0) > 0
+
+    def refresh(self):
+        # Lists the snapshots and rewrites the cache; returns their keys
+
+        cached = self._cache['snapshots']
+        snapshots = {}
+        paginator = self.client.get_paginator('list_objects_v2')
+        for page in paginator.paginate(Bucket=self.bucket.name,
+                                       Prefix=SNAPSHOT_PREFIX, Delimiter='/'):
+            for obj in page.get('Contents', []):
+                snapshots[obj['Key']] = {
+                    'etag': obj['ETag'],
+                    'modified': _seconds(obj['LastModified']),
+                    'size': obj['Size']
+                }
+            for common in page.get('CommonPrefixes', []):
+                prefix = common['Prefix']
+                if prefix in cached: # its manifest was already found
+                    snapshots[prefix] = cached[prefix]
+                    continue
+                info = self.head(prefix + MANIFEST_FILE)
+                if info is not None:
+                    snapshots[prefix] = info
+
+        self._cache = {
+            'bucket': self.bucket.name,
+            'listed': time.time(),
+            'snapshots': snapshots
+        }
+        self._save()
+        return sorted(snapshots)
+
+    def snapshots(self, refresh=False):
+        # Keys of every snapshot, from the cache while it is fresh
+
+        if refresh or time.time() - self._cache['listed'] > self.max_age:
+            return self.refresh()
+        return sorted(self._cache['snapshots'])
+
+    def check(self, key):
+        # True if the snapshot is in the bucket. The cache entry follows
+        # what HEAD finds: it is dropped when the snapshot is gone and
+        # replaced when its ETag or LastModified changed.
+
+        info = self.head(self._marker(key))
+        cached = self._cache['snapshots'].get(key)
+        if info is None:
+            if cached is not None:
+                del self._cache['snapshots'][key]
+                self._save()
+            return False
+        if cached is None or (cached['etag'], cached['modified']) != \
+                             (info['etag'], info['modified']):
+            self._cache['snapshots'][key] = info
+            self._save()
+        return True
+
+    def add(self, key):
+        # Records a snapshot that was just uploaded
+        return self.check(key)
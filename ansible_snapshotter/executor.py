@@ -0,0 +1,415 @@
+import os
+import sys
+import shutil
+import subprocess
+import threading
+import tempfile
+from multiprocessing.pool import ThreadPool
+try:
+    from ConfigParser import ConfigParser
+except:
+    from configparser import ConfigParser # python3
+
+from snapshotter.metrics import METRICS_DIR, phase
+from snapshotter.profiling import PROFILE_DIR, PROFILE_FILES
+
+# Runs the stages of snapshot.yml, restore.yml and install.yml without
+# ansible-playbook. Every node keeps one SSH connection open for the whole
+# run, and each node goes through its own steps as fast as it can; the only
+# barriers left are the ones the cluster needs (the schema is dropped before
+# the data is cleaned, and loaded before any node streams sstables).
+
+EXECUTORS = ['ansible', 'ssh', 'local']
+DEFAULT_FAN_OUT = 20 # nodes worked on at once
+
+# relative to the home directory, like ~/ansible_playbook/snapshotter
+HOST_SNAPSHOTTER_DIRECTORY = 'ansible_playbook/snapshotter'
+
+
+def _stream(cmd, output=None, **kwargs):
+    # Runs cmd, handing every line of output to output(line) as it arrives;
+    # returns (returncode, output)
+
+    process = subprocess.Popen(cmd,
+                               stdout=subprocess.PIPE,
+                               stderr=subprocess.STDOUT,
+                               universal_newlines=True,
+                               **kwargs)
+    lines = []
+    for line in iter(process.stdout.readline, ''):
+        lines.append(line)
+        if output:
+            output(line.rstrip('\n'))
+    process.stdout.close()
+    return process.wait(), ''.join(lines)
+
+
+# Hosts
+class SSHHost(object):
+    # A node reached through a persistent OpenSSH master connection; every
+    # command and copy goes over it instead of connecting again
+
+    def __init__(self, host, control_dir, user=None, port=None):
+
+        self.host = host
+        self.target = user + '@' + host if user else host
+        self.options = ['-o', 'ControlMaster=auto',
+                        '-o', 'ControlPath=%s/%%r@%%h:%%p' % control_dir,
+                        '-o', 'ControlPersist=600',
+                        '-o', 'BatchMode=yes']
+        if port:
+            self.options += ['-o', 'Port=%s' % port]
+
+    def run(self, command, output=None):
+        # command runs in the home directory of the node
+        return _stream(['ssh'] + self.options + [self.target, command], output)
+
+    def put(self, src, dest):
+        return _stream(['scp', '-q', '-p', '-r'] + self.options +
+                       [src, '%s:%s' % (self.target, dest)])[0]
+
+    def get(self, src, dest):
+        return _stream(['scp', '-q', '-p'] + self.options +
+                       ['%s:%s' % (self.target, src), dest])[0]
+
+    def close(self):
+        _stream(['ssh'] + self.options + ['-O', 'exit', self.target])
+
+
+class LocalHost(object):
+    # Fake node for testing: its home directory is a local directory and
+    # commands run as local processes
+
+    def __init__(self, host, root):
+
+        self.host = host
+        self.home = os.path.join(root, host)
+        if not os.path.isdir(self.home):
+            os.makedirs(self.home)
+
+    def _path(self, path):
+        # node paths are relative to the home directory
+        return os.path.join(self.home, path)
+
+    def run(self, command, output=None):
+
+        env = dict(os.environ)
+        env['HOME'] = self.home
+        if command.startswith('python '): # the node's python is this one
+            command = sys.executable + command[len('python'):]
+        return _stream(command, output, shell=True, cwd=self.home, env=env)
+
+    def put(self, src, dest):
+
+        dest = self._path(dest)
+        if os.path.isdir(dest):
+            dest = os.path.join(dest, os.path.basename(src.rstrip('/')))
+        if os.path.isdir(src):
+            if os.path.isdir(dest):
+                shutil.rmtree(dest)
+            shutil.copytree(src, dest)
+        else:
+            shutil.copy2(src, dest)
+        return 0
+
+    def get(self, src, dest):
+
+        src = self._path(src)
+        if not os.path.isfile(src):
+            return 1
+        shutil.copy2(src, dest)
+        return 0
+
+    def close(self):
+        pass
+
+
+# Executor
+class Executor(object):
+
+    def __init__(self, hosts, fan_out=DEFAULT_FAN_OUT, log_dir=None):
+
+        self.hosts = hosts
+        self.fan_out = fan_out
+        self.log_dir = log_dir
+        self._lock = threading.Lock()
+
+    def run(self, host, name, command):
+        # Runs a script on a node, printing its output live; like the
+        # playbooks, the output is saved in output_logs/<name>-<host>.txt
+
+        def output(line):
+            with self._lock:
+                print('[%s] %s' % (host.host, line))
+                sys.stdout.flush()
+
+        returncode, log = host.run(command, output)
+        if self.log_dir:
+            with open('%s/%s-%s.txt' % (self.log_dir, name, host.host), 'w') as f:
+                f.write(log)
+        if returncode != 0:
+            output('ERROR: %s failed (%i), output in output_logs/%s-%s.txt'
+                   % (name, returncode, name, host.host))
+        return returncode
+
+    def fetch_metrics(self, host, command):
+        # The node's phase records, saved like the playbooks do as
+        # output_logs/<command>-<host>.metrics.jsonl; a node that did not
+        # get as far as writing them is skipped
+
+        if self.log_dir:
+            host.get('%s/%s/%s.jsonl' % (HOST_SNAPSHOTTER_DIRECTORY, METRICS_DIR, command),
+                     '%s/%s-%s.metrics.jsonl' % (self.log_dir, command, host.host))
+
+    def fetch_profiles(self, host, scripts):
+        # --profile: the scripts' profiles, saved like the playbooks do in
+        # output_logs/profiles/<host>/
+
+        if self.log_dir:
+            dest = '%s/profiles/%s' % (self.log_dir, host.host)
+            if not os.path.isdir(dest):
+                os.makedirs(dest)
+            for script in scripts:
+                for ext in PROFILE_FILES:
+                    host.get('%s/%s/%s.%s' % (HOST_SNAPSHOTTER_DIRECTORY, PROFILE_DIR,
+                                              script, ext), dest + '/')
+
+    def check(self, host, name, returncode):
+
+        if returncode != 0:
+            raise Exception('%s failed on %s' % (name, host.host))
+
+    def each(self, func, hosts=None, fan_out=None):
+        # Runs func(host) on every node, fan_out nodes at a time (or fewer,
+        # if given); each node moves on through func without waiting for the
+        # others. Returns True if every node succeeded.
+
+        def run(host):
+            try:
+                func(host)
+                return True
+            except Exception as e:
+                with self._lock:
+                    print('[%s] ERROR: %s' % (host.host, e))
+                return False
+
+        hosts = hosts or self.hosts
+        fan_out = min(fan_out or self.fan_out, self.fan_out)
+        pool = ThreadPool(max(min(fan_out, len(hosts)), 1))
+        try:
+            results = pool.map(run, hosts)
+        finally:
+            pool.close()
+            pool.join()
+        return all(results)
+
+    def once(self, func):
+        # Runs func on the first node only, like run_once in the playbooks
+        return self.each(func, self.hosts[:1])
+
+    def close(self):
+        for host in self.hosts:
+            host.close()
+
+
+# Node steps shared by the stages
+def _reload(executor, host, src):
+
+    directory = HOST_SNAPSHOTTER_DIRECTORY
+    executor.check(host, 'reload', host.run('rm -rf %s && mkdir -p %s'
+                                            % (directory, os.path.dirname(directory)))[0])
+    executor.check(host, 'reload', host.put(src, os.path.dirname(directory)))
+
+
+def _check_module(executor, host, module, requirement):
+
+    if host.run('python -c "import %s"' % module)[0] != 0:
+        executor.check(host, 'pip install ' + requirement,
+                       executor.run(host, 'pip', 'sudo -n pip install ' + requirement))
+
+
+def snapshot_stages(executor, args, src):
+    # snapshot.yml: the first node saves the schema before its snapshot,
+    # the other nodes start their snapshots straight away
+
+    directory = HOST_SNAPSHOTTER_DIRECTORY
+    first = executor.hosts[0]
+
+    def node(host):
+
+        if args['reload']:
+            _reload(executor, host, src)
+        _check_module(executor, host, 'yaml', 'pyyaml==3.11')
+
+        if host is first:
+            returncode = executor.run(host, 'schema', 'python %s/%s'
+                                      % (directory, args['save_schema_command']))
+            if args['profile']:
+                executor.fetch_profiles(host, ['save_schema'])
+            executor.check(host, 'save_schema', returncode)
+            for f in ('ring_info.txt', 'schemas.zip'):
+                executor.check(host, 'fetch ' + f, host.get(
+                        '%s/.snapshots/%s' % (directory, f), args['path'] + '/' + f))
+
+        if args['known_objects']:
+            executor.check(host, 'copy known objects', host.put(
+                    args['known_objects'], directory + '/known_objects.txt'))
+        if args['upload_config']:
+            _check_module(executor, host, 'boto3', 'boto3')
+            executor.check(host, 'copy upload settings', host.put(
+                    args['upload_config'], directory + '/upload.ini'))
+
+        returncode = executor.run(host, 'snapshot', 'python %s/%s'
+                                  % (directory, args['snapshotter_command']))
+        if args['upload_config']:
+            host.run('rm -f %s/upload.ini' % directory)
+        executor.fetch_metrics(host, 'snapshot')
+        if args['profile']:
+            executor.fetch_profiles(host, ['snapshotter'])
+        executor.check(host, 'snapshotter', returncode)
+
+        if args['node_file']:
+            node_file = '%s.%s' % (host.host, args['node_file'])
+            with phase('fetch', files=1, node=host.host) as counts:
+                executor.check(host, 'fetch snapshot', host.get(
+                        '%s/.snapshots/%s' % (directory, node_file), args['path'] + '/'))
+                counts['bytes'] = os.path.getsize(args['path'] + '/' + node_file)
+        if args['node_manifest']:
+            executor.check(host, 'fetch manifest', host.get(
+                    '%s/.snapshots/%s.manifest.json' % (directory, host.host),
+                    args['path'] + '/'))
+
+    return executor.each(node)
+
+
+def restore_stages(executor, args, src, temp_path):
+    # restore.yml
+
+    directory = HOST_SNAPSHOTTER_DIRECTORY
+    nodes = ' '.join(host.host for host in executor.hosts)
+
+    def prepare(host):
+
+        if args['reload']:
+            _reload(executor, host, src)
+        _check_module(executor, host, 'yaml', 'pyyaml==3.11')
+        if args['hard_reset']:
+            executor.check(host, 'hard_reset.py', executor.run(
+                    host, 'hard_reset_shutdown', 'python %s/hard_reset.py -s shutdown' % directory))
+
+    def restart(host):
+        # rolling: restart_batch nodes at a time, each until it answers queries
+
+        executor.check(host, 'hard_reset.py', executor.run(
+                host, 'hard_reset_start', 'nohup python %s/%s'
+                % (directory, args['hard_reset_start_command'])))
+
+    def rolling(func):
+        return executor.each(func, fan_out=args['restart_batch'])
+
+    def destroy(host):
+        executor.run(host, 'destroy', 'python %s/destroy.py' % directory)
+
+    def clean(host):
+        # the node archive is copied as soon as the node is clean
+
+        returncode = executor.run(host, 'cleaner', 'python %s/%s'
+                                  % (directory, args['cleaner_command']))
+        if args['profile']:
+            executor.fetch_profiles(host, ['cleaner'])
+        executor.check(host, 'cleaner.py', returncode)
+        executor.check(host, 'prepare directories', host.run(
+                'rm -rf {0}/.snapshots {0}/.temp && mkdir -p {0}/.snapshots {0}/.temp'
+                .format(directory))[0])
+        archive = '%s/%s.%s' % (temp_path, host.host, args['archive_format'])
+        with phase('push', os.path.getsize(archive), 1, node=host.host):
+            executor.check(host, 'copy snapshot', host.put(
+                    archive, directory + '/.snapshots/'))
+        executor.check(host, 'copy ring info', host.put(
+                temp_path + '/ring_info.txt', directory + '/.snapshots/'))
+        executor.check(host, 'copy schema', host.put(
+                temp_path + '/schemas.zip', directory + '/.snapshots/'))
+
+    def load_schema(host):
+
+        executor.check(host, 'copy schema', host.put(
+                temp_path + '/schemas.zip', directory + '/.temp/'))
+        returncode = executor.run(host, 'schema', 'python %s/%s'
+                                  % (directory, args['load_schema_command']))
+        if args['profile']:
+            executor.fetch_profiles(host, ['load_schema'])
+        executor.check(host, 'load_schema.py', returncode)
+
+    def load(host):
+
+        returncode = executor.run(host, 'restore', 'python %s/%s --nodes %s'
+                                  % (directory, args['restore_command'], nodes))
+        executor.fetch_metrics(host, 'restore')
+        if args['profile']:
+            executor.fetch_profiles(host, ['restore'])
+        executor.check(host, 'restore.py', returncode)
+
+    stages = [(executor.each, prepare)]
+    if args['hard_reset']:
+        stages.append((rolling, restart))
+    stages += [(executor.once, destroy), (executor.each, clean),
+               (executor.once, load_schema), (executor.each, load)]
+    for stage, func in stages:
+        if not stage(func):
+            return False
+    return True
+
+
+def install_stages(executor, args, src):
+    # install.yml
+
+    def node(host):
+        _reload(executor, host, src)
+        _check_module(executor, host, 'yaml', 'pyyaml==3.11')
+
+    return executor.each(node)
+
+
+def run_executor(play, args, backend='ssh', fan_out=None):
+    # Runs a playbook's stages with the built-in executor; returns 0 on
+    # success and 1 on failure like run_playbook
+
+    if play.endswith('.yml'):
+        play = play[:-len('.yml')]
+    root = sys.path[0]
+    src = root + '/snapshotter'
+
+    config = ConfigParser()
+    config.read(root + '/config.ini')
+    def setting(option):
+        if config.has_option('ssh', option) and config.get('ssh', option):
+            return config.get('ssh', option)
+        return None
+    if fan_out is None:
+        fan_out = int(setting('fan_out') or DEFAULT_FAN_OUT)
+
+    control_dir = None
+    hosts = []
+    for node in args['nodes'].split():
+        if backend == 'local':
+            hosts.append(LocalHost(node, root + '/.fake_hosts'))
+        else:
+            if control_dir is None:
+                control_dir = tempfile.mkdtemp(prefix='snapshotter-ssh-')
+            hosts.append(SSHHost(node, control_dir, setting('user'), setting('port')))
+
+    executor = Executor(hosts, fan_out, root + '/output_logs')
+    try:
+        if play == 'snapshot':
+            success = snapshot_stages(executor, args, src)
+        elif play == 'restore':
+            success = restore_stages(executor, args, src, root + '/.temp')
+        elif play == 'install':
+            success = install_stages(executor, args, src)
+        else:
+            raise Exception('No executor stages for %s' % play)
+    finally:
+        executor.close()
+        if control_dir:
+            shutil.rmtree(control_dir, True)
+    return 0 if success else 1
@@ -5,6 +5,7 @@ try:
 except:
     from configparser import ConfigParser
 
+from executor import EXECUTORS
 from utils import run_playbook
 
 def parse_cmd():
@@ -16,16 +17,30 @@ def parse_cmd():
                         help='Specify the hosts from the Ansible inventory or ' +
                              'through a space separated list'
     )
+    parser.add_argument('--executor',
+                        required=False,
+                        choices=EXECUTORS,
+                        default='ansible',
+                        help='Run the stages with ansible-playbook, or over ' +
+                             'persistent SSH connections (ssh), or on fake ' +
+                             'local hosts for testing (local)'
+    )
+    parser.add_argument('--fan-out',
+                        required=False,
+                        type=int,
+                        help='Nodes worked on at once by the ssh and local ' +
+                             'executors (default 20, or fan_out in config.ini)'
+    )
     return parser.parse_args()
     
 
-def install(nodes):
+def install(nodes, executor='ansible', fan_out=None):
 
     playbook_args = {
         'nodes' : ' '.join(nodes),
     }
 
-    return_code = run_playbook('install.yml', playbook_args)
+    return_code = run_playbook('install.yml', playbook_args, executor, fan_out)
     if return_code != 0:
         print('Error running ansible script')
     else:
@@ -45,4 +60,4 @@ if __name__ == '__main__':
     else:
         nodes = cmds.nodes
 
-    install(nodes)
+    install(nodes, cmds.executor, cmds.fan_out)
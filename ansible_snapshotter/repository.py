@@ -0,0 +1,289 @@
+import os
+import json
+import time
+import shutil
+
+import botocore
+
+from snapshotter.archive import (ArchiveReader, checksum_mismatches, dir_members,
+                                 index_checksums, split_format, write_archive)
+from snapshotter.objects import OBJECT_MANIFEST
+
+# Deduplicated backup repository. Sstable components are immutable, so each
+# one is stored once and snapshots only reference them:
+#
+#   objects/<node>/<keyspace>/<table>/<file>/<size>-<checksum>
+#   snapshots/<title>/manifest.json    every file of every node and its object
+#   snapshots/<title>/schemas.zip
+#   snapshots/<title>/ring_info.txt
+#   latest.json                        title of the newest snapshot
+
+_MANIFEST_VERSION = 1
+_SNAPSHOT_FILES = ['schemas.zip', 'ring_info.txt']
+
+
+# Storage Backends
+class LocalBackend(object):
+    # Repository in a local (or mounted) directory
+
+    def __init__(self, root):
+        self.root = root
+
+    def _path(self, key):
+        return os.path.join(self.root, key)
+
+    def exists(self, key):
+        return os.path.isfile(self._path(key))
+
+    def put_file(self, path, key):
+
+        dest = self._path(key)
+        if not os.path.isdir(os.path.dirname(dest)):
+            os.makedirs(os.path.dirname(dest))
+        shutil.copyfile(path, dest)
+
+    def get_file(self, key, path):
+
+        if not os.path.isdir(os.path.dirname(path)):
+            os.makedirs(os.path.dirname(path))
+        shutil.copyfile(self._path(key), path)
+
+    def put_bytes(self, data, key):
+
+        dest = self._path(key)
+        if not os.path.isdir(os.path.dirname(dest)):
+            os.makedirs(os.path.dirname(dest))
+        with open(dest, 'wb') as f:
+            f.write(data)
+
+    def get_bytes(self, key):
+
+        with open(self._path(key), 'rb') as f:
+            return f.read()
+
+    def put_files(self, pairs):
+        for path, key in pairs:
+            self.put_file(path, key)
+
+    def get_files(self, pairs):
+        for key, path in pairs:
+            self.get_file(key, path)
+
+    def list(self, prefix):
+        # only walks the directory holding prefix, not the object store
+
+        directory = prefix[:prefix.rfind('/') + 1]
+        if not os.path.isdir(os.path.join(self.root, directory)):
+            return []
+        keys = []
+        for path, name in dir_members(os.path.join(self.root, directory)):
+            if (directory + name).startswith(prefix):
+                keys.append(directory + name)
+        return keys
+
+
+class S3Backend(object):
+    # Repository under a key prefix of an S3 bucket (utils.s3_bucket); files
+    # move through a transfer.TransferEngine (utils.s3_transfer)
+
+    def __init__(self, bucket, transfer, prefix='cassandra-repository/'):
+        self.bucket = bucket
+        self.transfer = transfer
+        self.prefix = prefix
+
+    def exists(self, key):
+
+        try:
+            self.bucket.Object(self.prefix + key).load() # HEAD request
+            return True
+        except botocore.exceptions.ClientError as e:
+            if e.response['Error']['Code'] in ('404', 'NoSuchKey', 'NotFound'):
+                return False
+            raise e
+
+    def put_file(self, path, key):
+        self.transfer.upload_file(path, self.prefix + key)
+
+    def get_file(self, key, path):
+
+        if not os.path.isdir(os.path.dirname(path)):
+            os.makedirs(os.path.dirname(path))
+        self.transfer.download_file(self.prefix + key, path)
+
+    def put_files(self, pairs):
+
+        if pairs:
+            result = self.transfer.upload_files(
+                    [(path, self.prefix + key) for path, key in pairs])
+            print(self.transfer.report(result))
+
+    def get_files(self, pairs):
+
+        for key, path in pairs:
+            if not os.path.isdir(os.path.dirname(path)):
+                os.makedirs(os.path.dirname(path))
+        if pairs:
+            result = self.transfer.download_files(
+                    [(self.prefix + key, path) for key, path in pairs])
+            print(self.transfer.report(result))
+
+    def put_bytes(self, data, key):
+        self.bucket.put_object(Key=self.prefix + key, Body=data)
+
+    def get_bytes(self, key):
+        return self.bucket.Object(self.prefix + key).get()['Body'].read()
+
+    def list(self, prefix):
+        return [obj.key[len(self.prefix):] for obj in
+                self.bucket.objects.filter(Prefix=self.prefix + prefix)]
+
+
+# Repository
+class Repository(object):
+
+    def __init__(self, backend):
+        self.backend = backend
+
+    def snapshots(self):
+        # Titles of every snapshot in the repository, oldest first by title
+
+        titles = set()
+        for key in self.backend.list('snapshots/'):
+            if key.endswith('/manifest.json'):
+                titles.add(key[len('snapshots/'):-len('/manifest.json')])
+        return sorted(titles)
+
+    def manifest(self, title):
+
+        try:
+            data = self.backend.get_bytes('snapshots/%s/manifest.json' % title)
+        except Exception:
+            raise Exception('Snapshot "%s" not found in repository' % title)
+        return json.loads(data.decode('utf-8'))
+
+    def latest(self):
+
+        if not self.backend.exists('latest.json'):
+            return None
+        return json.loads(self.backend.get_bytes('latest.json').decode('utf-8'))['title']
+
+    def known_objects(self):
+        # Objects referenced by any snapshot in the repository; nodes leave
+        # these out of their archives. Not only the newest one, which may
+        # have covered some keyspaces or tables (-ks/-tb).
+
+        keys = set()
+        for title in self.snapshots():
+            for entries in self.manifest(title)['nodes'].values():
+                for entry in entries:
+                    keys.add(entry['key'])
+        return keys
+
+    def write_known_objects(self, path):
+
+        keys = self.known_objects()
+        with open(path, 'w') as f:
+            for key in sorted(keys):
+                f.write(key + '\n')
+        return len(keys)
+
+    def store(self, title, snapshot_path):
+        # Uploads the new objects of every fetched node archive in
+        # snapshot_path, or takes the <node>.objects.json of nodes that
+        # uploaded their own objects, and writes the snapshot manifest
+
+        if self.backend.exists('snapshots/%s/manifest.json' % title):
+            raise Exception('Snapshot "%s" already in repository' % title)
+
+        manifest = {
+            'version': _MANIFEST_VERSION,
+            'title': title,
+            'created': time.time(),
+            'nodes': {}
+        }
+        total_bytes = 0
+        uploaded_bytes = 0
+        extracted = []
+        uploads = []
+        for f in sorted(os.listdir(snapshot_path)):
+            if f.endswith('.' + OBJECT_MANIFEST):
+                # the node uploaded its new objects itself (--direct)
+                node = f[:-len('.' + OBJECT_MANIFEST)]
+                with open(snapshot_path + '/' + f, 'r') as manifest_file:
+                    entries = json.load(manifest_file)
+                for entry in entries:
+                    total_bytes += entry['size']
+                    if entry.pop('new'):
+                        uploaded_bytes += entry['size']
+                manifest['nodes'][node] = entries
+                continue
+
+            node, fmt = split_format(f)
+            if not fmt or f in _SNAPSHOT_FILES:
+                continue
+
+            print('Storing objects of %s' % node)
+            reader = ArchiveReader(snapshot_path + '/' + f)
+            entries = json.loads(reader.read(OBJECT_MANIFEST).decode('utf-8'))
+            node_path = snapshot_path + '/' + node
+            reader.extractall(node_path)
+            mismatched = checksum_mismatches(reader.checksums, entries)
+            if mismatched:
+                raise Exception('Checksum mismatch in the archive of %s: %s'
+                                % (node, ', '.join(mismatched)))
+
+            for entry in entries:
+                total_bytes += entry['size']
+                if entry.pop('new') and not self.backend.exists(entry['key']):
+                    uploads.append((node_path + '/' + entry['name'], entry['key']))
+                    uploaded_bytes += entry['size']
+            manifest['nodes'][node] = entries
+            extracted.append(node_path)
+
+        self.backend.put_files(uploads)
+        for node_path in extracted:
+            shutil.rmtree(node_path, True)
+
+        for f in _SNAPSHOT_FILES:
+            self.backend.put_file(snapshot_path + '/' + f,
+                                  'snapshots/%s/%s' % (title, f))
+        self.backend.put_bytes(json.dumps(manifest).encode('utf-8'),
+                               'snapshots/%s/manifest.json' % title)
+        self.backend.put_bytes(json.dumps({'title': title}).encode('utf-8'),
+                               'latest.json')
+
+        print('Uploaded %i of %i bytes; the rest was already in the repository'
+              % (uploaded_bytes, total_bytes))
+        return manifest
+
+    def materialize(self, title, dest, select=None):
+        # Rebuilds the snapshot in dest as the layout restore.py expects:
+        # one <node>.tar per node next to schemas.zip and ring_info.txt.
+        # Only the objects whose names pass select are retrieved.
+
+        manifest = self.manifest(title)
+        downloads = []
+        for node, entries in manifest['nodes'].items():
+            for entry in entries:
+                if select is not None and not select(entry['name']):
+                    continue
+                downloads.append((entry['key'],
+                                  dest + '/' + node + '/' + entry['name']))
+        print('Retrieving %i objects' % len(downloads))
+        self.backend.get_files(downloads)
+
+        # the objects are checked as they are archived again
+        for node, entries in manifest['nodes'].items():
+            node_path = dest + '/' + node
+            index = []
+            write_archive(node_path + '.tar', dir_members(node_path), 'tar',
+                          index=index)
+            shutil.rmtree(node_path, True)
+            mismatched = checksum_mismatches(index_checksums(index), entries)
+            if mismatched:
+                raise Exception('Checksum mismatch in the objects of %s: %s'
+                                % (node, ', '.join(mismatched)))
+
+        for f in _SNAPSHOT_FILES:
+            self.backend.get_file('snapshots/%s/%s' % (title, f), dest + '/' + f)
+        return 'tar'
@@ -2,14 +2,24 @@ import argparse
 import os
 import sys
 import re
+import time
 import zipfile
 try:
     from ConfigParser import ConfigParser
 except:
     from configparser import ConfigParser # python3
 
-from utils import (run_playbook, s3_bucket, s3_list_snapshots,
-                   check_file, clean_dir, make_dir, prepare_dir) 
+from executor import EXECUTORS
+from utils import (run_playbook, s3_bucket, s3_transfer, s3_catalog,
+                   select_snapshot, extract_snapshot,
+                   s3_extract_snapshot, s3_extract_prefix, s3_read_member,
+                   check_file, clean_dir, make_dir, prepare_dir,
+                   start_run_metrics, write_run_report)
+from repository import Repository, LocalBackend, S3Backend
+from snapshotter.archive import ArchiveReader, member_filter, split_format
+from snapshotter.manifest import (MANIFEST_FILE, load_manifest, manifest_tables,
+                                  node_manifest, snapshot_manifest)
+from snapshotter.metrics import phase
 
 def parse_cmd():
 
@@ -45,12 +55,94 @@ def parse_cmd():
                         action='store_true',
                         help='Hard reset Cassandra on all nodes, then restore'
     )
+    parser.add_argument('--restart-batch',
+                        required=False,
+                        type=int,
+                        default=1,
+                        help='Nodes started at once after --hard-reset; each ' +
+                             'waits for the previous ones to answer queries ' +
+                             '(default 1)'
+    )
+    parser.add_argument('--start-timeout',
+                        required=False,
+                        type=int,
+                        help='Seconds each node may take to answer queries ' +
+                             'after --hard-reset (default 600)'
+    )
     parser.add_argument('--s3',
                         required=False,
                         nargs='?',
                         const=True,
                         help='Specify an s3 object key, or search S3 bucket for a snapshot'
     )
+    parser.add_argument('--repository',
+                        required=False,
+                        nargs='?',
+                        const=True,
+                        help='Restore from a backup repository; in the S3 bucket ' +
+                             'by default, or in the given directory'
+    )
+    parser.add_argument('--refresh',
+                        required=False,
+                        action='store_true',
+                        help='List the S3 bucket again instead of using the ' +
+                             'cached snapshot listing'
+    )
+    parser.add_argument('-t', '--title', '--tag', '--name',
+                        required=False,
+                        help='Title of the snapshot to restore from the repository'
+    )
+    parser.add_argument('--loaders',
+                        required=False,
+                        type=int,
+                        help='Concurrent sstableloaders across the cluster, ' +
+                             'split between the nodes (default 2 per node)'
+    )
+    parser.add_argument('--import',
+                        dest='import_sstables',
+                        required=False,
+                        action='store_true',
+                        help='Import sstables in place with nodetool when the ' +
+                             'ring and the keyspaces\' replication match the ' +
+                             'snapshot, stream them otherwise'
+    )
+    parser.add_argument('--route',
+                        required=False,
+                        action='store_true',
+                        help='Use ring_info.txt and the sstables\' token bounds ' +
+                             'to skip sstables outside each node\'s ranges'
+    )
+    parser.add_argument('--executor',
+                        required=False,
+                        choices=EXECUTORS,
+                        default='ansible',
+                        help='Run the stages with ansible-playbook, or over ' +
+                             'persistent SSH connections (ssh), or on fake ' +
+                             'local hosts for testing (local)'
+    )
+    parser.add_argument('--fan-out',
+                        required=False,
+                        type=int,
+                        help='Nodes worked on at once by the ssh and local ' +
+                             'executors (default 20, or fan_out in config.ini)'
+    )
+    parser.add_argument('-l', '--list',
+                        required=False,
+                        action='store_true',
+                        help='List the keyspaces and tables in the snapshot ' +
+                             'from its manifest, without restoring'
+    )
+    parser.add_argument('--prometheus',
+                        required=False,
+                        help='Also write the run\'s phase metrics to this ' +
+                             'Prometheus textfile'
+    )
+    parser.add_argument('--profile',
+                        required=False,
+                        action='store_true',
+                        help='Profile the node scripts; profiles are saved ' +
+                             'in output_logs/profiles/<node>/'
+    )
     return parser.parse_args()
 
 
@@ -72,12 +164,65 @@ def get_zipped_schema(path):
     return schema
 
 
+def get_archive_format(path):
+
+    # node archives are saved as <host>.<format> next to schemas.zip
+    for f in os.listdir(path):
+        if f == 'schemas.zip':
+            continue
+        name, fmt = split_format(f)
+        if fmt:
+            return fmt
+    raise Exception('ERROR: No node snapshots found in snapshot file')
+
+
+def bundle_manifest(read):
+
+    # read(name) returns a member of the bundle; the manifest is the first
+    # member of tar bundles, and zips index their members, so only the
+    # manifest is read
+    try:
+        return load_manifest(read(MANIFEST_FILE))
+    except KeyError:
+        raise Exception('ERROR: Snapshot has no %s; it was taken by an older '
+                        'snapshotter' % MANIFEST_FILE)
+
+
+def repository_manifest(repository, title):
+
+    # the repository lists every object of every node; only the index of
+    # each node's files is needed
+    manifest = repository.manifest(title)
+    nodes = {}
+    for node, entries in manifest['nodes'].items():
+        nodes[node] = node_manifest(None, entries)
+    return snapshot_manifest(title, 'tar', nodes, manifest['created'])
+
+
+def print_manifest(manifest):
+
+    print('Snapshot %s (%s), taken %s' % (manifest['title'], manifest['format'],
+          time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(manifest['created']))))
+    template = '{0:40} | {1:>8} | {2:>14}'
+    print(template.format('Table', 'Nodes', 'Bytes'))
+    tables = manifest_tables(manifest)
+    node_tables = [manifest_tables(manifest, node) for node in manifest['nodes']]
+    for ks in sorted(tables):
+        for tb in sorted(tables[ks]):
+            nodes = len([t for t in node_tables if tb in t.get(ks, {})])
+            print(template.format(ks + '.' + tb, nodes, tables[ks][tb]))
+    for node in sorted(manifest['nodes']):
+        files = manifest['nodes'][node]['files']
+        print('%s: %i files, %i bytes' % (node, len(files),
+                                          sum(entry['size'] for entry in files)))
+
+
 def ansible_restore(cmds):
 
-    if not (bool(cmds.path) ^ bool(cmds.s3)):
-        raise Exception('Only one of --path or --s3 must be specified') 
+    if [bool(cmds.path), bool(cmds.s3), bool(cmds.repository)].count(True) != 1:
+        raise Exception('Only one of --path, --s3 or --repository must be specified')
 
-    if not cmds.nodes:
+    if not cmds.nodes and not cmds.list:
         config = ConfigParser()
         if len(config.read('config.ini')) == 0:
             raise Exception('ERROR: Cannot find config.ini in script directory')
@@ -91,53 +236,102 @@ def ansible_restore(cmds):
     temp_path = sys.path[0] + '/.temp'
     prepare_dir(sys.path[0] + '/output_logs', output=True)
     prepare_dir(temp_path, output=True)
+    start_run_metrics('restore')
+
+    # only the members of the requested keyspaces and tables are extracted,
+    # copied to the nodes and loaded
+    select = member_filter(cmds.keyspace, cmds.table)
     
     if cmds.path:
         zip_path = cmds.path
+        if cmds.list:
+            print_manifest(bundle_manifest(ArchiveReader(zip_path).read))
+            return
     elif cmds.s3:
         s3 = s3_bucket()
-        s3_snapshots = s3_list_snapshots(s3)
+        catalog = s3_catalog(s3)
 
         if cmds.s3 == True: # not a string parameter
-            if len(s3_snapshots) == 0:
-                print('No snapshots found in s3')
-                exit(0)
+            s3_key = None
+            refresh = cmds.refresh
+            while s3_key is None:
+                s3_snapshots = catalog.snapshots(refresh)
+                if len(s3_snapshots) == 0:
+                    print('No snapshots found in s3')
+                    exit(0)
 
-            # search 
-            print('\nSnapshots found:')
-            template = '{0:5} | {1:67}'
-            print(template.format('Index', 'Snapshot'))
-            for idx, snap in enumerate(s3_snapshots):
                 # every snapshot starts with cassandra-snapshot- (19 chars)
-                stripped = snap[19:] 
-                print(template.format(idx + 1, stripped))
-            
-            index = 0
-            while index not in range(1, len(s3_snapshots) + 1):
-                try:
-                    index = int(raw_input('Enter snapshot index: '))
-                except ValueError:
-                    continue
-            s3_key = s3_snapshots[index - 1]
+                s3_key = select_snapshot(s3_snapshots, strip=19)
+                if not catalog.check(s3_key):
+                    print('"%s" is no longer in S3, listing again' % s3_key)
+                    s3_key = None
+                    refresh = True
 
         else:
             s3_key = cmds.s3
             if not s3_key.startswith('cassandra-snapshot-'):
                 s3_key = 'cassandra-snapshot-' + s3_key
 
-            if s3_key not in s3_snapshots:
-                raise Exception('S3 Snapshot not found')
+            if not catalog.check(s3_key):
+                s3_key += '/' # uploaded by the nodes (--direct)
+                if not catalog.check(s3_key):
+                    raise Exception('S3 Snapshot not found')
+
+        if cmds.list and s3_key.endswith('/'):
+            print_manifest(load_manifest(
+                    s3.Object(s3_key + MANIFEST_FILE).get()['Body'].read()))
+            return
 
         print('Retrieving snapshot from S3: %s' % s3_key)
-        s3.download_file(s3_key, temp_path + '/temp.zip') 
-        zip_path = temp_path + '/temp.zip'
+        transfer = s3_transfer(s3)
+        if cmds.list and not s3_key.endswith('/'):
+            print_manifest(bundle_manifest(
+                    lambda name: s3_read_member(transfer, s3_key, name)))
+            return
+        with phase('download') as counts:
+            if s3_key.endswith('/'):
+                # node archives, schemas.zip and ring_info.txt are separate objects
+                s3_extract_prefix(transfer, s3_key, temp_path, nodes, select)
+            else:
+                s3_extract_snapshot(transfer, s3_key, temp_path, nodes, select)
+            counts['bytes'] = transfer.bytes
+            counts['files'] = transfer.objects
+        # only the index, the archives of these nodes and, with -ks/-tb, the
+        # selected members are fetched
+        zip_path = None
+        archive_format = get_archive_format(temp_path)
+    elif cmds.repository:
+        if cmds.repository == True: # not a string parameter
+            bucket = s3_bucket()
+            repository = Repository(S3Backend(bucket, s3_transfer(bucket)))
+        else:
+            repository = Repository(LocalBackend(cmds.repository))
+
+        title = cmds.title
+        if not title:
+            snapshots = repository.snapshots()
+            if len(snapshots) == 0:
+                print('No snapshots found in repository')
+                exit(0)
+            title = select_snapshot(snapshots)
+
+        if cmds.list:
+            print_manifest(repository_manifest(repository, title))
+            return
+
+        print('Retrieving snapshot from repository: %s' % title)
+        zip_path = None
+        with phase('materialize'):
+            archive_format = repository.materialize(title, temp_path, select)
     else:
         raise Exception('No file specified.')
 
-    # unzip 
-    print('Unzipping snapshot file')
-    z = zipfile.ZipFile(zip_path, 'r')
-    z.extractall(temp_path)
+    # unzip; the bundle and node archive formats are detected from the files
+    if zip_path:
+        print('Unzipping snapshot file')
+        with phase('extract', os.path.getsize(zip_path), 1):
+            extract_snapshot(zip_path, temp_path, select)
+        archive_format = get_archive_format(temp_path)
 
     # check schema specification args
     print('Checking arguments . . .')
@@ -169,14 +363,38 @@ def ansible_restore(cmds):
     elif cmds.table:
         raise Exception('ERROR: Keyspace must be specified with tables')
 
+    if cmds.loaders:
+        restore_command += ' --loaders %i' % cmds.loaders
+    if cmds.import_sstables:
+        restore_command += ' --import'
+    if cmds.route:
+        restore_command += ' --route'
+    cleaner_command = 'cleaner.py'
+    hard_reset_start_command = 'hard_reset.py -s start'
+    if cmds.start_timeout:
+        hard_reset_start_command += ' --timeout %i' % cmds.start_timeout
+    if cmds.restart_batch < 1:
+        raise Exception('ERROR: --restart-batch must be at least 1')
+    if cmds.profile:
+        restore_command += ' --profile'
+        load_schema_command += ' --profile'
+        cleaner_command += ' --profile'
+
     playbook_args = {
         'nodes': ' '.join(nodes),
         'restore_command' : restore_command,
         'load_schema_command' : load_schema_command,
+        'cleaner_command' : cleaner_command,
         'reload' : cmds.reload,
-        'hard_reset' : cmds.hard_reset
+        'hard_reset' : cmds.hard_reset,
+        'hard_reset_start_command' : hard_reset_start_command,
+        'restart_batch' : cmds.restart_batch,
+        'archive_format' : archive_format,
+        'profile' : cmds.profile
     }
-    return_code = run_playbook('restore.yml', playbook_args)
+    with phase('playbook', executor=cmds.executor):
+        return_code = run_playbook('restore.yml', playbook_args,
+                                   cmds.executor, cmds.fan_out)
     
     if return_code != 0:
         print('ERROR: Ansible script failed to run properly. ' +
@@ -184,7 +402,10 @@ def ansible_restore(cmds):
     else:
         print('Process complete.')
         print('Output logs saved in %s' % (sys.path[0] + '/output_logs'))
-    
+
+    print('')
+    write_run_report('restore', cmds.prometheus)
+
 
 if __name__ == '__main__':
     cmds = parse_cmd()
@@ -1,5 +1,6 @@
 import argparse
 import os
+import re
 import sys
 import time
 import shutil
@@ -8,8 +9,16 @@ try:
 except:
     from configparser import ConfigParser # python3
 
-from utils import (clean_dir, make_dir, check_dir, zip_dir, prepare_dir,
-                   run_playbook, s3_bucket, confirm)
+from executor import EXECUTORS
+from utils import (clean_dir, make_dir, check_dir, bundle_dir, prepare_dir,
+                   run_playbook, s3_bucket, s3_transfer, s3_catalog,
+                   write_upload_config, confirm, start_run_metrics,
+                   write_run_report)
+from repository import Repository, LocalBackend, S3Backend
+from snapshotter.archive import FORMATS
+from snapshotter.manifest import MANIFEST_FILE, merge_node_manifests
+from snapshotter.objects import OBJECT_MANIFEST
+from snapshotter.metrics import phase
 
 def parse_cmd():
 
@@ -49,9 +58,114 @@ def parse_cmd():
                         action='store_true',
                         help='Reset the snapshotter files in the nodes'
     )
+    parser.add_argument('--stage',
+                        required=False,
+                        action='store_true',
+                        help='Copy snapshot files on the nodes before archiving ' +
+                             'instead of archiving them in place'
+    )
+    parser.add_argument('--format',
+                        required=False,
+                        choices=FORMATS,
+                        default='zip',
+                        help='Archive format of the node snapshots; tar formats ' +
+                             'are bundled into a .tar file'
+    )
+    parser.add_argument('--repository',
+                        required=False,
+                        nargs='?',
+                        const=True,
+                        help='Store in a deduplicated backup repository; in the ' +
+                             'S3 bucket by default, or in the given directory'
+    )
+    parser.add_argument('--direct',
+                        required=False,
+                        action='store_true',
+                        help='Nodes upload their snapshots straight to S3 in ' +
+                             'parallel instead of through this host (with --s3 ' +
+                             'or an S3 --repository)'
+    )
+    parser.add_argument('--executor',
+                        required=False,
+                        choices=EXECUTORS,
+                        default='ansible',
+                        help='Run the stages with ansible-playbook, or over ' +
+                             'persistent SSH connections (ssh), or on fake ' +
+                             'local hosts for testing (local)'
+    )
+    parser.add_argument('--fan-out',
+                        required=False,
+                        type=int,
+                        help='Nodes worked on at once by the ssh and local ' +
+                             'executors (default 20, or fan_out in config.ini)'
+    )
+    parser.add_argument('--read-limit',
+                        required=False,
+                        type=float,
+                        help='Disk read limit per node in MB/s (default none, ' +
+                             'or read_limit in config.ini)'
+    )
+    parser.add_argument('--upload-limit',
+                        required=False,
+                        type=float,
+                        help='Upload limit per node in MB/s with --direct ' +
+                             '(default none, or upload_limit in config.ini)'
+    )
+    parser.add_argument('--threads',
+                        required=False,
+                        type=int,
+                        help='Compression threads per node for tar.zst ' +
+                             '(default every core, or threads in config.ini)'
+    )
+    parser.add_argument('--low-priority',
+                        required=False,
+                        action='store_true',
+                        help='Run the snapshotter on the nodes with lower ' +
+                             'CPU and I/O priority (or low_priority in config.ini)'
+    )
+    parser.add_argument('--prometheus',
+                        required=False,
+                        help='Also write the run\'s phase metrics to this ' +
+                             'Prometheus textfile'
+    )
+    parser.add_argument('--profile',
+                        required=False,
+                        action='store_true',
+                        help='Profile the node scripts; profiles are saved ' +
+                             'in output_logs/profiles/<node>/'
+    )
     return parser.parse_args()
 
 
+def throttle_args(cmds):
+    # snapshotter.py arguments that limit the load on the nodes; options
+    # not given on the command line come from the optional [throttle]
+    # section of config.ini
+
+    config = ConfigParser()
+    config.read(sys.path[0] + '/config.ini')
+    def setting(option):
+        if config.has_option('throttle', option) and \
+           config.get('throttle', option):
+            return config.get('throttle', option)
+        return None
+
+    args = ''
+    read_limit = cmds.read_limit or setting('read_limit')
+    if read_limit:
+        args += ' --read-limit %s' % float(read_limit)
+    upload_limit = cmds.upload_limit or setting('upload_limit')
+    if upload_limit:
+        args += ' --upload-limit %s' % float(upload_limit)
+    threads = cmds.threads or setting('threads')
+    if threads:
+        args += ' --threads %i' % int(threads)
+    if cmds.low_priority or \
+       (setting('low_priority') or '').lower() in ('yes', 'true', 'on', '1'):
+        args += ' --low-priority'
+    return args
+
+
 def ansible_snapshot(cmds):
 
     # set title of snapshot file
@@ -71,8 +185,29 @@ def ansible_snapshot(cmds):
     else:
         nodes = cmds.nodes
 
+    if cmds.direct and not (cmds.s3 or cmds.repository == True):
+        raise Exception('ERROR: --direct uploads to S3, use it with --s3 or ' +
+                        'a --repository in S3')
+
     if cmds.s3:
         s3 = s3_bucket() # checks config.ini args
+        catalog = s3_catalog(s3)
+
+    repository = None
+    if cmds.repository == True: # not a string parameter
+        bucket = s3_bucket()
+        repository = Repository(S3Backend(bucket, s3_transfer(bucket)))
+    elif cmds.repository:
+        repository = Repository(LocalBackend(cmds.repository))
+
+    # nodes upload under this prefix with --direct
+    upload_prefix = None
+    if cmds.direct and repository:
+        upload_prefix = repository.backend.prefix
+    elif cmds.direct:
+        upload_prefix = 'cassandra-snapshot-%s/' % title
+        if catalog.exists(upload_prefix):
+            raise Exception('"%s" already exists in the S3 bucket' % upload_prefix)
 
     # path to save snapshot in
     if cmds.path:
@@ -81,14 +216,16 @@ def ansible_snapshot(cmds):
         save_path = sys.path[0] + '/snapshots'
         make_dir(save_path)
     
-    if os.path.isfile(save_path + '/' + title + '.zip'):
+    bundle_ext = '.zip' if cmds.format == 'zip' else '.tar'
+    if os.path.isfile(save_path + '/' + title + bundle_ext):
         raise Exception('%s has already been created' %
-                        save_path + '/' + title + '.zip')
+                        save_path + '/' + title + bundle_ext)
 
     # prepare working directories
     temp_path = sys.path[0] + '/.temp'
     prepare_dir(sys.path[0] + '/output_logs')
     prepare_dir(temp_path)
+    start_run_metrics('snapshot')
     os.makedirs(temp_path + '/' + title)
 
     # check keyspace and table args
@@ -108,42 +245,114 @@ def ansible_snapshot(cmds):
     elif cmds.table:
         raise Exception('ERROR: Keyspace must be specified with tables')
 
+    if cmds.stage:
+        snapshotter_command += ' --stage'
+    snapshotter_command += ' --format ' + cmds.format
+    snapshotter_command += throttle_args(cmds)
+    if cmds.profile:
+        snapshotter_command += ' --profile'
+        save_schema_command += ' --profile'
+
+    known_objects = ''
+    if repository:
+        # nodes only archive files that are not in the repository yet
+        known_objects = temp_path + '/known_objects.txt'
+        count = repository.write_known_objects(known_objects)
+        print('%i objects already in the repository' % count)
+        snapshotter_command += ' --known-objects known_objects.txt'
+
+    # file fetched from every node; nodes that upload a plain snapshot
+    # themselves leave nothing to fetch
+    node_file = cmds.format
+    upload_config = ''
+    if upload_prefix:
+        upload_config = temp_path + '/upload.ini'
+        write_upload_config(upload_config, upload_prefix)
+        snapshotter_command += ' --upload upload.ini'
+        node_file = OBJECT_MANIFEST if repository else ''
+
     playbook_args = {
         'nodes' : ' '.join(nodes),
         'snapshotter_command' : snapshotter_command,
         'save_schema_command' : save_schema_command,
         'path' : temp_path + '/' + title,
-        'reload' : cmds.reload
+        'reload' : cmds.reload,
+        'node_file' : node_file,
+        # the repository keeps its own manifest of every object
+        'node_manifest' : not repository,
+        'known_objects' : known_objects,
+        'upload_config' : upload_config,
+        'profile' : cmds.profile
     }
 
     # call playbook
-    return_code = run_playbook('snapshot.yml', playbook_args)
+    try:
+        with phase('playbook', executor=cmds.executor):
+            return_code = run_playbook('snapshot.yml', playbook_args,
+                                       cmds.executor, cmds.fan_out)
+    finally:
+        if upload_config:
+            os.remove(upload_config)
 
     if return_code != 0:
         shutil.rmtree(temp_path + '/' + title)
         print('Error running ansible script')
+    elif upload_prefix and not repository:
+        # the nodes uploaded their archives; the manifest is written last
+        # so only complete snapshots are listed
+        transfer = s3_transfer(s3)
+        with phase('upload') as counts:
+            for f in ('schemas.zip', 'ring_info.txt'):
+                transfer.upload_file(temp_path + '/' + title + '/' + f,
+                                     upload_prefix + f)
+            merge_node_manifests(temp_path + '/' + title, title, cmds.format)
+            transfer.upload_file(temp_path + '/' + title + '/' + MANIFEST_FILE,
+                                 upload_prefix + MANIFEST_FILE)
+            counts['bytes'] = transfer.bytes
+            counts['files'] = transfer.objects
+        catalog.add(upload_prefix)
+        print('Process complete.')
+        print('Output logs saved in %s' % (sys.path[0] + '/output_logs'))
+        print('Snapshot uploaded by the nodes under "%s"' % upload_prefix)
+    elif repository:
+        with phase('repository_store'):
+            repository.store(title, temp_path + '/' + title)
+        print('Process complete.')
+        print('Output logs saved in %s' % (sys.path[0] + '/output_logs'))
+        print('Snapshot "%s" stored in the repository' % title)
     else:
-        zip_dir(temp_path + '/' + title, save_path, title)
+        with phase('bundle', files=len(nodes)) as counts:
+            merge_node_manifests(temp_path + '/' + title, title, cmds.format)
+            bundle_path = bundle_dir(temp_path + '/' + title, save_path, title,
+                                     cmds.format)
+            counts['bytes'] = os.path.getsize(bundle_path)
 
         if cmds.s3:
         
-            file_size = os.path.getsize(save_path + '/' + title + '.zip')
+            file_size = os.path.getsize(bundle_path)
             if confirm('Snapshot size is %i bytes. Upload? [y/n] ' % file_size):
                 print('Uploading to s3 . . .')
                 key = 'cassandra-snapshot-' + title
                 upload = True
-                if key in [obj.key for obj in s3.objects.all()]:
+                if catalog.exists(key):
                     upload = confirm(('"%s" already exists in the S3 bucket.' % key) +
                                       'Overwrite? [y/n]')
                 if upload:
-                    s3.upload_file(save_path + '/' + title + '.zip', key)
+                    transfer = s3_transfer(s3)
+                    with phase('upload', file_size, 1):
+                        transfer.upload_file(bundle_path, key)
+                    catalog.add(key)
+                    print(transfer.report())
                     print('Uploaded with key "%s"' % key)
                 else:
                     print('Skipping upload to s3 . . .')
 
         print('Process complete.')
         print('Output logs saved in %s' % (sys.path[0] + '/output_logs'))
-        print('Snapshot zip saved in %s' % save_path)
+        print('Snapshot saved as %s' % bundle_path)
+
+    print('')
+    write_run_report('snapshot', cmds.prometheus)
 
 
 if __name__ == '__main__':
@@ -0,0 +1,744 @@
+import io
+import os
+import json
+import time
+import zlib
+import shutil
+import struct
+import tarfile
+import zipfile
+import subprocess
+
+try:
+    from shutil import which
+except ImportError:
+    from distutils.spawn import find_executable as which # python2
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+try:
+    import lz4.frame as lz4frame
+except ImportError:
+    lz4frame = None
+
+# archive formats, also used as the file extension
+FORMATS = ['zip', 'tar', 'tar.zst', 'tar.lz4']
+
+# every archive records its format in this member
+FORMAT_FILE = '.archive_format'
+_FORMAT_VERSION = 1
+# tar archives end with the crc32 of every member; zips keep their own
+CHECKSUM_FILE = '.archive_checksums'
+_INTERNAL_FILES = (FORMAT_FILE, CHECKSUM_FILE)
+_COPY_SIZE = 1024 * 1024
+
+# members with these extensions are already compressed
+_COMPRESSED_EXTENSIONS = ('.zip', '.zst', '.lz4', '.gz', '.bz2', '.xz',
+                          '.snappy')
+_SAMPLE_SIZE = 64 * 1024 # bytes read to test a member's compressibility
+_SMALL_FILE = 4096       # always compressed, not worth sampling
+_MIN_RATIO = 0.9         # stored when compressed/original is above this
+
+_MAGIC = [(b'PK\x03\x04', 'zip'),
+          (b'PK\x05\x06', 'zip'),         # empty zip
+          (b'\x28\xb5\x2f\xfd', 'tar.zst'),
+          (b'\x04\x22\x4d\x18', 'tar.lz4')]
+
+
+# Format Functions
+def head_format(head):
+    # Format of an archive from its first 512 bytes, or None
+
+    for magic, fmt in _MAGIC:
+        if head.startswith(magic):
+            return fmt
+    if head[257:262] == b'ustar':
+        return 'tar'
+    return None
+
+
+def detect_format(path):
+    # Finds the format of an archive from its first bytes
+
+    with open(path, 'rb') as f:
+        fmt = head_format(f.read(512))
+    if fmt is None:
+        raise Exception('Unrecognized archive format: %s' % path)
+    return fmt
+
+
+def is_archive(path):
+
+    try:
+        detect_format(path)
+        return True
+    except Exception:
+        return False
+
+
+def split_format(name):
+    # Splits 'name.tar.zst' into ('name', 'tar.zst'); the longest extension
+    # wins so that '.tar.zst' is not taken for '.zst'
+
+    for fmt in sorted(FORMATS, key=len, reverse=True):
+        if name.endswith('.' + fmt):
+            return name[:-len(fmt) - 1], fmt
+    return name, None
+
+
+def find_archive(base_path):
+    # Returns the archive saved as base_path.<format>, whatever the format
+
+    for fmt in FORMATS:
+        if os.path.isfile(base_path + '.' + fmt):
+            return base_path + '.' + fmt
+    raise Exception('No archive found for %s' % base_path)
+
+
+# Compression Detection
+class CompressionStats(object):
+    # Counts what was stored instead of compressed and estimates the deflate
+    # time saved from the measured cost of compressing the samples
+
+    def __init__(self):
+
+        self.stored_files = 0
+        self.stored_bytes = 0
+        self.compressed_files = 0
+        self.compressed_bytes = 0
+        self.sample_bytes = 0
+        self.sample_seconds = 0.0
+
+    def sample(self, data):
+        # Returns the deflate ratio (compressed/original) of a sample
+
+        start = time.time()
+        size = len(zlib.compress(data, zlib.Z_DEFAULT_COMPRESSION))
+        self.sample_seconds += time.time() - start
+        self.sample_bytes += len(data)
+        return float(size) / max(len(data), 1)
+
+    def add(self, size, stored):
+
+        if stored:
+            self.stored_files += 1
+            self.stored_bytes += size
+        else:
+            self.compressed_files += 1
+            self.compressed_bytes += size
+
+    def saved_seconds(self):
+        # deflate time of the stored bytes, less the time spent sampling
+
+        if not self.sample_bytes:
+            return 0.0
+        return max(self.stored_bytes * self.sample_seconds / self.sample_bytes -
+                   self.sample_seconds, 0.0)
+
+    def report(self):
+
+        return ('Stored %i already compressed file(s) (%i bytes) without ' +
+                'recompressing, compressed %i file(s) (%i bytes); ' +
+                'saved about %.2f seconds of CPU time') % (
+                    self.stored_files, self.stored_bytes,
+                    self.compressed_files, self.compressed_bytes,
+                    self.saved_seconds())
+
+
+def is_compressed(path, stats=None):
+    # Decides whether a file is already compressed: nested archives and the
+    # Data.db of tables with compression (a CompressionInfo.db next to it) by
+    # name, anything else by deflating a sample of it
+
+    if path.endswith(_COMPRESSED_EXTENSIONS) or (
+            path.endswith('-Data.db') and
+            os.path.exists(path[:-len('Data.db')] + 'CompressionInfo.db')):
+        return True
+    if os.path.getsize(path) < _SMALL_FILE:
+        return False
+
+    stats = stats or CompressionStats()
+    with open(path, 'rb') as f:
+        ratio = stats.sample(f.read(_SAMPLE_SIZE))
+    return ratio >= _MIN_RATIO
+
+
+# Compression Streams
+class _CommandWriter(object):
+    # Pipes everything written through an external compressor into fileobj
+
+    def __init__(self, cmd, fileobj):
+        self._process = subprocess.Popen(cmd, stdin=subprocess.PIPE,
+                                         stdout=fileobj)
+
+    def write(self, data):
+        self._process.stdin.write(data)
+
+    def close(self):
+        self._process.stdin.close()
+        if self._process.wait() != 0:
+            raise Exception('Compressor exited with code %i'
+                            % self._process.returncode)
+
+
+class _ZstdWriter(object):
+
+    def __init__(self, fileobj, threads, level):
+        compressor = zstandard.ZstdCompressor(level=level or 3,
+                                              threads=threads or -1)
+        self._writer = compressor.stream_writer(fileobj)
+
+    def write(self, data):
+        self._writer.write(data)
+
+    def close(self):
+        self._writer.flush(zstandard.FLUSH_FRAME)
+
+
+class _PlainWriter(object):
+
+    def __init__(self, fileobj):
+        self._fileobj = fileobj
+
+    def write(self, data):
+        self._fileobj.write(data)
+
+    def close(self):
+        pass
+
+
+def _compressor(fmt, fileobj, threads=0, level=None):
+    # Returns a writer that compresses into fileobj; threads=0 uses every core
+
+    if fmt == 'tar':
+        return _PlainWriter(fileobj)
+    elif fmt == 'tar.zst':
+        if zstandard is not None:
+            return _ZstdWriter(fileobj, threads, level)
+        if which('zstd'):
+            return _CommandWriter(['zstd', '-q', '-c', '-T%i' % threads,
+                                   '-%i' % (level or 3)], fileobj)
+        raise Exception('tar.zst needs the zstandard module or the zstd command')
+    elif fmt == 'tar.lz4':
+        if lz4frame is not None:
+            return lz4frame.open(fileobj, 'wb',
+                                 compression_level=level or 0)
+        if which('lz4'):
+            return _CommandWriter(['lz4', '-q', '-c', '-%i' % (level or 1)],
+                                  fileobj)
+        raise Exception('tar.lz4 needs the lz4 module or the lz4 command')
+    raise Exception('Unknown archive format: %s' % fmt)
+
+
+def _decompressor(fmt, path):
+    # Returns (readable stream, cleanup function) for a tar archive
+
+    if fmt == 'tar':
+        f = open(path, 'rb')
+        return f, f.close
+    elif fmt == 'tar.zst':
+        if zstandard is not None:
+            f = open(path, 'rb')
+            return zstandard.ZstdDecompressor().stream_reader(f), f.close
+        cmd = ['zstd', '-d', '-q', '-c', path]
+    elif fmt == 'tar.lz4':
+        if lz4frame is not None:
+            f = lz4frame.open(path, 'rb')
+            return f, f.close
+        cmd = ['lz4', '-d', '-q', '-c', path]
+    else:
+        raise Exception('Unknown archive format: %s' % fmt)
+
+    process = subprocess.Popen(cmd, stdout=subprocess.PIPE)
+    def cleanup():
+        process.stdout.close()
+        process.wait()
+    return process.stdout, cleanup
+
+
+class _CrcReader(object):
+    # File wrapper that computes the crc32 of everything read through it
+
+    def __init__(self, fileobj):
+        self._file = fileobj
+        self.crc = 0
+
+    def read(self, size=-1):
+
+        data = self._file.read(size)
+        self.crc = zlib.crc32(data, self.crc)
+        return data
+
+
+def _extract_file(tar, member, dest):
+    # Writes a regular tar member under dest and returns its crc32, computed
+    # in the same pass
+
+    path = os.path.join(dest, member.name)
+    if not os.path.realpath(path).startswith(os.path.realpath(dest) + os.sep):
+        raise Exception('Archive member outside of %s: %s' % (dest, member.name))
+    if not os.path.isdir(os.path.dirname(path)):
+        os.makedirs(os.path.dirname(path))
+    source = tar.extractfile(member)
+    crc = 0
+    with open(path, 'wb') as f:
+        for block in iter(lambda: source.read(_COPY_SIZE), b''):
+            crc = zlib.crc32(block, crc)
+            f.write(block)
+    os.utime(path, (member.mtime, member.mtime))
+    return 'crc32:%08x' % (crc & 0xffffffff)
+
+
+class _LimitedReader(object):
+    # File wrapper whose reads are paced by a throttle.RateLimiter
+
+    def __init__(self, fileobj, limiter):
+        self._file = fileobj
+        self._limiter = limiter
+
+    def read(self, size=-1):
+
+        data = self._file.read(size)
+        self._limiter.consume(len(data))
+        return data
+
+
+# Archive Classes
+class ArchiveWriter(object):
+    # Writes zip or streaming tar archives one member at a time. Zip members
+    # that are already compressed are stored as they are; zstd and lz4 pass
+    # incompressible blocks through cheaply on their own.
+    #
+    # index lists every member with its size, crc32 and offset: the local
+    # header offset in a zip, the header offset in the uncompressed tar
+    # stream otherwise.
+
+    def __init__(self, path, fmt='zip', threads=0, level=None, stats=None,
+                 limiter=None):
+
+        if fmt not in FORMATS:
+            raise Exception('Unknown archive format: %s' % fmt)
+        self.path = path
+        self.format = fmt
+        self.stats = stats or CompressionStats()
+        self.limiter = limiter # paces the reads of added files
+        self.index = []
+        if fmt == 'zip':
+            self._zip = zipfile.ZipFile(path, 'w', zipfile.ZIP_DEFLATED,
+                                        allowZip64=True)
+        else:
+            self._file = open(path, 'wb')
+            self._stream = _compressor(fmt, self._file, threads, level)
+            self._tar = tarfile.open(fileobj=self._stream, mode='w|',
+                                     format=tarfile.PAX_FORMAT)
+        info = {'format': fmt, 'version': _FORMAT_VERSION}
+        self.add_bytes(FORMAT_FILE, json.dumps(info).encode('utf-8'))
+
+    def _record(self, arcname, size, offset, crc):
+
+        if arcname not in _INTERNAL_FILES:
+            self.index.append({
+                'name': arcname,
+                'size': size,
+                'offset': offset,
+                'checksum': 'crc32:%08x' % (crc & 0xffffffff)
+            })
+
+    def add(self, path, arcname):
+
+        if self.format == 'zip':
+            stored = is_compressed(path, self.stats)
+            self.stats.add(os.path.getsize(path), stored)
+            compress_type = zipfile.ZIP_STORED if stored else zipfile.ZIP_DEFLATED
+            if self.limiter is None:
+                self._zip.write(path, arcname, compress_type)
+            elif hasattr(zipfile.ZipInfo, 'from_file'): # python 3.6+
+                info = zipfile.ZipInfo.from_file(path, arcname)
+                info.compress_type = compress_type
+                with open(path, 'rb') as f:
+                    with self._zip.open(info, 'w') as member:
+                        for block in iter(lambda: f.read(_COPY_SIZE), b''):
+                            self.limiter.consume(len(block))
+                            member.write(block)
+            else: # paced a whole file at a time
+                self._zip.write(path, arcname, compress_type)
+                self.limiter.consume(os.path.getsize(path))
+            info = self._zip.getinfo(arcname)
+            self._record(arcname, info.file_size, info.header_offset, info.CRC)
+        else:
+            info = self._tar.gettarinfo(path, arcname)
+            offset = self._tar.offset
+            with open(path, 'rb') as f:
+                if self.limiter is not None:
+                    f = _LimitedReader(f, self.limiter)
+                reader = _CrcReader(f)
+                self._tar.addfile(info, reader)
+            self._record(arcname, info.size, offset, reader.crc)
+
+    def add_bytes(self, arcname, data):
+
+        if self.format == 'zip':
+            self._zip.writestr(arcname, data)
+            info = self._zip.getinfo(arcname)
+            self._record(arcname, info.file_size, info.header_offset, info.CRC)
+        else:
+            info = tarfile.TarInfo(arcname)
+            info.size = len(data)
+            info.mtime = time.time()
+            offset = self._tar.offset
+            self._tar.addfile(info, io.BytesIO(data))
+            self._record(arcname, info.size, offset, zlib.crc32(data))
+
+    def close(self):
+
+        if self.format == 'zip':
+            self._zip.close()
+        else:
+            # checked against the crc32 computed while extracting
+            checksums = dict((entry['name'], entry['checksum'])
+                             for entry in self.index)
+            self.add_bytes(CHECKSUM_FILE, json.dumps(checksums).encode('utf-8'))
+            self._tar.close()
+            self._stream.close()
+            self._file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+class ArchiveReader(object):
+    # Reads any archive written by ArchiveWriter (and plain zips), detecting
+    # its format from the file itself
+
+    def __init__(self, path):
+
+        self.path = path
+        self.format = detect_format(path)
+        self.checksums = {}
+
+    def _tar_members(self):
+        # Yields (tarfile, member) in archive order from a single stream
+        # pass; plain tars are opened for random access so that the data of
+        # members that are not read is skipped over
+
+        if self.format == 'tar':
+            tar = tarfile.open(self.path, 'r:')
+            try:
+                for member in tar:
+                    yield tar, member
+            finally:
+                tar.close()
+            return
+
+        stream, cleanup = _decompressor(self.format, self.path)
+        try:
+            tar = tarfile.open(fileobj=stream, mode='r|')
+            for member in tar:
+                yield tar, member
+            tar.close()
+        finally:
+            cleanup()
+
+    def read_format(self):
+        # Returns the recorded format info; plain zips have none
+
+        try:
+            return json.loads(self.read(FORMAT_FILE).decode('utf-8'))
+        except KeyError:
+            return {'format': self.format, 'version': 0}
+
+    def names(self):
+
+        if self.format == 'zip':
+            with zipfile.ZipFile(self.path, 'r') as z:
+                names = z.namelist()
+        else:
+            names = [m.name for tar, m in self._tar_members()]
+        return [n for n in names if n not in _INTERNAL_FILES and not n.endswith('/')]
+
+    def read(self, name):
+
+        if self.format == 'zip':
+            with zipfile.ZipFile(self.path, 'r') as z:
+                return z.read(name)
+        for tar, member in self._tar_members():
+            if member.name == name:
+                return tar.extractfile(member).read()
+        raise KeyError(name)
+
+    def extract(self, dest, select=None):
+        # Extracts the members whose names pass select (all when None) and
+        # returns their names. The crc32 of every extracted file is computed
+        # as it is written and kept in self.checksums; zipfile checks its
+        # own, and tar members are checked against the archive's
+        # CHECKSUM_FILE when it reaches the end of the archive.
+
+        extracted = []
+        self.checksums = {}
+        if self.format == 'zip':
+            with zipfile.ZipFile(self.path, 'r') as z:
+                for info in z.infolist():
+                    name = info.filename
+                    if name in _INTERNAL_FILES or name.endswith('/'):
+                        continue
+                    if select is None or select(name):
+                        z.extract(info, dest) # raises on a bad crc
+                        self.checksums[name] = 'crc32:%08x' % info.CRC
+                        extracted.append(name)
+            return extracted
+
+        recorded = None
+        for tar, member in self._tar_members():
+            if member.name == CHECKSUM_FILE:
+                recorded = json.loads(tar.extractfile(member).read().decode('utf-8'))
+                continue
+            if member.name == FORMAT_FILE or member.isdir():
+                continue
+            if select is None or select(member.name):
+                if member.isfile():
+                    self.checksums[member.name] = _extract_file(tar, member, dest)
+                elif hasattr(tarfile, 'data_filter'):
+                    tar.extract(member, dest, filter='data')
+                else:
+                    tar.extract(member, dest)
+                extracted.append(member.name)
+
+        if recorded is not None: # archives written before checksums were
+            mismatched = [name for name, checksum in self.checksums.items()
+                          if recorded.get(name, checksum) != checksum]
+            if mismatched:
+                raise Exception('Checksum mismatch in %s: %s'
+                                % (self.path, ', '.join(sorted(mismatched))))
+        return extracted
+
+    def extractall(self, dest):
+        return self.extract(dest)
+
+
+# Member Functions
+def dir_members(root_path):
+    # Lists (source path, archive name) pairs for every file under root_path
+
+    members = []
+    for root, dirs, files in os.walk(root_path):
+        for f in sorted(files):
+            path = os.path.join(root, f)
+            members.append((path, os.path.relpath(path, root_path)))
+    return members
+
+
+def member_filter(keyspaces=None, tables=None):
+    # select function for ArchiveReader.extract that keeps the
+    # <keyspace>/<table>/ members of the given keyspaces (and tables);
+    # None when everything is kept
+
+    if not keyspaces:
+        return None
+
+    def select(name):
+        parts = name.split('/')
+        return len(parts) > 2 and parts[0] in keyspaces and \
+               (not tables or parts[1] in tables)
+    return select
+
+
+def snapshot_members(snapshot_dirs):
+    # Lists (source path, archive name) pairs straight from Cassandra's
+    # snapshot directories, given (snapshot dir, archive dir) pairs. Files
+    # that appear on several disks (manifest.json, schema.cql) are kept once,
+    # and secondary indexes (.<index> subdirectories) are kept like --stage
+    # copies them.
+
+    members = []
+    seen = set()
+    snapshot_dirs = list(snapshot_dirs)
+    while snapshot_dirs:
+        load_dir, arc_dir = snapshot_dirs.pop(0)
+        for f in sorted(os.listdir(load_dir)):
+            arcname = arc_dir + '/' + f
+            if os.path.isdir(load_dir + '/' + f):
+                snapshot_dirs.append((load_dir + '/' + f, arcname))
+            elif arcname not in seen:
+                seen.add(arcname)
+                members.append((load_dir + '/' + f, arcname))
+    return members
+
+
+def write_archive(archive_path, members, fmt='zip', threads=0, stats=None,
+                  extra=None, index=None, limiter=None):
+    # Writes the members into an archive one file at a time; nothing is
+    # staged on disk besides the archive itself. extra holds (archive name,
+    # bytes) pairs generated by the caller. The archive's member index is
+    # appended to index when it is given, and limiter (a
+    # throttle.RateLimiter) paces the reads of the members.
+
+    with ArchiveWriter(archive_path, fmt, threads, stats=stats,
+                       limiter=limiter) as archive:
+        for path, arcname in members:
+            archive.add(path, arcname)
+        for arcname, data in extra or []:
+            archive.add_bytes(arcname, data)
+    if index is not None:
+        index.extend(archive.index)
+    return archive_path
+
+
+def member_ranges(fileobj, select=None, offsets=None):
+    # (name, data offset, stored size, compression) of the file members of a
+    # zip or plain tar, read through a seekable file object without reading
+    # their data, so the data can be fetched by byte range. compression is
+    # 'deflate' for deflated zip members and None for stored ones. With
+    # offsets, only the tar headers at those offsets are read (the manifest
+    # records them), not every header in the archive.
+
+    fileobj.seek(0)
+    fmt = head_format(fileobj.read(512))
+    ranges = []
+    if fmt == 'zip':
+        z = zipfile.ZipFile(fileobj, 'r')
+        for info in z.infolist():
+            if info.filename.endswith('/') or info.filename in _INTERNAL_FILES:
+                continue
+            if select is not None and not select(info.filename):
+                continue
+            if info.compress_type == zipfile.ZIP_STORED:
+                compression = None
+            elif info.compress_type == zipfile.ZIP_DEFLATED:
+                compression = 'deflate'
+            else:
+                raise Exception('Cannot read %s by range' % info.filename)
+            # the data follows the local header, whose extra field can
+            # differ from the central directory's
+            fileobj.seek(info.header_offset)
+            header = fileobj.read(30)
+            name_length, extra_length = struct.unpack('<HH', header[26:30])
+            ranges.append((info.filename,
+                           info.header_offset + 30 + name_length + extra_length,
+                           info.compress_size, compression))
+        return ranges
+
+    if fmt != 'tar':
+        raise Exception('Only zip and plain tar archives can be read by range')
+    fileobj.seek(0)
+    tar = tarfile.TarFile(fileobj=fileobj)
+    if offsets is None:
+        members = tar.getmembers()
+    else:
+        members = []
+        for offset in sorted(offsets):
+            fileobj.seek(offset)
+            members.append(tarfile.TarInfo.fromtarfile(tar))
+    for member in members:
+        if not member.isfile() or member.name in _INTERNAL_FILES:
+            continue
+        if select is None or select(member.name):
+            ranges.append((member.name, member.offset_data, member.size, None))
+    return ranges
+
+
+def inflate_file(src, dest):
+    # Decompresses the raw deflate data of a zip member
+
+    decompressor = zlib.decompressobj(-zlib.MAX_WBITS)
+    with open(src, 'rb') as fin:
+        with open(dest, 'wb') as fout:
+            for block in iter(lambda: fin.read(1024 * 1024), b''):
+                fout.write(decompressor.decompress(block))
+            fout.write(decompressor.flush())
+
+
+def copy_range(fileobj, start, length, path, compression=None):
+    # Copies length bytes of fileobj from start into path, inflating them
+    # when they are a deflated zip member
+
+    if not os.path.isdir(os.path.dirname(path)):
+        os.makedirs(os.path.dirname(path))
+    decompressor = zlib.decompressobj(-zlib.MAX_WBITS) if compression else None
+    fileobj.seek(start)
+    with open(path, 'wb') as fout:
+        while length > 0:
+            block = fileobj.read(min(length, _COPY_SIZE))
+            if not block:
+                raise Exception('Unexpected end of archive in %s' % path)
+            length -= len(block)
+            fout.write(decompressor.decompress(block) if decompressor else block)
+        if decompressor:
+            fout.write(decompressor.flush())
+
+
+class FileRange(object):
+    # Read-only, seekable view of length bytes of a file from start, so that
+    # member_ranges can read an archive nested in a bundle where it lies
+
+    def __init__(self, fileobj, start, length):
+
+        self.fileobj = fileobj
+        self.start = start
+        self.length = length
+        self.position = 0
+
+    def seekable(self):
+        return True
+
+    def readable(self):
+        return True
+
+    def tell(self):
+        return self.position
+
+    def seek(self, offset, whence=0):
+
+        if whence == 1:
+            offset += self.position
+        elif whence == 2:
+            offset += self.length
+        self.position = max(offset, 0)
+        return self.position
+
+    def read(self, size=-1):
+
+        if size is None or size < 0:
+            size = self.length - self.position
+        size = max(min(size, self.length - self.position), 0)
+        self.fileobj.seek(self.start + self.position)
+        data = self.fileobj.read(size)
+        self.position += len(data)
+        return data
+
+
+def checksum_mismatches(checksums, entries):
+    # Names of the entries (dicts with a name and checksum, as in index
+    # lists and manifests) whose checksum differs from the one computed for
+    # them; checksums maps names to checksums, entries not in it are skipped
+
+    return sorted(entry['name'] for entry in entries
+                  if checksums.get(entry['name'], entry['checksum']) !=
+                     entry['checksum'])
+
+
+def index_checksums(index):
+    return dict((entry['name'], entry['checksum']) for entry in index)
+
+
+def filter_archive(path, select):
+    # Rewrites an archive in place, in the same format, with only the
+    # members select keeps; only those are ever extracted. Returns their
+    # names.
+
+    reader = ArchiveReader(path)
+    work_path = path + '.select'
+    if os.path.isdir(work_path):
+        shutil.rmtree(work_path)
+    try:
+        kept = reader.extract(work_path, select)
+        write_archive(path + '.tmp', dir_members(work_path), reader.format)
+    finally:
+        shutil.rmtree(work_path, True)
+    os.rename(path + '.tmp', path)
+    return kept
@@ -2,6 +2,21 @@ import yaml
 import os
 import subprocess
 import re
+import atexit
+import socket
+import json
+
+try:
+    # DataStax python driver; optional, cqlsh is used when it is missing
+    from cassandra.cluster import Cluster
+    from cassandra.query import dict_factory
+except ImportError:
+    Cluster = None
+
+try:
+    from yaml import CSafeLoader as YamlLoader # libyaml bindings
+except ImportError:
+    from yaml import SafeLoader as YamlLoader
 
 _SYSTEM_KEYSPACES = set(['system_schema',
                          'system_auth',
@@ -14,95 +29,393 @@ _YAML_LOCATIONS = ['/etc/cassandra/conf/', # package install on centos
                    '/etc/dse/cassandra/'   # datastax enterprise package
                   ] #TODO user input yaml locations, other locations
 
-    
+_NATIVE_PORT = 9042
+
+# keyspace -> table -> directory map, reused until the schema version changes
+_STRUCTURE_CACHE = (os.path.dirname(os.path.abspath(__file__)) +
+                    '/.cache/structure.json')
+
+
 # Cassandra YAML related functions
+def find_yaml():
+    # An explicit CASSANDRA_YAML or CASSANDRA_CONF (tarball installs) wins
+    # over the package install locations
+
+    if os.environ.get('CASSANDRA_YAML'):
+        return os.environ['CASSANDRA_YAML']
+    locations = list(_YAML_LOCATIONS)
+    if os.environ.get('CASSANDRA_CONF'):
+        locations.insert(0, os.environ['CASSANDRA_CONF'].rstrip('/') + '/')
+
+    for loc in locations:
+        if os.path.exists(loc + 'cassandra.yaml'):
+            return loc + 'cassandra.yaml'
+    raise Exception('Could not find cassandra YAML file. ' +
+                    'Set CASSANDRA_YAML to its location.')
+
+
+def cassandra_tool(name):
+    # Path of a Cassandra command line tool such as cqlsh; tarball installs
+    # (and the benchmark's stand-ins) keep them in $CASSANDRA_HOME/bin
+
+    if os.environ.get('CASSANDRA_HOME'):
+        return os.environ['CASSANDRA_HOME'].rstrip('/') + '/bin/' + name
+    return '/bin/' + name
+
+
+class CassandraConfig(object):
+    # cassandra.yaml parsed once per process; the file is only parsed again
+    # if its mtime changes
+
+    def __init__(self, path=None):
+
+        self._path = path
+        self._mtime = None
+        self._values = {}
+
+    @property
+    def path(self):
+        if self._path is None:
+            self._path = find_yaml()
+        return self._path
+
+    def values(self):
+
+        mtime = os.path.getmtime(self.path)
+        if mtime != self._mtime:
+            with open(self.path, 'r') as f:
+                self._values = yaml.load(f, Loader=YamlLoader) or {}
+            self._mtime = mtime
+        return self._values
+
+    def get(self, var, default=None):
+        return self.values().get(var, default)
+
+    def __getitem__(self, var):
+        return self.values()[var]
+
+
+_CONFIG = CassandraConfig()
+
+
+def set_yaml_path(path):
+    # Points every later get_yaml_var call at an explicit cassandra.yaml
+
+    global _CONFIG
+    _CONFIG = CassandraConfig(path)
+
+
 def get_yaml_var(var):
     # This function uses cassandra.yaml to find a specific variable in it
+    return _CONFIG[var]
 
-    for loc in _YAML_LOCATIONS:
-        if os.path.exists(loc + 'cassandra.yaml'):
-            yaml_dir = loc + 'cassandra.yaml'
-            break
-    else:
-        # TODO user inputs yaml location (too many args to pass on call?)
-        raise Exception('Could not find cassandra YAML file.')
 
-    with open(yaml_dir, 'r') as f:
-        cass_yaml = yaml.load(f)
-    return cass_yaml[var]
-    
+def get_data_dirs():
+    return get_yaml_var('data_file_directories')
+
 
 def get_data_dir():
-    return get_yaml_var('data_file_directories')[0]
+    return get_data_dirs()[0]
+
+
+def group_by_disk(paths):
+    # Groups directories by the device they live on so each physical disk
+    # can be given its own worker
+
+    disks = {}
+    order = []
+    for path in paths:
+        try:
+            device = os.stat(path).st_dev
+        except OSError:
+            device = path
+        if device not in disks:
+            disks[device] = []
+            order.append(device)
+        disks[device].append(path)
+    return [disks[device] for device in order]
 
 
 def get_rpc_address():
     return get_yaml_var('rpc_address')
 
 
+def get_native_port():
+    return int(_CONFIG.get('native_transport_port') or _NATIVE_PORT)
+
+
+# Cassandra Session
+class CassandraSession(object):
+    # One long-lived connection to a node, shared by every query in a run.
+    # Queries go through the native driver when it is installed, otherwise
+    # each statement (or batch of statements) is fed to a cqlsh process.
+
+    def __init__(self, host, port=_NATIVE_PORT, native=True):
+
+        self.host = host
+        self.port = port
+        self.use_native = native and Cluster is not None
+        self._cluster = None
+        self._session = None
+        self.connect()
+
+    @property
+    def native(self):
+        return self._session is not None
+
+    def connect(self):
+
+        if not self.use_native or self.native:
+            return self.native
+        try:
+            self._cluster = Cluster([self.host], port=self.port)
+            self._session = self._cluster.connect()
+            self._session.row_factory = dict_factory
+        except Exception as e:
+            print('Native connection to %s failed, using cqlsh: %s'
+                  % (self.host, e))
+            self.close()
+        return self.native
+
+    def close(self):
+
+        if self._cluster is not None:
+            try:
+                self._cluster.shutdown()
+            except Exception:
+                pass
+        self._cluster = None
+        self._session = None
+
+    def cqlsh(self, script):
+        # Runs one or more statements in a single cqlsh process and returns
+        # (returncode, output)
+
+        cqlsh = subprocess.Popen((cassandra_tool('cqlsh'), self.host),
+                                 stdin=subprocess.PIPE,
+                                 stdout=subprocess.PIPE,
+                                 universal_newlines=True)
+        output = cqlsh.communicate(script)[0]
+        return cqlsh.returncode, output
+
+    def execute(self, query):
+        # Returns the result rows as a list of dicts keyed by column name
+
+        if self.native:
+            return list(self._session.execute(query))
+        returncode, output = self.cqlsh(query)
+        if returncode != 0:
+            raise Exception('cqlsh query failed: %s' % query)
+        return parse_cqlsh_rows(output)
+
+    def execute_many(self, statements):
+        # Runs statements that do not return rows; without the native driver
+        # they all share one cqlsh process
+
+        if self.native:
+            for statement in statements:
+                self._session.execute(statement)
+            return 0
+        return self.cqlsh('\n'.join(statements))[0]
+
+    def run_script(self, script):
+        # Runs a .cql script such as a saved schema; cqlsh handles comments
+        # and shell commands that the driver does not understand
+        return self.cqlsh(script)
+
+    def ping(self):
+        # Returns 0 if the node answers queries, like cqlsh's return code
+
+        if self.connect():
+            try:
+                self._session.execute('SELECT release_version FROM system.local')
+                return 0
+            except Exception:
+                self.close()
+                return 1
+        return self.cqlsh('exit')[0]
+
+
+_SESSIONS = {}
+
+
+def get_session(host):
+    # Every caller in a process shares the same session per host
+
+    if host not in _SESSIONS:
+        _SESSIONS[host] = CassandraSession(host, port=get_native_port())
+    return _SESSIONS[host]
+
+
+def close_sessions():
+
+    for session in _SESSIONS.values():
+        session.close()
+    _SESSIONS.clear()
+
+
+atexit.register(close_sessions)
+
+
+def parse_cqlsh_rows(output):
+    # Turns cqlsh's tabular output into a list of dicts
+
+    '''
+
+     table_name  | id
+    -------------+---------------------------
+     first_table | first_uuid
+     . . .       | . . .
+
+    (num rows)
+    '''
+
+    lines = output.split('\n')
+    for idx, line in enumerate(lines):
+        if idx > 0 and re.match(r'^-+(\+-+)*$', line.strip()):
+            break
+    else:
+        return []
+
+    columns = [c.strip() for c in lines[idx - 1].split('|')]
+    rows = []
+    for line in lines[idx + 1:]:
+        if not line.strip():
+            break
+        values = [v.strip() for v in line.split('|')]
+        rows.append(dict(zip(columns, values)))
+    return rows
+
+
 # Cassandra Query Related Function
 def cassandra_query(host, query, test=False):
     # This function takes in a cassandra query and returns the output
 
-    if type(query) is str:
-        query = ['echo', query]
-    elif type(query) is not list:
+    if type(query) is list: # command whose output is the query
+        query = subprocess.check_output(query, universal_newlines=True)
+    elif type(query) is not str:
         raise Exception('Query not recognized')
 
-    query_process = subprocess.Popen(query, stdout=subprocess.PIPE)
-    cqlsh = subprocess.Popen(('/bin/cqlsh', host),
-                             stdin=query_process.stdout,
-                             stdout=subprocess.PIPE)
-    query_process.stdout.close()
-    output = cqlsh.communicate()[0]
-    query_process.wait()
+    returncode, output = get_session(host).cqlsh(query)
     if test:
-        output = cqlsh.returncode
+        output = returncode
     return output
 
 
 def check_host(host):
-    return cassandra_query(host, 'exit', test=True)
+    return get_session(host).ping()
+
+
+def port_open(host, port, timeout=1.0):
+    # True if the port accepts TCP connections; much cheaper than a query
+    # while a node is still starting
+
+    try:
+        sock = socket.create_connection((host, port), timeout)
+    except (socket.error, socket.timeout):
+        return False
+    sock.close()
+    return True
 
 
 def get_keyspaces(host, system=False):
     # This function calls Cassandra to find the keyspaces in the database
 
-    keyspaces_string = cassandra_query(host, 'DESCRIBE keyspaces;')
-    keyspaces = set(keyspaces_string.strip().split())
+    keyspaces = set(get_schema_structure(host).keys())
     if not system:
         keyspaces = keyspaces - _SYSTEM_KEYSPACES
     return keyspaces
 
 
+def table_directory(table, uuid):
+    # Data directories are named <table>-<uuid without dashes>
+    return table + '-' + str(uuid).replace('-', '')
+
+
 def get_table_directories(host, keyspace):
     # This function calls Cassandra to retrieve the tables and their
     # corresponding uuid
 
-    cmd = ("SELECT table_name, id FROM system_schema.tables \
-            WHERE keyspace_name='%s';" % keyspace)
-    query = cassandra_query(host, cmd)
+    return dict(get_schema_structure(host).get(keyspace, {}))
 
-    # format of query is as follows, may need to be updated
-    '''
 
-    table_name  | id
-    ------------+---------------------------
-    first_table | first_uuid
-    . . .       | . . .
-    last_table  | last_uuid
+def get_replication(host, keyspace):
+    # Replication settings of a keyspace, such as
+    # {'class': 'org.apache.cassandra.locator.SimpleStrategy', 'replication_factor': '3'}
+
+    rows = get_session(host).execute('SELECT replication FROM system_schema.keyspaces ' +
+                                     "WHERE keyspace_name = '%s';" % keyspace)
+    if not rows:
+        raise Exception('Keyspace not found: %s' % keyspace)
+    replication = rows[0]['replication']
+    if not isinstance(replication, dict): # cqlsh prints the map
+        replication = dict(re.findall("'([^']*)': '([^']*)'", replication))
+    return replication
+
+
+def schema_replication(schema_cql):
+    # Replication settings of every keyspace in a DESCRIBE SCHEMA output,
+    # such as the schema.cql saved with a snapshot
+
+    replication = {}
+    for keyspace, settings in re.findall(
+            r'CREATE KEYSPACE (?:IF NOT EXISTS )?"?(\w+)"? WITH replication = (\{[^}]*\})',
+            schema_cql):
+        replication[keyspace] = dict(re.findall("'([^']*)': '([^']*)'", settings))
+    return replication
 
-    (num rows)
-    '''
 
-    # finds table and uuid; could be more efficient?
-    matcher = '(\w{1,})\ \|\ ([0-9a-f]{8}-[0-9a-f]{4}-[0-9a-f]{4}-[0-9a-f]{4}-[0-9a-f]{12})'
-    r = re.compile(matcher)
-    table_directory = dict(re.findall(r, query))
-    for table, uuid in table_directory.iteritems(): # strip '-' from uuid
-        table_directory[table] = table + '-' + uuid.replace('-', '')
+def get_release_version(host):
+    # Cassandra version as a tuple of ints, such as (3, 11, 4)
 
-    return table_directory
+    rows = get_session(host).execute('SELECT release_version FROM system.local;')
+    return tuple(int(n) for n in re.findall(r'\d+', str(rows[0]['release_version']))[:3])
+
+
+def get_schema_version(host):
+    rows = get_session(host).execute('SELECT schema_version FROM system.local;')
+    return str(rows[0]['schema_version'])
+
+
+def scan_schema(host):
+    # Builds the directory structure of every keyspace from one scan of
+    # system_schema.keyspaces and one of system_schema.tables
+
+    session = get_session(host)
+    structure = {}
+    for row in session.execute('SELECT keyspace_name FROM system_schema.keyspaces;'):
+        structure[row['keyspace_name']] = {}
+    for row in session.execute('SELECT keyspace_name, table_name, id ' +
+                               'FROM system_schema.tables;'):
+        tables = structure.setdefault(row['keyspace_name'], {})
+        tables[row['table_name']] = table_directory(row['table_name'], row['id'])
+    return structure
+
+
+def get_schema_structure(host, cache_path=_STRUCTURE_CACHE):
+    # Returns the structure of every keyspace, read from the on-node cache
+    # when it was saved under the current schema version
+
+    version = get_schema_version(host)
+    try:
+        with open(cache_path, 'r') as f:
+            cached = json.load(f)
+        if cached['schema_version'] == version:
+            return cached['structure']
+    except (IOError, OSError, ValueError, KeyError):
+        pass
+
+    structure = scan_schema(host)
+    try:
+        cache_dir = os.path.dirname(cache_path)
+        if not os.path.isdir(cache_dir):
+            os.makedirs(cache_dir)
+        with open(cache_path + '.tmp', 'w') as f:
+            json.dump({'schema_version': version, 'structure': structure}, f)
+        os.rename(cache_path + '.tmp', cache_path)
+    except (IOError, OSError) as e:
+        print('WARNING: Could not cache schema structure: %s' % e)
+    return structure
 
 
 def get_dir_structure(host, keyspaces):
@@ -123,8 +436,9 @@ def get_dir_structure(host, keyspaces):
     }
     '''
 
+    schema = get_schema_structure(host)
     structure = {}
     for keyspace in keyspaces:
-        structure[keyspace] = get_table_directories(host, keyspace)
+        structure[keyspace] = dict(schema.get(keyspace, {}))
 
     return structure
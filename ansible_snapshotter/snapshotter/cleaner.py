@@ -1,63 +1,140 @@
 import os
+import sys
+import argparse
 import shutil
 import subprocess
+from multiprocessing.pool import ThreadPool
 
-from cass_functions import (get_data_dir, get_keyspaces, get_rpc_address,
-                            get_dir_structure, check_host, _SYSTEM_KEYSPACES)
+from cass_functions import (get_data_dirs, get_rpc_address,
+                            get_schema_structure, group_by_disk,
+                            _SYSTEM_KEYSPACES)
+from profiling import profile
 
-def data_cleaner(host, backups=False):
+def parse_cmd():
+
+    parser = argparse.ArgumentParser(description='Cassandra Data Cleaner')
+    parser.add_argument('--dry-run',
+                        required=False,
+                        action='store_true',
+                        help='Print what would be deleted without deleting it'
+    )
+    parser.add_argument('--profile',
+                        required=False,
+                        action='store_true',
+                        help='Write a cProfile profile and subprocess timings ' +
+                             'to .profiles/ (or set SNAPSHOTTER_PROFILE=1)'
+    )
+    return parser.parse_args()
+
+
+_WORKERS_PER_DISK = 4 # directories deleted at once on each disk
+
+
+def data_cleaner(host, backups=False, dry_run=False):
     # This fuction finds inactive data directories and removes them
     # This includes unused keyspace directories and table directories
     # This will also remove snapshot files in the data directories
 
-    if check_host(host) != 0:
-        raise Exception('Invalid host parameter')
-    keyspaces = get_keyspaces(host, system=True) # avoid system keyspaces
-    structure = get_dir_structure(host, keyspaces)
-    cass_data_dir = get_data_dir()
-
-    print('Deleting old keyspaces . . .')
-    for ks in os.listdir(cass_data_dir):
-        if ks not in keyspaces:
-            print('\tDeleting: ' + cass_data_dir + '/' + ks)
-            shutil.rmtree(cass_data_dir + '/' + ks)
-
-    print('\nDeleting old tables . . .')
-    for keyspace in keyspaces:
-        if keyspace not in _SYSTEM_KEYSPACES:
-            print('\nProcessing keyspace: %s' % keyspace)
-            # should only be directories in this folder
-            data_dirs = set(os.listdir(cass_data_dir + '/' + keyspace))
-            table_dirs = set()
+    try:
+        structure = get_schema_structure(host) # one scan, cached on the node
+    except Exception as e:
+        raise Exception('Invalid host parameter: %s' % e)
+
+    disks = group_by_disk(get_data_dirs())
+    plans = [clean_plan(data_dirs, structure, backups) for data_dirs in disks]
+    print_plan(plans)
+    if dry_run:
+        print('\nDry run, nothing deleted')
+        return
+
+    # the disks' deletions are interleaved so every disk stays busy
+    steps = interleave(plans)
+    pool = ThreadPool(max(min(len(disks) * _WORKERS_PER_DISK, len(steps)), 1))
+    try:
+        pool.map(delete_step, steps)
+    finally:
+        pool.close()
+        pool.join()
+    print('Deleted %i directories and cleared %i backup directories'
+          % (len([step for step in steps if step[0] != 'backups']),
+             len([step for step in steps if step[0] == 'backups'])))
+
+    print('\nClearing old snapshots . . .')
+    subprocess.call(['nodetool', 'clearsnapshot'])
+
+
+def clean_plan(data_dirs, structure, backups=False):
+    # Everything to delete in the data directories of one disk, as
+    # (kind, path) steps: 'keyspace' and 'table' directories are removed,
+    # 'backups' directories are emptied of their files
 
-            for table in structure[keyspace].keys():
-                table_dirs.add(structure[keyspace][table])
+    steps = []
+    for cass_data_dir in data_dirs:
+        for ks in sorted(os.listdir(cass_data_dir)):
+            if ks not in structure:
+                steps.append(('keyspace', cass_data_dir + '/' + ks))
 
-            inactive_dirs = data_dirs - table_dirs
+        for keyspace in sorted(structure):
+            if keyspace in _SYSTEM_KEYSPACES:
+                continue
+            if not os.path.isdir(cass_data_dir + '/' + keyspace):
+                continue # no data on this disk yet
+            # should only be directories in this folder
+            ks_dirs = set(os.listdir(cass_data_dir + '/' + keyspace))
+            table_dirs = set(structure[keyspace].values())
 
-            print('Removing inactive directories . . .')
-            for d in inactive_dirs:
-                print('\tDeleting: ' + cass_data_dir + '/' + keyspace + '/' + d)
-                shutil.rmtree(cass_data_dir + '/' + keyspace + '/' + d)
+            for d in sorted(ks_dirs - table_dirs):
+                steps.append(('table', cass_data_dir + '/' + keyspace + '/' + d))
 
             if backups:
-                print('Removing old backup db files')
-                for d in table_dirs:
-                    clean_directory(cass_data_dir + '/' + keyspace + '/' + d + '/backups')
+                for d in sorted(ks_dirs & table_dirs):
+                    backup_dir = cass_data_dir + '/' + keyspace + '/' + d + '/backups'
+                    if os.path.isdir(backup_dir) and os.listdir(backup_dir):
+                        steps.append(('backups', backup_dir))
+    return steps
 
-    print('\nClearing old snapshots . . .')
-    subprocess.call(['nodetool', 'clearsnapshot'])
+
+def print_plan(plans):
+
+    for kind, title in (('keyspace', 'Old keyspaces'),
+                        ('table', 'Inactive table directories'),
+                        ('backups', 'Old backup db files')):
+        paths = [path for plan in plans for step_kind, path in plan
+                 if step_kind == kind]
+        print('%s (%i):' % (title, len(paths)))
+        for path in paths:
+            print('\tDeleting: ' + path)
+
+
+def interleave(plans):
+    # [[a1, a2], [b1]] -> [a1, b1, a2]
+
+    steps = []
+    for idx in range(max([len(plan) for plan in plans] or [0])):
+        steps += [plan[idx] for plan in plans if idx < len(plan)]
+    return steps
+
+
+def delete_step(step):
+
+    kind, path = step
+    if kind == 'backups':
+        clean_directory(path)
+    else:
+        shutil.rmtree(path)
 
 
 def clean_directory(table_directory):
 
     for f in os.listdir(table_directory):
-        if os.isfile(f):
+        if os.path.isfile(table_directory + '/' + f):
             os.remove(table_directory + '/' + f)
 
 
 if __name__ == '__main__':
 
-    data_cleaner(get_rpc_address(), backups=True)
+    cmds = parse_cmd()
+    with profile(sys.path[0], 'cleaner', cmds.profile):
+        data_cleaner(get_rpc_address(), backups=True, dry_run=cmds.dry_run)
 
 
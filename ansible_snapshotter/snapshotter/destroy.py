@@ -1,12 +1,15 @@
-from cass_functions import cassandra_query, get_keyspaces, get_rpc_address
+from cass_functions import get_session, get_keyspaces, get_rpc_address
 
 def destroy_schema(host):
 
     keyspaces = get_keyspaces(host)
 
+    statements = []
     for k in keyspaces:
         print('Dropping keyspace: %s' % k)
-        cassandra_query(host, 'DROP KEYSPACE %s;' % k)
+        statements.append('DROP KEYSPACE %s;' % k)
+    if statements:
+        get_session(host).execute_many(statements)
 
 if __name__ == '__main__':
     destroy_schema(get_rpc_address())
@@ -1,13 +1,17 @@
 import argparse
 import os
+import random
 import subprocess
 import shutil
 import time
 
-from cass_functions import check_host, get_rpc_address, get_yaml_var
+from cass_functions import (check_host, get_native_port, get_rpc_address,
+                            get_yaml_var, port_open)
 
-_TIMEOUT = 120 # seconds
-_SLEEP = 2 
+_TIMEOUT = 600 # seconds, default deadline for Cassandra to answer queries
+_FIRST_DELAY = 0.5 # seconds between probes, doubled after every probe
+_MAX_DELAY = 15
+_PROBE_TIMEOUT = 2 # seconds for one port probe
 
 
 def parse_cmd():
@@ -17,6 +21,13 @@ def parse_cmd():
                         required=False,
                         help='Specify which stage to run'
     )
+    parser.add_argument('--timeout',
+                        required=False,
+                        type=int,
+                        default=_TIMEOUT,
+                        help='Seconds to wait for Cassandra to answer ' +
+                             'queries after starting (default %i)' % _TIMEOUT
+    )
     return parser.parse_args()
 
 
@@ -34,15 +45,44 @@ def shutdown():
     remove_dirs = [
         get_yaml_var('commitlog_directory'),
         get_yaml_var('saved_caches_directory'),
-        get_yaml_var('data_file_directories')[0],
         '/var/log/cassandra'
-    ]
+    ] + get_yaml_var('data_file_directories')
     for d in remove_dirs:
         if os.path.isdir(d):
             shutil.rmtree(d)
 
 
-def start():
+def wait_for_cassandra(host, timeout=_TIMEOUT):
+    # Probes the native transport port, and only once it accepts connections
+    # queries system.local through the session shared by the whole run. The
+    # waits between probes double up to _MAX_DELAY, with jitter.
+
+    port = get_native_port()
+    start = time.time()
+    delay = _FIRST_DELAY
+    probes = 0
+    while True:
+        probes += 1
+        if not port_open(host, port, _PROBE_TIMEOUT):
+            state = 'port %i closed' % port
+        elif check_host(host) != 0:
+            state = 'port %i open, not answering queries yet' % port
+        else:
+            print('Cassandra answered after %.1f seconds (%i probes)'
+                  % (time.time() - start, probes))
+            return True
+
+        elapsed = time.time() - start
+        if elapsed > timeout:
+            return False
+        print('Time elapsed waiting for Cassandra: %.1f seconds, %s'
+              % (elapsed, state))
+        time.sleep(min(delay / 2 + random.uniform(0, delay / 2),
+                       timeout - elapsed))
+        delay = min(delay * 2, _MAX_DELAY)
+
+
+def start(timeout=_TIMEOUT):
 
     print('Starting service')
     startservice = subprocess.Popen(('sudo', 'service', 'cassandra', 'start'))
@@ -52,17 +92,10 @@ def start():
     print('Starting Cassandra') 
     start_cassandra = subprocess.Popen(('/usr/sbin/cassandra'), shell=True)
 
-    start = time.time()
-    current = start
-    host = get_rpc_address()
-    while check_host(host) != 0:
-        print('Time elapsed waiting for Cassandra: %s' % (current - start))
-        current = time.time()
-        if current - start > _TIMEOUT:
-            print('ERROR: Timed out waiting for cassandra to start.' +
-                  'Try increasing _TIMEOUT value.')
-            exit(1)
-        time.sleep(_SLEEP)
+    if not wait_for_cassandra(get_rpc_address(), timeout):
+        print('ERROR: Timed out after %i seconds waiting for cassandra to ' % timeout +
+              'start. Try a longer --timeout.')
+        exit(1)
 
     print('Hard reset complete')
 
@@ -77,9 +110,9 @@ if __name__ == '__main__':
         if cmds.stage == 'shutdown':
             shutdown()
         elif cmds.stage == 'start':
-            start()
+            start(cmds.timeout)
 
     else:
         shutdown()
-        start()
+        start(cmds.timeout)
     print('Process took %s seconds to complete' % (time.time() - start_time))
@@ -1,8 +1,9 @@
 import sys
 import argparse
-import zipfile
 
-from cass_functions import (get_rpc_address, cassandra_query)
+from cass_functions import (get_rpc_address, get_session)
+from archive import ArchiveReader
+from profiling import profile
 
 def parse_cmd():
 
@@ -12,6 +13,12 @@ def parse_cmd():
                         nargs='+',
                         help='Specify a keyspace'
     )
+    parser.add_argument('--profile',
+                        required=False,
+                        action='store_true',
+                        help='Write a cProfile profile and subprocess timings ' +
+                             'to .profiles/ (or set SNAPSHOTTER_PROFILE=1)'
+    )
     return parser.parse_args()
 
 
@@ -19,7 +26,9 @@ def _load(host, load_path):
     
     # The load path is the location of the .cql file which contains the schema
     with open(load_path, 'r') as f:
-        cassandra_query(host, f.read())
+        returncode, output = get_session(host).run_script(f.read())
+    if returncode != 0:
+        raise Exception('Failed to load schema: %s' % load_path)
 
 
 def load_schema(keyspace = None):
@@ -30,8 +39,7 @@ def load_schema(keyspace = None):
 
     # unzip schemas.zip
     print('Unzipping schemas.zip')
-    z = zipfile.ZipFile(temp_path + '/schemas.zip', 'r')
-    z.extractall(temp_path)
+    ArchiveReader(temp_path + '/schemas.zip').extractall(temp_path)
 
     if keyspace:
         for ks in keyspace:
@@ -43,4 +51,5 @@ def load_schema(keyspace = None):
 
 if __name__ == '__main__':
     cmds = parse_cmd()
-    load_schema(cmds.keyspace)
+    with profile(sys.path[0], 'load_schema', cmds.profile):
+        load_schema(cmds.keyspace)
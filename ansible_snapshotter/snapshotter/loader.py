@@ -0,0 +1,155 @@
+import os
+import re
+import time
+import shutil
+import threading
+import subprocess
+from multiprocessing.pool import ThreadPool
+
+from cass_functions import cassandra_tool
+
+# Runs sstableloader for several tables at once. Tables are started largest
+# first, so the biggest one is not left running alone at the end of the
+# restore. When the ring and the replication are as they were when the
+# snapshot was taken, the sstables are imported in place with nodetool instead.
+
+LOADERS_PER_NODE = 2 # default concurrent sstableloaders per restoring node
+
+# sstable components, such as mc-1-big-Data.db or nb-1-big-TOC.txt; snapshot
+# directories also hold manifest.json and schema.cql
+_COMPONENT = re.compile(r'-(CompressionInfo|Data|Digest|Filter|Index|Partitions|'
+                        r'Rows|Statistics|Summary|TOC|CRC)\.\w+$')
+
+
+def table_size(path):
+
+    size = 0
+    for root, dirs, files in os.walk(path):
+        for f in files:
+            size += os.path.getsize(os.path.join(root, f))
+    return size
+
+
+def node_jobs(loaders, hosts):
+    # Every node in hosts runs its loaders at the same time, so each one
+    # takes its share of the cluster wide number of loaders
+    return max(loaders // max(len(hosts), 1), 1)
+
+
+def _run(cmd):
+    # Returns (returncode, output)
+
+    process = subprocess.Popen(cmd,
+                               stdout=subprocess.PIPE,
+                               stderr=subprocess.STDOUT,
+                               universal_newlines=True)
+    output = process.communicate()[0]
+    return process.returncode, output
+
+
+def run_loader(hosts, table_dir):
+    # Streams the table to its owners in the cluster
+    return _run([cassandra_tool('sstableloader'), '-d', ','.join(hosts), table_dir])
+
+
+def sstable_components(table_dir):
+    # Paths, relative to table_dir, of the sstable components in it and in
+    # its secondary index (.<index>) directories
+
+    components = []
+    for f in sorted(os.listdir(table_dir)):
+        if os.path.isdir(table_dir + '/' + f):
+            components += [f + '/' + c for c in sstable_components(table_dir + '/' + f)]
+        elif _COMPONENT.search(f):
+            components.append(f)
+    return components
+
+
+def run_import(table_dir, live_dir=None):
+    # Adds the sstables of a <keyspace>/<table> directory to the table on
+    # this node. nodetool import (Cassandra 4.0+) takes them from where they
+    # are; older versions need their components moved into live_dir, the
+    # table's data directory, before nodetool refresh.
+
+    table = os.path.basename(table_dir.rstrip('/'))
+    keyspace = os.path.basename(os.path.dirname(table_dir.rstrip('/')))
+    if live_dir is None:
+        return _run(['nodetool', 'import', keyspace, table, table_dir])
+
+    components = sstable_components(table_dir)
+    for f in components:
+        if os.path.exists(live_dir + '/' + f):
+            return 1, 'sstable %s already in %s' % (f, live_dir)
+    for f in components:
+        if not os.path.isdir(os.path.dirname(live_dir + '/' + f)):
+            os.makedirs(os.path.dirname(live_dir + '/' + f))
+        shutil.move(table_dir + '/' + f, live_dir + '/' + f)
+    return _run(['nodetool', 'refresh', keyspace, table])
+
+
+def run_tables(tables, run, jobs=1):
+    # Runs run(table_dir) for every (name, table_dir) with at most jobs at
+    # once and returns one result per table, largest first
+
+    sized = sorted([(table_size(table_dir), name, table_dir)
+                    for name, table_dir in tables], reverse=True)
+    lock = threading.Lock()
+
+    def load(table):
+
+        size, name, table_dir = table
+        with lock:
+            print('Loading table: %s (%i bytes)' % (name, size))
+        start = time.time()
+        returncode, output = run(table_dir)
+        seconds = time.time() - start
+        with lock: # output is printed whole, not interleaved
+            print(output)
+            print('Loaded table: %s in %.2f seconds (exit code %i)'
+                  % (name, seconds, returncode))
+        return {
+            'table': name,
+            'bytes': size,
+            'start': start,
+            'seconds': seconds,
+            'returncode': returncode
+        }
+
+    pool = ThreadPool(max(min(jobs, len(sized)), 1))
+    try:
+        # chunksize 1 hands the tables out in order as workers free up
+        return pool.map(load, sized, 1)
+    finally:
+        pool.close()
+        pool.join()
+
+
+def load_tables(hosts, tables, jobs=1):
+    return run_tables(tables, lambda table_dir: run_loader(hosts, table_dir), jobs)
+
+
+def import_tables(tables, live_dirs=None, jobs=1):
+    # live_dirs maps table directories to the data directories of their
+    # tables when nodetool refresh is used
+
+    def run(table_dir):
+        return run_import(table_dir, live_dirs[table_dir] if live_dirs else None)
+    return run_tables(tables, run, jobs)
+
+
+def timing_report(results, elapsed):
+
+    lines = ['Table load times:']
+    template = '{0:50} | {1:>14} | {2:>10} | {3}'
+    lines.append(template.format('Table', 'Bytes', 'Seconds', 'Status'))
+    total_seconds = 0.0
+    for result in sorted(results, key=lambda r: r['seconds'], reverse=True):
+        total_seconds += result['seconds']
+        status = 'ok' if result['returncode'] == 0 else \
+                 'FAILED (%i)' % result['returncode']
+        lines.append(template.format(result['table'], result['bytes'],
+                                     '%.2f' % result['seconds'], status))
+    lines.append('%i tables, %i bytes in %.2f seconds (%.2f seconds of loading)'
+                 % (len(results), sum(r['bytes'] for r in results), elapsed,
+                    total_seconds))
+    return '\n'.join(lines)
@@ -0,0 +1,119 @@
+import os
+import json
+import time
+
+# Every snapshot carries an index of what it holds, so it can be listed,
+# checked and partly restored without opening the archives:
+#
+#   <node>.manifest.json    written next to each node archive
+#   manifest.json           all node manifests of a snapshot, at its top level
+#
+# {
+#   "version": 1,
+#   "title": "1500000000",
+#   "created": 1500000000.0,
+#   "format": "zip",
+#   "nodes": {
+#     "10.0.0.1": {
+#       "archive": "10.0.0.1.zip",
+#       "files": [
+#         {"keyspace": "ks", "table": "tb", "file": "mc-1-big-Data.db",
+#          "name": "ks/tb/mc-1-big-Data.db", "size": 1024,
+#          "offset": 512, "checksum": "crc32:0a1b2c3d"},
+#         . . .
+#       ]
+#     }
+#   }
+# }
+#
+# offset is the member's header offset in the archive (in the uncompressed
+# stream of tar formats).
+
+MANIFEST_FILE = 'manifest.json'
+MANIFEST_VERSION = 1
+
+
+def node_manifest_name(node):
+    return node + '.' + MANIFEST_FILE
+
+
+def node_manifest(archive_name, index):
+    # Manifest of one node archive from ArchiveWriter.index
+
+    files = []
+    for entry in index:
+        parts = entry['name'].split('/')
+        entry = dict(entry)
+        if len(parts) == 3: # <keyspace>/<table>/<file>
+            entry['keyspace'], entry['table'], entry['file'] = parts
+        else:
+            entry['keyspace'] = entry['table'] = None
+            entry['file'] = parts[-1]
+        files.append(entry)
+    return {'archive': archive_name, 'files': files}
+
+
+def snapshot_manifest(title, fmt, nodes, created=None):
+    # nodes maps each node to its node_manifest
+
+    return {
+        'version': MANIFEST_VERSION,
+        'title': title,
+        'created': created or time.time(),
+        'format': fmt,
+        'nodes': nodes
+    }
+
+
+def write_manifest(path, manifest):
+
+    with open(path + '.tmp', 'w') as f:
+        json.dump(manifest, f, sort_keys=True)
+    os.rename(path + '.tmp', path)
+
+
+def read_manifest(path):
+
+    with open(path, 'r') as f:
+        return load_manifest(f.read())
+
+
+def load_manifest(data):
+
+    if isinstance(data, bytes):
+        data = data.decode('utf-8')
+    manifest = json.loads(data)
+    if manifest.get('version', 0) > MANIFEST_VERSION:
+        raise Exception('Manifest version %s is newer than this script supports'
+                        % manifest.get('version'))
+    return manifest
+
+
+def merge_node_manifests(path, title, fmt):
+    # Collects the <node>.manifest.json files in path into path/manifest.json
+    # and removes them; returns the snapshot manifest
+
+    nodes = {}
+    suffix = '.' + MANIFEST_FILE
+    for f in sorted(os.listdir(path)):
+        if f.endswith(suffix):
+            nodes[f[:-len(suffix)]] = read_manifest(path + '/' + f)
+            os.remove(path + '/' + f)
+    manifest = snapshot_manifest(title, fmt, nodes)
+    write_manifest(path + '/' + MANIFEST_FILE, manifest)
+    return manifest
+
+
+def manifest_tables(manifest, node=None):
+    # {keyspace: {table: bytes}} over every node, or over one node
+
+    tables = {}
+    for name, node_manifest in manifest['nodes'].items():
+        if node is not None and name != node:
+            continue
+        for entry in node_manifest['files']:
+            if entry['keyspace'] is None:
+                continue
+            ks_tables = tables.setdefault(entry['keyspace'], {})
+            ks_tables[entry['table']] = ks_tables.get(entry['table'], 0) + entry['size']
+    return tables
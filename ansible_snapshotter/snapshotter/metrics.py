@@ -0,0 +1,227 @@
+import os
+import json
+import time
+import threading
+import contextlib
+
+# Per-phase timing of the snapshot and restore scripts. Every phase (schema
+# discovery, nodetool snapshot, copy, archive, upload, extract, each
+# sstableloader run . . .) is written as one JSON line:
+#
+#   {"command": "snapshot", "node": "10.0.0.1", "phase": "archive",
+#    "start": 1536000000.0, "seconds": 12.5, "bytes": 1048576, "files": 42,
+#    "mb_per_second": 0.08}
+#
+# plus labels such as "table" or "returncode". The nodes write
+# .metrics/<command>.jsonl next to the scripts; the controller fetches them
+# into output_logs/ and merges them with its own phases into one run report
+# (and optionally a Prometheus textfile, see prometheus_text).
+
+METRICS_DIR = '.metrics'
+PROMETHEUS_PREFIX = 'cassandra_snapshotter'
+
+_MB = 1024 * 1024
+
+
+class MetricsRecorder(object):
+    # Appends phase records to a JSON lines file; without a path the records
+    # are only kept in memory
+
+    def __init__(self, path=None, node=None, command=None):
+
+        self.path = path
+        self.node = node
+        self.command = command
+        self.records = []
+        self._lock = threading.Lock()
+        if path:
+            if not os.path.isdir(os.path.dirname(path)):
+                os.makedirs(os.path.dirname(path))
+            open(path, 'w').close()
+
+    def record(self, phase, seconds, size=0, files=0, start=None, **labels):
+
+        entry = {
+            'command': self.command,
+            'node': self.node,
+            'phase': phase,
+            'start': start if start is not None else time.time() - seconds,
+            'seconds': seconds,
+            'bytes': size,
+            'files': files,
+            'mb_per_second': size / float(_MB) / seconds if seconds and size
+                             else None
+        }
+        entry.update(labels)
+        with self._lock:
+            self.records.append(entry)
+            if self.path:
+                with open(self.path, 'a') as f:
+                    f.write(json.dumps(entry, sort_keys=True) + '\n')
+        return entry
+
+    @contextlib.contextmanager
+    def phase(self, phase, size=0, files=0, **labels):
+        # Times the with block; it gets a dict whose bytes and files (and
+        # any labels) can be set once they are known
+
+        counts = {'bytes': size, 'files': files}
+        start = time.time()
+        yield counts
+        size = counts.pop('bytes')
+        files = counts.pop('files')
+        labels.update(counts)
+        self.record(phase, time.time() - start, size, files, start, **labels)
+
+
+_RECORDER = MetricsRecorder()
+
+
+def start_metrics(path, node, command):
+    # Every later phase and record call in this process goes to path
+
+    global _RECORDER
+    _RECORDER = MetricsRecorder(path, node, command)
+    return _RECORDER
+
+
+def phase(name, size=0, files=0, **labels):
+    return _RECORDER.phase(name, size, files, **labels)
+
+
+def record(name, seconds, size=0, files=0, start=None, **labels):
+    return _RECORDER.record(name, seconds, size, files, start, **labels)
+
+
+def node_metrics_path(root, command):
+    # where a node script writes its records
+    return '%s/%s/%s.jsonl' % (root, METRICS_DIR, command)
+
+
+def read_metrics(path):
+
+    records = []
+    with open(path, 'r') as f:
+        for line in f:
+            if line.strip():
+                records.append(json.loads(line))
+    return records
+
+
+# Run Report
+def metrics_report(command, records):
+    # Sums the records per node and phase, and finds the slowest node of
+    # every phase
+
+    nodes = {}
+    phases = {}
+    for entry in records:
+        node = nodes.setdefault(entry['node'], {})
+        totals = node.setdefault(entry['phase'], {'seconds': 0.0, 'bytes': 0,
+                                                  'files': 0, 'count': 0})
+        totals['seconds'] += entry['seconds']
+        totals['bytes'] += entry['bytes']
+        totals['files'] += entry['files']
+        totals['count'] += 1
+
+    for name, node in nodes.items():
+        for phase_name, totals in node.items():
+            totals['mb_per_second'] = totals['bytes'] / float(_MB) / \
+                                      totals['seconds'] \
+                                      if totals['seconds'] and totals['bytes'] \
+                                      else None
+            summary = phases.setdefault(phase_name, {
+                'nodes': 0, 'seconds': 0.0, 'bytes': 0, 'files': 0,
+                'max_seconds': -1, 'slowest_node': None
+            })
+            summary['nodes'] += 1
+            summary['seconds'] += totals['seconds']
+            summary['bytes'] += totals['bytes']
+            summary['files'] += totals['files']
+            if totals['seconds'] > summary['max_seconds']:
+                summary['max_seconds'] = totals['seconds']
+                summary['slowest_node'] = name
+
+    starts = [entry['start'] for entry in records]
+    ends = [entry['start'] + entry['seconds'] for entry in records]
+    return {
+        'command': command,
+        'start': min(starts) if starts else None,
+        'seconds': max(ends) - min(starts) if starts else 0.0,
+        'phases': phases,
+        'nodes': nodes,
+        'records': records
+    }
+
+
+def report_table(report):
+    # Phases in the order they started, with the slowest node of each
+
+    first = {}
+    for entry in report['records']:
+        first[entry['phase']] = min(first.get(entry['phase'], entry['start']),
+                                    entry['start'])
+    template = '{0:20} | {1:>5} | {2:>14} | {3:>10} | {4:>10} | {5}'
+    lines = [template.format('Phase', 'Nodes', 'Bytes', 'Max sec', 'MB/s',
+                             'Slowest node')]
+    for name in sorted(report['phases'], key=lambda name: first[name]):
+        summary = report['phases'][name]
+        slowest = report['nodes'][summary['slowest_node']][name]
+        lines.append(template.format(
+                name, summary['nodes'], summary['bytes'],
+                '%.2f' % summary['max_seconds'],
+                '%.1f' % slowest['mb_per_second'] if slowest['mb_per_second']
+                else '-',
+                summary['slowest_node']))
+    lines.append('%s took %.2f seconds' % (report['command'], report['seconds']))
+    return '\n'.join(lines)
+
+
+def _label(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def prometheus_text(report):
+    # Prometheus text exposition of the per node and phase totals (and per
+    # table, for records that name one), for node_exporter's textfile
+    # collector
+
+    series = {}
+    for entry in report['records']:
+        labels = [('command', entry['command']), ('node', entry['node']),
+                  ('phase', entry['phase'])]
+        if entry.get('table'):
+            labels.append(('table', entry['table']))
+        key = tuple(labels)
+        totals = series.setdefault(key, [0.0, 0, 0])
+        totals[0] += entry['seconds']
+        totals[1] += entry['bytes']
+        totals[2] += entry['files']
+
+    lines = []
+    for idx, (metric, help_text) in enumerate((
+            ('phase_seconds', 'Seconds spent in a snapshot or restore phase'),
+            ('phase_bytes', 'Bytes handled by a snapshot or restore phase'),
+            ('phase_files', 'Files handled by a snapshot or restore phase'))):
+        name = PROMETHEUS_PREFIX + '_' + metric
+        lines.append('# HELP %s %s' % (name, help_text))
+        lines.append('# TYPE %s gauge' % name)
+        for key in sorted(series, key=lambda key: [str(v) for l, v in key]):
+            lines.append('%s{%s} %s' % (name, ','.join('%s="%s"' % (l, _label(v))
+                                                       for l, v in key),
+                                        str(series[key][idx])))
+    name = PROMETHEUS_PREFIX + '_last_run_timestamp_seconds'
+    lines.append('# HELP %s Time the last run started' % name)
+    lines.append('# TYPE %s gauge' % name)
+    lines.append('%s{command="%s"} %s' % (name, _label(report['command']),
+                                         str(report['start'] or 0.0)))
+    return '\n'.join(lines) + '\n'
+
+
+def write_prometheus(path, report):
+    # written to a temporary file and renamed, so the textfile collector
+    # never reads half a file
+
+    with open(path + '.tmp', 'w') as f:
+        f.write(prometheus_text(report))
+    os.rename(path + '.tmp', path)
@@ -0,0 +1,77 @@
+import os
+import zlib
+
+# Each sstable component is stored once in the backup repository under
+#   objects/<node>/<keyspace>/<table>/<file name>/<size>-<checksum>
+# The file name carries the sstable generation and component, so unchanged
+# files of an immutable sstable map to the same key in every snapshot.
+
+OBJECT_MANIFEST = 'objects.json'
+_CHUNK_SIZE = 1024 * 1024
+
+
+def file_crc32(path):
+
+    crc = 0
+    with open(path, 'rb') as f:
+        chunk = f.read(_CHUNK_SIZE)
+        while chunk:
+            crc = zlib.crc32(chunk, crc)
+            chunk = f.read(_CHUNK_SIZE)
+    return crc & 0xffffffff
+
+
+def sstable_digest(path):
+    # Cassandra writes the crc32 of every Data.db into <prefix>-Digest.crc32,
+    # so Data.db files do not have to be read again to be identified
+
+    if not path.endswith('-Data.db'):
+        return None
+    digest_path = path[:-len('Data.db')] + 'Digest.crc32'
+    try:
+        with open(digest_path, 'r') as f:
+            return int(f.read().strip()) & 0xffffffff
+    except (IOError, OSError, ValueError):
+        return None
+
+
+def check_digests(checksums, paths):
+    # Compares the crc32 computed for Data.db files while they were archived
+    # or extracted with the Digest.crc32 Cassandra wrote for them.
+    # checksums and paths map archive names to 'crc32:<hex>' and to file
+    # paths. Returns (sstables checked, names that do not match).
+
+    checked = 0
+    mismatched = []
+    for name, checksum in checksums.items():
+        digest = sstable_digest(paths[name])
+        if digest is None:
+            continue
+        checked += 1
+        if checksum != 'crc32:%08x' % digest:
+            mismatched.append(name)
+    return checked, sorted(mismatched)
+
+
+def object_entry(node, path, arcname):
+    # Describes one archive member as a repository object; other components
+    # (Statistics.db and Summary.db can be rewritten in place) are hashed
+
+    size = os.path.getsize(path)
+    crc = sstable_digest(path)
+    if crc is None:
+        crc = file_crc32(path)
+    checksum = '%08x' % crc
+    return {
+        'name': arcname,
+        'size': size,
+        'checksum': 'crc32:' + checksum,
+        'key': 'objects/%s/%s/%i-%s' % (node, arcname, size, checksum)
+    }
+
+
+def read_known_objects(path):
+    # One object key per line, as written by the controller
+
+    with open(path, 'r') as f:
+        return set(line.strip() for line in f if line.strip())
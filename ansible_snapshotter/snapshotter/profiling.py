@@ -0,0 +1,157 @@
+import os
+import sys
+import time
+import pstats
+import cProfile
+import threading
+import subprocess
+import contextlib
+import json
+try:
+    from StringIO import StringIO
+except ImportError:
+    from io import StringIO # python3
+
+# Opt-in profiling of the node scripts, with --profile or with
+# SNAPSHOTTER_PROFILE=1 in the node's environment. While a script runs:
+#
+#   - cProfile records every function call, in the worker threads too
+#     (copy workers, sstableloader runners)
+#   - every subprocess (nodetool, cqlsh, sstableloader, zstd . . .) is timed
+#     from start to exit
+#
+# Then .profiles/<script>.prof (for pstats or snakeviz), <script>.txt (the
+# slowest functions and subprocesses) and <script>.subprocesses.json are
+# written next to the scripts, where the playbooks fetch them from.
+
+PROFILE_ENV = 'SNAPSHOTTER_PROFILE'
+PROFILE_DIR = '.profiles'
+PROFILE_FILES = ('prof', 'txt', 'subprocesses.json') # written for every script
+
+_TOP_FUNCTIONS = 40
+_Popen = subprocess.Popen
+_SUBPROCESSES = []
+_LOCK = threading.Lock()
+
+
+def profiling_enabled(flag=False):
+    return flag or os.environ.get(PROFILE_ENV, '') not in ('', '0')
+
+
+def profile_path(root, script):
+    # .profiles/<script> without the extension
+    return '%s/%s/%s' % (root, PROFILE_DIR, script)
+
+
+class _TimedPopen(_Popen):
+    # Popen that records the wall time of its command until it exits
+
+    def __init__(self, args, *pargs, **kwargs):
+
+        self._profile_command = args if isinstance(args, str) else ' '.join(args)
+        self._profile_start = time.time()
+        self._profile_recorded = False
+        _Popen.__init__(self, args, *pargs, **kwargs)
+
+    def wait(self, *args, **kwargs):
+
+        returncode = _Popen.wait(self, *args, **kwargs)
+        if not self._profile_recorded:
+            self._profile_recorded = True
+            with _LOCK:
+                _SUBPROCESSES.append({
+                    'command': self._profile_command,
+                    'start': self._profile_start,
+                    'seconds': time.time() - self._profile_start,
+                    'returncode': returncode
+                })
+        return returncode
+
+
+def _start_thread_profiler(profilers):
+    # cProfile only sees the thread it was enabled in before python 3.12,
+    # so every thread started while profiling gets its own profiler
+
+    def start(frame, event, arg):
+        profiler = cProfile.Profile()
+        with _LOCK:
+            profilers.append(profiler)
+        profiler.enable() # replaces this function as the thread's hook
+    threading.setprofile(start)
+
+
+def _merge_stats(profilers, stream):
+
+    stats = None
+    for profiler in profilers:
+        try:
+            if stats is None:
+                stats = pstats.Stats(profiler, stream=stream)
+            else:
+                stats.add(profiler)
+        except TypeError: # a thread that recorded nothing
+            pass
+    return stats
+
+
+def subprocess_report(subprocesses, elapsed):
+
+    lines = ['Subprocesses by wall time:']
+    template = '{0:>10} | {1:>5} | {2}'
+    lines.append(template.format('Seconds', 'Exit', 'Command'))
+    for entry in sorted(subprocesses, key=lambda e: e['seconds'], reverse=True):
+        lines.append(template.format('%.3f' % entry['seconds'],
+                                     entry['returncode'], entry['command'][:200]))
+    total = sum(entry['seconds'] for entry in subprocesses)
+    lines.append('%i subprocesses, %.2f seconds of subprocess wall time in a '
+                 '%.2f second run' % (len(subprocesses), total, elapsed))
+    return '\n'.join(lines)
+
+
+def write_profile(path, profilers, subprocesses, elapsed):
+    # path.prof holds the merged cProfile stats, path.txt the top functions
+    # by cumulative and own time and the subprocess wall times
+
+    if not os.path.isdir(os.path.dirname(path)):
+        os.makedirs(os.path.dirname(path))
+    stream = StringIO()
+    stats = _merge_stats(profilers, stream)
+    if stats is not None:
+        stats.dump_stats(path + '.prof')
+        stats.sort_stats('cumulative').print_stats(_TOP_FUNCTIONS)
+        stats.sort_stats('tottime').print_stats(_TOP_FUNCTIONS)
+    with open(path + '.txt', 'w') as f:
+        f.write(subprocess_report(subprocesses, elapsed) + '\n\n')
+        f.write(stream.getvalue())
+    with open(path + '.subprocesses.json', 'w') as f:
+        json.dump(subprocesses, f, indent=2)
+
+
+@contextlib.contextmanager
+def profile(root, script, enabled=False):
+    # Profiles the with block when enabled (or SNAPSHOTTER_PROFILE is set);
+    # the profile is written even if the script exits early
+
+    if not profiling_enabled(enabled):
+        yield
+        return
+
+    path = profile_path(root, script)
+    for ext in PROFILE_FILES:
+        if os.path.exists(path + '.' + ext): # left by an earlier run
+            os.remove(path + '.' + ext)
+    del _SUBPROCESSES[:]
+    subprocess.Popen = _TimedPopen
+    profilers = [cProfile.Profile()]
+    if sys.version_info < (3, 12):
+        _start_thread_profiler(profilers)
+    start = time.time()
+    profilers[0].enable()
+    try:
+        yield
+    finally:
+        profilers[0].disable()
+        threading.setprofile(None)
+        subprocess.Popen = _Popen
+        write_profile(path, profilers, list(_SUBPROCESSES), time.time() - start)
+        print('Profile written to %s.txt' % path)
@@ -1,12 +1,22 @@
 import os
 import sys
 import argparse
+import zipfile
 import subprocess
 import shutil
 import time
-import zipfile
 
-from cass_functions import get_rpc_address
+from cass_functions import (get_rpc_address, get_data_dirs, get_dir_structure,
+                            get_release_version, get_replication,
+                            schema_replication)
+from archive import ArchiveReader, find_archive, member_filter
+from objects import check_digests
+from loader import (LOADERS_PER_NODE, load_tables, import_tables, node_jobs,
+                    timing_report)
+from ring import (read_ring_nodes, current_ring_nodes, same_replication,
+                  summary_bounds, intersects, TokenRing)
+from metrics import node_metrics_path, phase, record, start_metrics
+from profiling import profile
 
 def parse_cmd():
 
@@ -26,6 +36,33 @@ def parse_cmd():
                         nargs='+',
                         help="Specify table(s)"
     )
+    parser.add_argument('--loaders',
+                        required=False,
+                        type=int,
+                        help='Concurrent sstableloaders across the cluster, ' +
+                             'shared by the restoring nodes (default %i per node)'
+                             % LOADERS_PER_NODE
+    )
+    parser.add_argument('--import',
+                        dest='import_sstables',
+                        required=False,
+                        action='store_true',
+                        help='Import the sstables in place with nodetool when ' +
+                             'the ring and the keyspaces\' replication match ' +
+                             'ring_info.txt and schemas.zip'
+    )
+    parser.add_argument('--route',
+                        required=False,
+                        action='store_true',
+                        help='Skip sstables outside the token ranges this node ' +
+                             'replicated in ring_info.txt'
+    )
+    parser.add_argument('--profile',
+                        required=False,
+                        action='store_true',
+                        help='Write a cProfile profile and subprocess timings ' +
+                             'to .profiles/ (or set SNAPSHOTTER_PROFILE=1)'
+    )
     return parser.parse_args()
 
 
@@ -50,7 +87,94 @@ def make_dir(path):
     return exists
 
 
-def restore(hosts, keyspace_arg = None, table_arg = None):
+def topology_matches(host, snapshot_path, keyspaces):
+    # True if the whole ring (every node's tokens, datacenter and rack) and
+    # the replication of the keyspaces are as they were when the snapshot
+    # was taken. A node's replicas also depend on its neighbours' tokens and
+    # on the replication, so only then does its snapshot hold exactly the
+    # ranges it replicates now.
+
+    for f in ('ring_info.txt', 'schemas.zip'):
+        if not os.path.isfile(snapshot_path + '/' + f):
+            print('No %s for the snapshot' % f)
+            return False
+    snapshot_ring = read_ring_nodes(snapshot_path + '/ring_info.txt')
+    if host not in snapshot_ring or snapshot_ring != current_ring_nodes():
+        print('The ring differs from the snapshot\'s')
+        return False
+
+    with zipfile.ZipFile(snapshot_path + '/schemas.zip', 'r') as z:
+        replication = schema_replication(z.read('schema.cql').decode('utf-8'))
+    for ks in keyspaces:
+        if ks not in replication or \
+                not same_replication(replication[ks], get_replication(host, ks)):
+            print('The replication of %s differs from the snapshot\'s' % ks)
+            return False
+    return True
+
+
+def live_table_dirs(host, load):
+    # Data directories of the restored tables, for nodetool refresh
+
+    keyspaces = set(name.split('.')[0] for name, table_dir in load)
+    structure = get_dir_structure(host, keyspaces)
+    data_dir = get_data_dirs()[0]
+    live_dirs = {}
+    for name, table_dir in load:
+        ks, tb = name.split('.', 1)
+        if tb not in structure.get(ks, {}):
+            raise Exception('Table %s not in schema' % name)
+        live_dirs[table_dir] = '%s/%s/%s' % (data_dir, ks, structure[ks][tb])
+    return live_dirs
+
+
+def skip_foreign_sstables(host, load, ring_path):
+    # Removes the sstables whose token bounds lie outside every range this
+    # node replicated when the snapshot was taken, such as data left behind
+    # by a topology change without cleanup. The nodes that did own those
+    # ranges have the data in their own snapshots, so streaming it from here
+    # again is redundant.
+
+    if not os.path.isfile(ring_path):
+        print('No ring_info.txt for the snapshot, loading every sstable')
+        return
+    token_ring = TokenRing(read_ring_nodes(ring_path))
+    if host not in token_ring.nodes:
+        print('%s not in ring_info.txt, loading every sstable' % host)
+        return
+
+    keyspace_ranges = {}
+    skipped = 0
+    skipped_bytes = 0
+    for name, table_dir in load:
+        ks = name.split('.')[0]
+        if ks not in keyspace_ranges:
+            keyspace_ranges[ks] = token_ring.replica_ranges(
+                    host, get_replication(host, ks))
+        ranges = keyspace_ranges[ks]
+        if ranges is None: # replication strategy not known
+            continue
+
+        files = os.listdir(table_dir)
+        for f in files:
+            if not f.endswith('-Data.db'):
+                continue
+            prefix = f[:-len('Data.db')]
+            bounds = summary_bounds(table_dir + '/' + prefix + 'Summary.db')
+            if bounds is None or intersects(ranges, bounds[0], bounds[1]):
+                continue
+            for component in files:
+                if component.startswith(prefix):
+                    skipped_bytes += os.path.getsize(table_dir + '/' + component)
+                    os.remove(table_dir + '/' + component)
+            skipped += 1
+
+    print('Skipped %i sstable(s), %i bytes, outside the ranges of this node'
+          % (skipped, skipped_bytes))
+
+
+def restore(hosts, keyspace_arg = None, table_arg = None, loaders=None,
+            import_sstables=False, route=False):
 
     cqlsh_host = get_rpc_address()
     snapshot_path = sys.path[0] + '/.snapshots'
@@ -60,10 +184,19 @@ def restore(hosts, keyspace_arg = None, table_arg = None):
     if make_dir(temp_path):
         clean_dir(temp_path)
 
-    zip_path = snapshot_path + '/' + cqlsh_host + '.zip'
-    zipf = zipfile.ZipFile(zip_path, 'r')
-    zipf.extractall(temp_path)
-    zipf.close()
+    # only the requested keyspaces and tables are extracted; the archive's
+    # checksums and Cassandra's digests are checked in the same pass
+    archive_path = find_archive(snapshot_path + '/' + cqlsh_host)
+    reader = ArchiveReader(archive_path)
+    with phase('extract', os.path.getsize(archive_path)) as counts:
+        extracted = reader.extract(temp_path, member_filter(keyspace_arg, table_arg))
+        checked, mismatched = check_digests(
+                reader.checksums, dict((name, temp_path + '/' + name) for name in extracted))
+        counts['files'] = len(extracted)
+    if mismatched:
+        print('ERROR: Checksum mismatch for %s' % ', '.join(mismatched))
+        exit(1)
+    print('Verified %i sstables against their Digest.crc32' % checked)
 
     print('Checking keyspace and table arguments . . .')
     keyspaces = os.listdir(temp_path)
@@ -82,15 +215,48 @@ def restore(hosts, keyspace_arg = None, table_arg = None):
         else:
             keyspaces = keyspace_arg
 
-    print('Loading snapshot data . . .')
+    load = []
     for ks in keyspaces:
         if not table_arg:
             tables = os.listdir(temp_path + '/' + ks)
-        print('Loading keyspace: %s' % ks)
         for tb in tables:
-            print('\tLoading table: %s' % tb)
-            tb_dir = temp_path + '/' + ks + '/' + tb
-            subprocess.call(['/bin/sstableloader', '-d', ','.join(hosts), tb_dir])
+            load.append((ks + '.' + tb, temp_path + '/' + ks + '/' + tb))
+
+    if loaders is None:
+        loaders = LOADERS_PER_NODE * len(hosts)
+    jobs = node_jobs(loaders, hosts)
+    start = time.time()
+    if import_sstables and topology_matches(
+            cqlsh_host, snapshot_path, set(name.split('.')[0] for name, table_dir in load)):
+        # nothing has to be streamed; nodetool import takes the files as
+        # they are, older versions refresh after a move into the table
+        loader_phase = 'import'
+        if get_release_version(cqlsh_host) >= (4, 0):
+            print('Ring matches the snapshot, importing sstables . . .')
+            results = import_tables(load, jobs=jobs)
+        else:
+            print('Ring matches the snapshot, refreshing tables . . .')
+            results = import_tables(load, live_table_dirs(cqlsh_host, load), jobs)
+    else:
+        loader_phase = 'sstableloader'
+        if import_sstables:
+            print('Streaming instead of importing')
+        if route:
+            skip_foreign_sstables(cqlsh_host, load, snapshot_path + '/ring_info.txt')
+        print('Loading snapshot data with %i sstableloader(s) . . .' % jobs)
+        results = load_tables(hosts, load, jobs)
+    elapsed = time.time() - start
+    print(timing_report(results, elapsed))
+    for result in results:
+        record(loader_phase, result['seconds'], result['bytes'], start=result['start'],
+               table=result['table'], returncode=result['returncode'])
+    record('load', elapsed, sum(r['bytes'] for r in results), len(results),
+           start=start, jobs=jobs)
+
+    failed = [r['table'] for r in results if r['returncode'] != 0]
+    if failed:
+        print('ERROR: sstableloader failed for %s' % ', '.join(failed))
+        exit(1)
 
     print('Restoration complete')
 
@@ -98,9 +264,13 @@ def restore(hosts, keyspace_arg = None, table_arg = None):
 if __name__ == '__main__':
 
     cmds = parse_cmd()
+    start_metrics(node_metrics_path(sys.path[0], 'restore'), get_rpc_address(),
+                  'restore')
 
     start = time.time()
-    restore(cmds.nodes, cmds.keyspace, cmds.table)
+    with profile(sys.path[0], 'restore', cmds.profile):
+        restore(cmds.nodes, cmds.keyspace, cmds.table, cmds.loaders,
+                cmds.import_sstables, cmds.route)
     end = time.time()
 
     print('Elapsed time: %s' % (end - start))
@@ -0,0 +1,257 @@
+import re
+import struct
+import bisect
+import subprocess
+
+# Token ring of a cluster, read from "nodetool ring" output such as the
+# ring_info.txt saved with every snapshot:
+#
+#   Datacenter: datacenter1
+#   ==========
+#   Address     Rack   Status State   Load        Owns     Token
+#                                                          9126510387402473911
+#   10.0.0.1    rack1  Up     Normal  1.02 MiB    33.33%   -9211787439616577131
+#   . . .
+
+_TOKEN = re.compile(r'^-?\d+$')
+_MASK = 0xffffffffffffffff
+
+
+def parse_ring_nodes(text):
+    # Returns {address: {'dc': datacenter, 'rack': rack, 'tokens': set}}
+
+    nodes = {}
+    dc = None
+    for line in text.split('\n'):
+        if line.startswith('Datacenter:'):
+            dc = line.split(':', 1)[1].strip()
+            continue
+        fields = line.split()
+        if len(fields) < 2 or not _TOKEN.match(fields[-1]):
+            continue
+        if _TOKEN.match(fields[0]): # first line of each datacenter's ring
+            continue
+        node = nodes.setdefault(fields[0], {'dc': dc,
+                                            'rack': fields[1],
+                                            'tokens': set()})
+        node['tokens'].add(int(fields[-1]))
+    return nodes
+
+
+def parse_ring(text):
+    # Returns {address: set of tokens}
+
+    nodes = parse_ring_nodes(text)
+    return dict((address, node['tokens']) for address, node in nodes.items())
+
+
+def read_ring(path):
+
+    with open(path, 'r') as f:
+        return parse_ring(f.read())
+
+
+def read_ring_nodes(path):
+
+    with open(path, 'r') as f:
+        return parse_ring_nodes(f.read())
+
+
+def current_ring_nodes():
+    # parse_ring_nodes of the cluster's ring now, from "nodetool ring"
+
+    output = subprocess.check_output(['nodetool', 'ring'],
+                                     universal_newlines=True)
+    return parse_ring_nodes(output)
+
+
+def same_replication(first, second):
+    # True if two keyspace replication maps place replicas the same way; the
+    # class may be given by its short or its full name
+
+    def normalize(replication):
+        replication = dict((key, str(value)) for key, value in replication.items())
+        replication['class'] = replication.get('class', '').split('.')[-1]
+        return replication
+    return first is not None and second is not None and \
+           normalize(first) == normalize(second)
+
+
+class TokenRing(object):
+    # Token map of a ring: every token range (previous token, token] and the
+    # nodes that replicate it under a keyspace's replication settings
+
+    def __init__(self, nodes):
+
+        self.nodes = nodes
+        pairs = sorted((token, address) for address, node in nodes.items()
+                       for token in node['tokens'])
+        self.tokens = [token for token, address in pairs]
+        self.owners = [address for token, address in pairs]
+
+    def owner(self, token):
+        # Primary owner: the node with the first token at or after token
+
+        idx = bisect.bisect_left(self.tokens, token)
+        return self.owners[idx % len(self.owners)]
+
+    def _walk(self, idx, rf, dc=None):
+        # First rf distinct nodes (of datacenter dc) clockwise from idx
+
+        replicas = []
+        for step in range(len(self.owners)):
+            address = self.owners[(idx + step) % len(self.owners)]
+            if address in replicas:
+                continue
+            if dc is not None and self.nodes[address]['dc'] != dc:
+                continue
+            replicas.append(address)
+            if len(replicas) == rf:
+                break
+        return replicas
+
+    def replicas(self, idx, replication):
+        # Nodes replicating the range ending at self.tokens[idx], or None if
+        # the strategy is not known. Rack aware placement can skip nodes, so
+        # datacenters spanning several racks count every node as a replica.
+
+        strategy = replication.get('class', '').split('.')[-1]
+        if strategy == 'SimpleStrategy':
+            return set(self._walk(idx, int(replication['replication_factor'])))
+        if strategy != 'NetworkTopologyStrategy':
+            return None
+
+        replicas = set()
+        for dc, rf in replication.items():
+            if dc == 'class':
+                continue
+            dc_nodes = [a for a, node in self.nodes.items() if node['dc'] == dc]
+            racks = set(self.nodes[a]['rack'] for a in dc_nodes)
+            if len(racks) > 1 and int(rf) < len(dc_nodes):
+                replicas.update(dc_nodes)
+            else:
+                replicas.update(self._walk(idx, int(rf), dc))
+        return replicas
+
+    def replica_ranges(self, address, replication):
+        # (start, end] ranges that address replicates, or None for all of them
+
+        ranges = []
+        for idx in range(len(self.tokens)):
+            replicas = self.replicas(idx, replication)
+            if replicas is None:
+                return None
+            if address in replicas:
+                ranges.append((self.tokens[idx - 1], self.tokens[idx]))
+        return ranges
+
+
+def intersects(ranges, first, last):
+    # True if the tokens [first, last] overlap any (start, end] range; a
+    # range whose start is not below its end wraps around the ring
+
+    for start, end in ranges:
+        if start < end:
+            if first <= end and last > start:
+                return True
+        elif last > start or first <= end:
+            return True
+    return False
+
+
+# Token bounds of sstables
+def _signed(value):
+    value &= _MASK
+    return value - (1 << 64) if value >> 63 else value
+
+
+def _rotl(value, shift):
+    return ((value << shift) | (value >> (64 - shift))) & _MASK
+
+
+def _fmix(k):
+
+    k ^= k >> 33
+    k = (k * 0xff51afd7ed558ccd) & _MASK
+    k ^= k >> 33
+    k = (k * 0xc4ceb9fe1a85ec53) & _MASK
+    k ^= k >> 33
+    return k
+
+
+def murmur3_token(key):
+    # Murmur3Partitioner token of a partition key: the first half of
+    # Cassandra's MurmurHash3 x64 128, whose tail bytes are sign extended
+
+    data = bytearray(key)
+    length = len(data)
+    nblocks = length >> 4
+    c1 = 0x87c37b91114253d5
+    c2 = 0x4cf5ad432745937f
+    h1 = h2 = 0
+
+    for i in range(nblocks):
+        k1, k2 = struct.unpack_from('<QQ', bytes(data), i * 16)
+        k1 = (_rotl((k1 * c1) & _MASK, 31) * c2) & _MASK
+        h1 ^= k1
+        h1 = (_rotl(h1, 27) + h2) & _MASK
+        h1 = (h1 * 5 + 0x52dce729) & _MASK
+        k2 = (_rotl((k2 * c2) & _MASK, 33) * c1) & _MASK
+        h2 ^= k2
+        h2 = (_rotl(h2, 31) + h1) & _MASK
+        h2 = (h2 * 5 + 0x38495ab5) & _MASK
+
+    tail = data[nblocks * 16:]
+    k1 = k2 = 0
+    for i in range(len(tail) - 1, -1, -1):
+        byte = tail[i] - 256 if tail[i] > 127 else tail[i]
+        if i >= 8:
+            k2 ^= (byte << ((i - 8) * 8)) & _MASK
+        else:
+            k1 ^= (byte << (i * 8)) & _MASK
+    if len(tail) > 8:
+        k2 = (_rotl((k2 * c2) & _MASK, 33) * c1) & _MASK
+        h2 ^= k2
+    if len(tail) > 0:
+        k1 = (_rotl((k1 * c1) & _MASK, 31) * c2) & _MASK
+        h1 ^= k1
+
+    h1 ^= length
+    h2 ^= length
+    h1 = (h1 + h2) & _MASK
+    h2 = (h2 + h1) & _MASK
+    h1 = _fmix(h1)
+    h2 = _fmix(h2)
+    h1 = (h1 + h2) & _MASK
+
+    token = _signed(h1)
+    if token == -(1 << 63): # the minimum token is reserved
+        token = (1 << 63) - 1
+    return token
+
+
+def summary_bounds(summary_path):
+    # (first token, last token) of an sstable. Summary.db holds the index
+    # summary followed by the first and last partition keys:
+    #   int min index interval, int offset count, long summary size,
+    #   int sampling level, int size at full sampling, summary,
+    #   int length + first key, int length + last key
+    # Returns None if the file is missing or not in this format.
+
+    try:
+        with open(summary_path, 'rb') as f:
+            header = f.read(24)
+            if len(header) < 24:
+                return None
+            summary_size = struct.unpack('>iiqii', header)[2]
+            f.seek(24 + summary_size)
+            keys = []
+            for i in range(2):
+                length = struct.unpack('>i', f.read(4))[0]
+                key = f.read(length)
+                if length < 0 or len(key) != length:
+                    return None
+                keys.append(key)
+    except (IOError, OSError, struct.error):
+        return None
+    return murmur3_token(keys[0]), murmur3_token(keys[1])
@@ -4,7 +4,8 @@ import sys
 import subprocess                                                                
 import shutil                                                                    
                                                                                  
-from cass_functions import (get_keyspaces, get_rpc_address)  
+from cass_functions import (get_keyspaces, get_rpc_address, get_session)  
+from profiling import profile
 
 def parse_cmd():
 
@@ -14,6 +15,12 @@ def parse_cmd():
                         nargs='+',
                         help='Specify a keyspace'
     )
+    parser.add_argument('--profile',
+                        required=False,
+                        action='store_true',
+                        help='Write a cProfile profile and subprocess timings ' +
+                             'to .profiles/ (or set SNAPSHOTTER_PROFILE=1)'
+    )
     return parser.parse_args()
 
 
@@ -40,12 +47,12 @@ def write_schema(host, save_path, keyspace=None):
     if not os.path.exists(save_path):
         os.makedirs(save_path)
 
+    # DESCRIBE is a cqlsh command, so this always goes through cqlsh
+    returncode, output = get_session(host).cqlsh(query)
+    if returncode != 0:
+        raise Exception('Failed to describe schema: %s' % query)
     with open(save_path + '/' + filename, 'w') as f:
-        query_process = subprocess.Popen(['echo', query], stdout=subprocess.PIPE)
-        cqlsh = subprocess.Popen(('/bin/cqlsh', host),
-                                  stdin=query_process.stdout, stdout=f)
-        cqlsh.wait()
-        query_process.stdout.close()
+        f.write(output)
 
     return (save_path + '/' + filename)
 
@@ -77,4 +84,5 @@ def save_schema(keyspace_arg=None):
 
 if __name__ == '__main__':
     cmds = parse_cmd()
-    save_schema(cmds.keyspace)
+    with profile(sys.path[0], 'save_schema', cmds.profile):
+        save_schema(cmds.keyspace)
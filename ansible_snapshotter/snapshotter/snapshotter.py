@@ -4,9 +4,20 @@ import argparse
 import subprocess
 import shutil
 import time
+import json
+from multiprocessing.pool import ThreadPool
 
-from cass_functions import (get_data_dir, get_keyspaces, get_dir_structure,
-                            get_rpc_address, cassandra_query, check_host)
+from cass_functions import (get_data_dirs, get_keyspaces, get_dir_structure,
+                            get_rpc_address, check_host, group_by_disk)
+from archive import (FORMATS, CompressionStats, checksum_mismatches,
+                     dir_members, index_checksums, snapshot_members,
+                     write_archive)
+from objects import (OBJECT_MANIFEST, check_digests, object_entry,
+                     read_known_objects)
+from manifest import node_manifest, node_manifest_name, write_manifest
+from throttle import limited_copy, lower_priority, rate_limiter
+from metrics import node_metrics_path, phase, record, start_metrics
+from profiling import profile
 
 def parse_cmd():
 
@@ -21,6 +32,55 @@ def parse_cmd():
                         nargs='+',
                         help='Enter table(s) corresponding to a single keyspace'
     )
+    parser.add_argument('--stage',
+                        required=False,
+                        action='store_true',
+                        help='Copy the snapshot files into .snapshots before ' +
+                             'archiving instead of reading them in place'
+    )
+    parser.add_argument('--format',
+                        required=False,
+                        choices=FORMATS,
+                        default='zip',
+                        help='Archive format of the snapshot file'
+    )
+    parser.add_argument('--known-objects',
+                        required=False,
+                        help='File of object keys already in the backup ' +
+                             'repository; those files are left out of the archive'
+    )
+    parser.add_argument('--upload',
+                        required=False,
+                        help='Upload settings file; the snapshot is uploaded ' +
+                             'straight to S3 instead of being fetched'
+    )
+    parser.add_argument('--read-limit',
+                        required=False,
+                        type=float,
+                        help='Disk read limit in MB/s for copying and archiving'
+    )
+    parser.add_argument('--upload-limit',
+                        required=False,
+                        type=float,
+                        help='Upload limit in MB/s with --upload'
+    )
+    parser.add_argument('--threads',
+                        required=False,
+                        type=int,
+                        default=0,
+                        help='Compression threads for tar.zst (default every core)'
+    )
+    parser.add_argument('--low-priority',
+                        required=False,
+                        action='store_true',
+                        help='Run with lower CPU (nice) and I/O (ionice) priority'
+    )
+    parser.add_argument('--profile',
+                        required=False,
+                        action='store_true',
+                        help='Write a cProfile profile and subprocess timings ' +
+                             'to .profiles/ (or set SNAPSHOTTER_PROFILE=1)'
+    )
     return parser.parse_args()
 
 
@@ -36,13 +96,38 @@ def run_snapshot(title, keyspace=None, table=None):
     subprocess.call(cmd.split())
 
 
-def snapshot(keyspace_arg=None, table_arg=None):
+def copy_snapshot(load_dir, save_table_path, limiter=None):
+
+    # JBOD nodes keep part of each table on every disk, so snapshot files
+    # from several data directories are merged into one table directory
+    if not os.path.isdir(save_table_path):
+        try:
+            os.makedirs(save_table_path)
+        except OSError: # created by another disk's worker
+            pass
+    for f in os.listdir(load_dir):
+        if os.path.isdir(load_dir + '/' + f): # secondary index (.<index>)
+            copy_snapshot(load_dir + '/' + f, save_table_path + f + '/', limiter)
+        elif limiter:
+            limited_copy(load_dir + '/' + f, save_table_path + f, limiter)
+        else:
+            shutil.copy2(load_dir + '/' + f, save_table_path + f)
+
+
+def snapshot(keyspace_arg=None, table_arg=None, stage=False, fmt='zip',
+             known_objects=None, upload=None, limiter=None, threads=0):
+
+    # upload is a (TransferEngine, key prefix) pair; the node then sends its
+    # archive, or in repository mode its new objects, straight to S3.
+    # limiter (a throttle.RateLimiter) paces the disk reads of the copy and
+    # archive stages, threads caps the compression threads.
 
     # nodetool can only run localhost and cqlsh can only run on host argument
     host = get_rpc_address()
     title = host # all local snapshots are named by its ip address or rpc_address
     save_root = sys.path[0] + '/.snapshots/'
 
+    discovery_start = time.time()
     if check_host(host) != 0:
         print('ERROR: Invalid host, check rpc_address in this node\'s yaml file')
         exit(1)
@@ -63,6 +148,7 @@ def snapshot(keyspace_arg=None, table_arg=None):
         print('No keyspace arguments.')
 
     structure = get_dir_structure(host, keyspaces) # basic schema in json format
+    record('discovery', time.time() - discovery_start, start=discovery_start)
     print('Checking table arguments . . .')
     if table_arg:
         if not keyspace_arg or len(keyspace_arg) != 1:
@@ -80,7 +166,8 @@ def snapshot(keyspace_arg=None, table_arg=None):
     print('Valid arguments.\n')
 
     print('Clearing previous cassandra data snapshots . . .')
-    subprocess.call(['nodetool', 'clearsnapshot'])
+    with phase('clearsnapshot'):
+        subprocess.call(['nodetool', 'clearsnapshot'])
     if os.path.isdir(save_root): # remove old snapshots from .snapshot
         for f in os.listdir(save_root):
             if os.path.isdir(save_root + f):
@@ -95,17 +182,20 @@ def snapshot(keyspace_arg=None, table_arg=None):
 
     print('Saving snapshot into %s . . .' % save_path)
     print('Producing snapshots . . .')
-    if keyspace_arg:
-        if table_arg:
-            ks = next(iter(keyspaces))
-            for table in tables:
-                run_snapshot(title, ks, table)
+    with phase('nodetool_snapshot'):
+        if keyspace_arg:
+            if table_arg:
+                ks = next(iter(keyspaces))
+                for table in tables:
+                    run_snapshot(title, ks, table)
+            else:
+                run_snapshot(title, ' '.join(keyspaces))
         else:
-            run_snapshot(title, ' '.join(keyspaces))
-    else:
-        run_snapshot(title)
+            run_snapshot(title)
 
-    cassandra_data_dir = get_data_dir()
+    # one (load_dir, save_table_path) list per physical disk
+    disks = group_by_disk(get_data_dirs())
+    disk_copies = [[] for disk in disks]
     for ks in keyspaces:
         if not table_arg:
             tables = structure[ks]
@@ -114,25 +204,153 @@ def snapshot(keyspace_arg=None, table_arg=None):
                           % dict(save_path = save_path,
                                  keyspace  = ks,
                                  table     = tb)
-            load_dir = '%(data_dir)s/%(keyspace)s/%(table_dir)s/snapshots/%(ss_title)s' \
-                   % dict(data_dir  = cassandra_data_dir,
-                          keyspace  = ks,
-                          table_dir = structure[ks][tb],
-                          ss_title  = title)
-            print('Storing %s in %s' % (tb, save_table_path))
-            shutil.copytree(load_dir, save_table_path)
+            found = False
+            for idx, disk in enumerate(disks):
+                for data_dir in disk:
+                    load_dir = '%(data_dir)s/%(keyspace)s/%(table_dir)s/snapshots/%(ss_title)s' \
+                           % dict(data_dir  = data_dir,
+                                  keyspace  = ks,
+                                  table_dir = structure[ks][tb],
+                                  ss_title  = title)
+                    if os.path.isdir(load_dir):
+                        disk_copies[idx].append((load_dir, save_table_path))
+                        found = True
+            if not found:
+                print('No snapshot files found for %s.%s' % (ks, tb))
+
+    if stage:
+        def copy_disk(copies):
+            for load_dir, save_table_path in copies:
+                print('Storing %s in %s' % (load_dir, save_table_path))
+                copy_snapshot(load_dir, save_table_path, limiter)
+
+        print('Copying snapshots from %i disk(s) . . .' % len(disks))
+        with phase('copy', disks=len(disks)) as counts:
+            pool = ThreadPool(max(len(disks), 1))
+            try:
+                pool.map(copy_disk, disk_copies)
+            finally:
+                pool.close()
+                pool.join()
+            members = dir_members(save_path)
+            counts['files'] = len(members)
+            counts['bytes'] = sum(os.path.getsize(path) for path, arcname in members)
+    else:
+        # snapshot directories are immutable hardlinks, so they are archived
+        # in place instead of being copied first
+        snapshot_dirs = []
+        for copies in disk_copies:
+            for load_dir, save_table_path in copies:
+                snapshot_dirs.append((load_dir,
+                                      os.path.relpath(save_table_path, save_path)))
+        members = snapshot_members(snapshot_dirs)
 
     print('Compressing snapshot file')
-    shutil.make_archive(save_path, 'zip', save_path)
+    if not os.path.isdir(save_root):
+        os.makedirs(save_root)
+    extra = []
+    if known_objects is not None:
+        # repository mode: only files missing from the repository are
+        # archived, and every file is listed in the object manifest
+        entries = [object_entry(host, path, arcname) for path, arcname in members]
+        new_members = []
+        new_keys = []
+        new_bytes = 0
+        for member, entry in zip(members, entries):
+            entry['new'] = entry['key'] not in known_objects
+            if entry['new']:
+                new_members.append(member)
+                new_keys.append(entry['key'])
+                new_bytes += entry['size']
+        print('%i of %i files (%i bytes) are not in the repository yet'
+              % (len(new_members), len(members), new_bytes))
+        members = new_members
+
+        if upload:
+            # every new file becomes its own repository object; only the
+            # object manifest is left for the controller to fetch
+            transfer, prefix = upload
+            print('Uploading %i objects . . .' % len(members))
+            with phase('upload', new_bytes, len(members)):
+                result = transfer.upload_files([(member[0], prefix + key) for
+                                                member, key in zip(members, new_keys)])
+            print(transfer.report(result))
+            manifest_path = save_path + '.' + OBJECT_MANIFEST
+            with open(manifest_path, 'w') as f:
+                json.dump(entries, f)
+            print('\nProcess complete. Object manifest stored in %s\n'
+                  % manifest_path)
+            return
+        extra.append((OBJECT_MANIFEST, json.dumps(entries).encode('utf-8')))
 
-    print('\nProcess complete. Snapshot stored in %s\n' % save_path)
+    stats = CompressionStats()
+    index = []
+    with phase('archive', sum(os.path.getsize(path) for path, arcname in members),
+               len(members), format=fmt) as counts:
+        archive_path = write_archive(save_path + '.' + fmt, members, fmt, threads,
+                                     stats=stats, extra=extra, index=index,
+                                     limiter=limiter)
+        counts['archive_bytes'] = os.path.getsize(archive_path)
+    if fmt == 'zip':
+        print(stats.report())
+
+    # every file's crc32 was computed as it went into the archive; Data.db
+    # files are checked against the digests Cassandra wrote for them
+    checksums = index_checksums(index)
+    checked, mismatched = check_digests(
+            checksums, dict((arcname, path) for path, arcname in members))
+    if known_objects is not None:
+        mismatched = sorted(set(mismatched) |
+                            set(checksum_mismatches(checksums, entries)))
+    if mismatched:
+        print('ERROR: Checksum mismatch for %s' % ', '.join(mismatched))
+        exit(1)
+    print('Verified %i sstables against their Digest.crc32' % checked)
+    write_manifest(save_root + node_manifest_name(title),
+                   node_manifest(os.path.basename(archive_path), index))
+
+    if upload:
+        transfer, prefix = upload
+        key = prefix + os.path.basename(archive_path)
+        print('Uploading snapshot as %s . . .' % key)
+        with phase('upload', os.path.getsize(archive_path), 1):
+            transfer.upload_file(archive_path, key)
+        print(transfer.report())
+        os.remove(archive_path)
+        print('\nProcess complete. Snapshot uploaded as %s\n' % key)
+        return
+
+    print('\nProcess complete. Snapshot stored in %s\n' % archive_path)
 
 
 if __name__ == '__main__':
     cmds = parse_cmd()
+    if cmds.low_priority:
+        lower_priority()
+    start_metrics(node_metrics_path(sys.path[0], 'snapshot'), get_rpc_address(),
+                  'snapshot')
+
+    known_objects = None
+    if cmds.known_objects:
+        known_path = cmds.known_objects
+        if not os.path.isabs(known_path):
+            known_path = sys.path[0] + '/' + known_path
+        known_objects = read_known_objects(known_path)
+
+    upload = None
+    if cmds.upload:
+        # boto3 is only needed on nodes that upload their own snapshots
+        from transfer import upload_target
+        upload_path = cmds.upload
+        if not os.path.isabs(upload_path):
+            upload_path = sys.path[0] + '/' + upload_path
+        upload = upload_target(upload_path)
+        upload[0].limiter = rate_limiter(cmds.upload_limit)
 
     start = time.time()
-    snapshot(cmds.keyspace, cmds.table)
+    with profile(sys.path[0], 'snapshotter', cmds.profile):
+        snapshot(cmds.keyspace, cmds.table, cmds.stage, cmds.format, known_objects,
+                 upload, rate_limiter(cmds.read_limit), cmds.threads)
     end = time.time()
 
     print('Elapsed time: %s' % (end - start))
@@ -0,0 +1,65 @@
+import os
+import time
+import threading
+import subprocess
+
+# Keeps snapshots from crowding out a node's traffic: rate limits for disk
+# reads and uploads, and lower CPU and I/O priority for the whole process
+# (compressor subprocesses and threads inherit it).
+
+_MB = 1024 * 1024
+_NICENESS = 10
+
+
+class RateLimiter(object):
+    # Token bucket shared by every thread doing one kind of I/O. consume(n)
+    # sleeps as long as needed to keep the total at rate bytes per second,
+    # allowing bursts of up to one second.
+
+    def __init__(self, rate):
+
+        self.rate = float(rate)
+        self._allowance = self.rate
+        self._last = time.time()
+        self._lock = threading.Lock()
+
+    def consume(self, size):
+
+        with self._lock:
+            now = time.time()
+            self._allowance = min(self.rate, self._allowance +
+                                  (now - self._last) * self.rate)
+            self._last = now
+            self._allowance -= size
+            wait = -self._allowance / self.rate
+        if wait > 0:
+            time.sleep(wait)
+
+
+def rate_limiter(mb_per_second):
+    # RateLimiter for a limit in MB/s; None (no limit) for 0 or None
+    return RateLimiter(mb_per_second * _MB) if mb_per_second else None
+
+
+def limited_copy(src, dest, limiter, chunk_size=_MB):
+    # shutil.copy2 with the reads paced by limiter
+
+    with open(src, 'rb') as fin:
+        with open(dest, 'wb') as fout:
+            for block in iter(lambda: fin.read(chunk_size), b''):
+                limiter.consume(len(block))
+                fout.write(block)
+    stat = os.stat(src)
+    os.chmod(dest, stat.st_mode & 0o777)
+    os.utime(dest, (stat.st_atime, stat.st_mtime))
+
+
+def lower_priority():
+    # Lowest best-effort I/O class and a higher niceness for this process;
+    # the idle I/O class is not used, it can stall a snapshot on a busy disk
+
+    os.nice(_NICENESS)
+    try:
+        subprocess.call(['ionice', '-c', '2', '-n', '7', '-p', str(os.getpid())])
+    except OSError:
+        print('ionice not found, only the CPU priority was lowered')
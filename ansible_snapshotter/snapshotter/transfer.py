@@ -0,0 +1,277 @@
+import os
+import time
+import threading
+from multiprocessing.pool import ThreadPool
+try:
+    from ConfigParser import ConfigParser
+except:
+    from configparser import ConfigParser # python3
+
+import boto3
+import botocore
+import botocore.config
+from boto3.s3.transfer import TransferConfig
+
+_MB = 1024 * 1024
+
+# defaults for the [s3-transfer] section of config.ini
+DEFAULT_PART_SIZE = 64 # MB
+DEFAULT_MAX_PARTS = 10 # concurrent parts per object
+DEFAULT_MAX_OBJECTS = 4 # concurrent objects
+
+
+def get_s3_bucket(s3_access_key, s3_secret_key, s3_region, s3_bucket,
+                  endpoint=None, pool_size=10):
+
+    # bucket.upload_file('path', 'key')
+    # bucket.download_file('key', 'path')
+    # the endpoint points at S3 compatible stores such as MinIO
+    s3 = boto3.resource(
+        's3',
+        aws_access_key_id=s3_access_key,
+        aws_secret_access_key=s3_secret_key,
+        region_name=s3_region,
+        endpoint_url=endpoint or None,
+        config=botocore.config.Config(max_pool_connections=pool_size)
+    )
+    bucket = s3.Bucket(s3_bucket)
+    
+    try:
+        s3.meta.client.head_bucket(Bucket=s3_bucket)
+    except botocore.exceptions.ClientError as e:
+        error_code = int(e.response['Error']['Code'])
+        if error_code == 404:
+            raise Exception('Bucket does not exist')
+        else:
+            raise e
+
+    return bucket
+
+
+def get_transfer_settings(config):
+
+    # the [s3-transfer] section of config.ini is optional
+    settings = {
+        'part_size': DEFAULT_PART_SIZE,
+        'max_parts': DEFAULT_MAX_PARTS,
+        'max_objects': DEFAULT_MAX_OBJECTS
+    }
+    if config.has_section('s3-transfer'):
+        for option in settings:
+            if (config.has_option('s3-transfer', option) and
+                    config.get('s3-transfer', option)):
+                settings[option] = config.getint('s3-transfer', option)
+    return settings
+
+
+def config_bucket(config):
+
+    # bucket from the [s3-aws-info] section of a config.ini
+    bucket = config.get('s3-aws-info', 'bucket')
+    region = config.get('s3-aws-info', 'region')
+    account = config.get('s3-aws-info', 'account')
+    password = config.get('s3-aws-info', 'password')
+    if not(bucket and region and account and password):
+        raise Exception('AWS arguments in config.ini not specified')
+    endpoint = None
+    if config.has_option('s3-aws-info', 'endpoint'):
+        endpoint = config.get('s3-aws-info', 'endpoint')
+
+    # one pooled connection for every part that can be in flight
+    settings = get_transfer_settings(config)
+    pool_size = settings['max_parts'] * settings['max_objects']
+    return get_s3_bucket(account, password, region, bucket, endpoint,
+                         pool_size)
+
+
+class TransferEngine(object):
+    # Moves files between the controller and an S3 bucket. Objects larger
+    # than part_size go up and down as multipart transfers with max_parts
+    # concurrent parts, and up to max_objects objects move at once, all over
+    # the bucket's one pooled client (see utils.get_s3_bucket).
+
+    def __init__(self, bucket, part_size=DEFAULT_PART_SIZE,
+                 max_parts=DEFAULT_MAX_PARTS, max_objects=DEFAULT_MAX_OBJECTS,
+                 limiter=None):
+
+        self.bucket = bucket
+        self.client = bucket.meta.client
+        self.part_size = part_size * _MB
+        self.max_parts = max_parts
+        self.max_objects = max_objects
+        self.limiter = limiter # throttle.RateLimiter pacing uploads
+        self.config = TransferConfig(multipart_threshold=part_size * _MB,
+                                     multipart_chunksize=part_size * _MB,
+                                     max_concurrency=max_parts,
+                                     use_threads=True)
+        self._lock = threading.Lock()
+        self.bytes = 0
+        self.objects = 0
+        self.seconds = 0.0
+
+    def _record(self, size, start):
+
+        with self._lock:
+            self.bytes += size
+            self.objects += 1
+            self.seconds += time.time() - start
+
+    def upload_file(self, path, key):
+
+        start = time.time()
+        # the callback runs in the thread reading each part, so sleeping in
+        # it paces the upload
+        self.client.upload_file(path, self.bucket.name, key, Config=self.config,
+                                Callback=self.limiter.consume if self.limiter
+                                         else None)
+        self._record(os.path.getsize(path), start)
+
+    def download_file(self, key, path):
+
+        start = time.time()
+        self.client.download_file(self.bucket.name, key, path, Config=self.config)
+        self._record(os.path.getsize(path), start)
+
+    def get_range(self, key, start, length):
+        # length bytes of an object from start, with one ranged GET
+
+        begin = time.time()
+        data = self.client.get_object(
+                Bucket=self.bucket.name, Key=key,
+                Range='bytes=%i-%i' % (start, start + length - 1))['Body'].read()
+        self._record(len(data), begin)
+        return data
+
+    def download_range(self, key, start, length, path):
+        # Writes length bytes of an object from start into path, in
+        # part_size ranged GETs with max_parts at once
+
+        parts = [(offset, min(self.part_size, length - offset))
+                 for offset in range(0, length, self.part_size)]
+        lock = threading.Lock()
+        with open(path, 'wb') as f:
+            def part(offset_length):
+                offset, size = offset_length
+                data = self.get_range(key, start + offset, size)
+                with lock:
+                    f.seek(offset)
+                    f.write(data)
+            if len(parts) == 1:
+                part(parts[0])
+            elif parts:
+                pool = ThreadPool(max(min(self.max_parts, len(parts)), 1))
+                try:
+                    pool.map(part, parts)
+                finally:
+                    pool.close()
+                    pool.join()
+
+    def reader(self, key, start=0, length=None):
+        return RangeReader(self, key, start, length)
+
+    def _run(self, func, pairs):
+        # Runs func on every (a, b) pair with max_objects transfers at once
+        # and returns (bytes moved, wall time)
+
+        start = time.time()
+        start_bytes = self.bytes
+        pool = ThreadPool(max(min(self.max_objects, len(pairs)), 1))
+        try:
+            pool.map(lambda pair: func(*pair), pairs)
+        finally:
+            pool.close()
+            pool.join()
+        return self.bytes - start_bytes, time.time() - start
+
+    def upload_files(self, pairs):
+        # pairs of (path, key)
+        return self._run(self.upload_file, pairs)
+
+    def download_files(self, pairs):
+        # pairs of (key, path)
+        return self._run(self.download_file, pairs)
+
+    def download_ranges(self, ranges):
+        # tuples of (key, start, length, path)
+        return self._run(self.download_range, ranges)
+
+    def report(self, result=None):
+        # Throughput of one upload_files/download_files result, or of every
+        # transfer so far (per-transfer times overlap when run in parallel)
+
+        if result is None:
+            transferred, elapsed = self.bytes, self.seconds
+        else:
+            transferred, elapsed = result
+        rate = transferred / elapsed / _MB if elapsed else 0.0
+        return 'Transferred %i bytes in %.2f seconds (%.2f MB/s)' % (
+                    transferred, elapsed, rate)
+
+
+class RangeReader(object):
+    # Read-only, seekable file over length bytes of an object from start.
+    # What is read is fetched with ranged GETs, so zipfile and tarfile can
+    # read an archive's index without the archive being downloaded. Reads
+    # are rounded up to block bytes and the last block is kept.
+
+    def __init__(self, engine, key, start=0, length=None, block=16 * 1024):
+
+        self.engine = engine
+        self.key = key
+        self.start = start
+        if length is None:
+            length = engine.client.head_object(Bucket=engine.bucket.name,
+                                               Key=key)['ContentLength'] - start
+        self.length = length
+        self.block = block
+        self.position = 0
+        self._cached_start = 0
+        self._cached = b''
+
+    def seekable(self):
+        return True
+
+    def readable(self):
+        return True
+
+    def tell(self):
+        return self.position
+
+    def seek(self, offset, whence=0):
+
+        if whence == 1:
+            offset += self.position
+        elif whence == 2:
+            offset += self.length
+        self.position = max(offset, 0)
+        return self.position
+
+    def read(self, size=-1):
+
+        if size is None or size < 0:
+            size = self.length - self.position
+        size = min(size, self.length - self.position)
+        if size <= 0:
+            return b''
+        end = self.position + size
+        if not (self._cached_start <= self.position and
+                end <= self._cached_start + len(self._cached)):
+            self._cached = self.engine.get_range(
+                    self.key, self.start + self.position,
+                    min(max(size, self.block), self.length - self.position))
+            self._cached_start = self.position
+        data = self._cached[self.position - self._cached_start:
+                            end - self._cached_start]
+        self.position = end
+        return data
+
+
+def upload_target(path):
+
+    # (TransferEngine, key prefix) from the upload settings the controller
+    # copies to the nodes for --direct (see utils.write_upload_config)
+    config = ConfigParser()
+    if len(config.read(path)) == 0:
+        raise Exception('Cannot read upload settings %s' % path)
+    engine = TransferEngine(config_bucket(config), **get_transfer_settings(config))
+    return engine, config.get('upload', 'prefix')
@@ -0,0 +1,168 @@
+import os
+import sys
+import shutil
+import tempfile
+import unittest
+import zipfile
+
+try:
+    from moto import mock_aws as s3_mock # in-process S3 stand-in
+except ImportError:
+    try:
+        from moto import mock_s3 as s3_mock # moto < 5
+    except ImportError:
+        s3_mock = None
+
+# the controller imports the node modules as snapshotter.<module>
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+_BUCKET = 'cassandra-snapshotter-test'
+_PART_SIZE = 5 # MB, the smallest part S3 accepts
+_SIZE = 12 * 1024 * 1024 + 12345 # three parts, the last one short
+
+
+@unittest.skipIf(s3_mock is None, 'moto is not installed')
+class TransferEngineTest(unittest.TestCase):
+    # Multipart upload, full download and ranged reads against moto's S3
+
+    def setUp(self):
+
+        import boto3
+        from snapshotter.transfer import TransferEngine, get_s3_bucket
+
+        self.mock = s3_mock()
+        self.mock.start()
+        for var in ('AWS_ACCESS_KEY_ID', 'AWS_SECRET_ACCESS_KEY'):
+            os.environ.setdefault(var, 'testing')
+        boto3.resource('s3', region_name='us-east-1').create_bucket(Bucket=_BUCKET)
+        bucket = get_s3_bucket('testing', 'testing', 'us-east-1', _BUCKET)
+        self.engine = TransferEngine(bucket, part_size=_PART_SIZE, max_parts=3,
+                                     max_objects=2)
+
+        self.temp = tempfile.mkdtemp()
+        self.data = os.urandom(_SIZE)
+        self.path = self.temp + '/node.tar'
+        with open(self.path, 'wb') as f:
+            f.write(self.data)
+        self.engine.upload_file(self.path, 'snapshots/node.tar')
+
+    def tearDown(self):
+
+        shutil.rmtree(self.temp)
+        self.mock.stop()
+
+    def test_multipart_upload(self):
+
+        head = self.engine.client.head_object(Bucket=_BUCKET, Key='snapshots/node.tar')
+        self.assertEqual(head['ContentLength'], _SIZE)
+        self.assertTrue(head['ETag'].strip('"').endswith('-3')) # three parts
+
+    def test_download_file(self):
+
+        path = self.temp + '/download.tar'
+        self.engine.download_file('snapshots/node.tar', path)
+        with open(path, 'rb') as f:
+            self.assertEqual(f.read(), self.data)
+
+    def test_download_range(self):
+        # spans all three parts, fetched as concurrent ranged GETs
+
+        start, length = 1000, 11 * 1024 * 1024
+        path = self.temp + '/range.tar'
+        self.engine.download_range('snapshots/node.tar', start, length, path)
+        with open(path, 'rb') as f:
+            self.assertEqual(f.read(), self.data[start:start + length])
+
+    def test_range_reader(self):
+
+        start = 5 * 1024 * 1024 - 100 # across a part boundary
+        reader = self.engine.reader('snapshots/node.tar', start)
+        self.assertEqual(reader.length, _SIZE - start)
+        self.assertEqual(reader.read(300), self.data[start:start + 300])
+        reader.seek(-50, 2)
+        self.assertEqual(reader.read(), self.data[-50:])
+        reader.seek(10)
+        self.assertEqual(reader.read(20000), self.data[start + 10:start + 20010])
+        self.assertEqual(reader.read(0), b'')
+
+
+def _node_zip(path, files):
+    # a node archive of {name: data}
+
+    with zipfile.ZipFile(path, 'w', zipfile.ZIP_STORED) as z:
+        for name, data in sorted(files.items()):
+            z.writestr(name, data)
+
+
+@unittest.skipIf(s3_mock is None, 'moto is not installed')
+class S3ExtractTest(unittest.TestCase):
+    # Restores from zip bundles whose node archives were deflated inside the
+    # bundle, as bundles made before node archives were stored are
+
+    def setUp(self):
+
+        import boto3
+        from snapshotter.transfer import TransferEngine, get_s3_bucket
+
+        self.mock = s3_mock()
+        self.mock.start()
+        for var in ('AWS_ACCESS_KEY_ID', 'AWS_SECRET_ACCESS_KEY'):
+            os.environ.setdefault(var, 'testing')
+        boto3.resource('s3', region_name='us-east-1').create_bucket(Bucket=_BUCKET)
+        bucket = get_s3_bucket('testing', 'testing', 'us-east-1', _BUCKET)
+        self.engine = TransferEngine(bucket, part_size=_PART_SIZE)
+
+        self.temp = tempfile.mkdtemp()
+        self.files = {
+            'ks1/t1/mc-1-big-Data.db': b'a' * 4096,
+            'ks1/t1/manifest.json': b'{}',
+            'ks2/t2/mc-2-big-Data.db': b'b' * 4096
+        }
+        _node_zip(self.temp + '/10.0.0.1.zip', self.files)
+        with zipfile.ZipFile(self.temp + '/bundle.zip', 'w',
+                             zipfile.ZIP_DEFLATED) as z:
+            z.write(self.temp + '/10.0.0.1.zip', '10.0.0.1.zip')
+            z.writestr('ring_info.txt', '10.0.0.1 0\n')
+        self.engine.upload_file(self.temp + '/bundle.zip', 'cassandra-snapshot-test.zip')
+        self.dest = self.temp + '/restore'
+        os.makedirs(self.dest)
+
+    def tearDown(self):
+
+        shutil.rmtree(self.temp)
+        self.mock.stop()
+
+    def read_node_zip(self):
+
+        from snapshotter.archive import ArchiveReader
+
+        path = self.dest + '/10.0.0.1.zip'
+        self.assertTrue(zipfile.is_zipfile(path))
+        reader = ArchiveReader(path)
+        return dict((name, reader.read(name)) for name in reader.names())
+
+    def test_extract(self):
+
+        from utils import s3_extract_snapshot
+
+        s3_extract_snapshot(self.engine, 'cassandra-snapshot-test.zip', self.dest)
+        with open(self.temp + '/10.0.0.1.zip', 'rb') as f:
+            with open(self.dest + '/10.0.0.1.zip', 'rb') as restored:
+                self.assertEqual(restored.read(), f.read())
+        with open(self.dest + '/ring_info.txt', 'r') as f:
+            self.assertEqual(f.read(), '10.0.0.1 0\n')
+
+    def test_extract_selected(self):
+
+        from utils import s3_extract_snapshot
+        from snapshotter.archive import member_filter
+
+        s3_extract_snapshot(self.engine, 'cassandra-snapshot-test.zip', self.dest,
+                            select=member_filter(['ks1']))
+        self.assertEqual(self.read_node_zip(),
+                         dict((name, data) for name, data in self.files.items()
+                              if name.startswith('ks1/')))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -1,9 +1,11 @@
 import argparse
 import os
+import sys
 import subprocess
 import json
 import shutil
 import zipfile
+import zlib
 import re
 
 try:
@@ -11,18 +13,30 @@ try:
 except:
     from configparser import ConfigParser # python3
 
-import boto3
-import botocore
+from executor import run_executor
+from catalog import SnapshotCatalog
+from snapshotter.transfer import (TransferEngine, config_bucket, get_s3_bucket,
+                                  get_transfer_settings)
+from snapshotter.archive import (ArchiveReader, FileRange, checksum_mismatches,
+                                 copy_range, dir_members, filter_archive,
+                                 index_checksums, inflate_file, is_archive,
+                                 member_ranges, split_format, write_archive)
+from snapshotter.manifest import MANIFEST_FILE, read_manifest
+from snapshotter.metrics import (metrics_report, read_metrics, report_table,
+                                 start_metrics, write_prometheus)
 
 
 # Ansible Functions
-def run_playbook(play, args):
-    # pass args as a dict
+def run_playbook(play, args, executor='ansible', fan_out=None):
+    # pass args as a dict; the ssh and local executors run the playbook's
+    # stages without ansible-playbook (see executor.py)
     
     if not play.endswith('.yml'):
         play += '.yml'
     if not os.path.isfile(play):
         raise Exception('File does not exist: %s' % play)
+    if executor != 'ansible':
+        return run_executor(play, args, executor, fan_out)
 
     cmd = ['ansible-playbook', play]
     
@@ -34,56 +48,177 @@ def run_playbook(play, args):
 
 
 # AWS S3 Functions
-def get_s3_bucket(s3_access_key, s3_secret_key, s3_region, s3_bucket):
-
-    # bucket.upload_file('path', 'key')
-    # bucket.download_file('key', 'path')
-    s3 = boto3.resource(
-        's3',
-        aws_access_key_id=s3_access_key,
-        aws_secret_access_key=s3_secret_key,
-        region_name=s3_region
-    )
-    bucket = s3.Bucket(s3_bucket)
-    
-    try:
-        s3.meta.client.head_bucket(Bucket=s3_bucket)
-    except botocore.exceptions.ClientError as e:
-        error_code = int(e.response['Error']['Code'])
-        if error_code == 404:
-            raise Exception('Bucket does not exist')
-        else:
-            raise e
-
-    return bucket
-
-
 def s3_bucket():
     
     config = ConfigParser()
     if len(config.read('config.ini')) == 0:
         raise Exception('ERROR: Cannot find config.ini in script directory')
-    bucket = config.get('s3-aws-info', 'bucket')
-    region = config.get('s3-aws-info', 'region')
-    account = config.get('s3-aws-info', 'account')
-    password = config.get('s3-aws-info', 'password')
-    if not(bucket and region and account and password):
-        raise Exception('AWS arguments in config.ini not specified')
     try:
-        return get_s3_bucket(account, password, region, bucket)
+        return config_bucket(config)
     except ValueError as e:
         print('ERROR: Invalid config.ini options')
         raise e
 
 
-def s3_list_snapshots(s3_bucket):
-    options = []
-    for obj in s3_bucket.objects.all():
-        match = re.match('cassandra-snapshot-[^\s]*', obj.key)
-        if match:
-            options.append(obj.key)
-    return options
-            
+def s3_transfer(s3_bucket):
+
+    config = ConfigParser()
+    config.read('config.ini')
+    return TransferEngine(s3_bucket, **get_transfer_settings(config))
+
+
+def write_upload_config(path, prefix):
+
+    # S3 settings for nodes that upload their own snapshots (--direct);
+    # the file holds the AWS keys, so only its owner can read it
+    config = ConfigParser()
+    if len(config.read('config.ini')) == 0:
+        raise Exception('ERROR: Cannot find config.ini in script directory')
+    upload = ConfigParser()
+    for section in ('s3-aws-info', 's3-transfer'):
+        if config.has_section(section):
+            upload.add_section(section)
+            for option, value in config.items(section):
+                upload.set(section, option, value)
+    upload.add_section('upload')
+    upload.set('upload', 'prefix', prefix)
+
+    fd = os.open(path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+    with os.fdopen(fd, 'w') as f:
+        upload.write(f)
+
+
+def s3_catalog(s3_bucket):
+
+    # snapshot listing of the bucket, cached on the Ansible host
+    return SnapshotCatalog(s3_bucket, sys.path[0] + '/.cache/s3_catalog.json')
+
+
+def s3_extract_snapshot(transfer, key, dest, hosts=None, select=None):
+
+    # extracts a snapshot bundle stored in S3 without downloading all of
+    # it: the bundle's index is read with small ranged GETs, and its members
+    # are fetched as byte ranges of the bundle
+    members = [(name, key, offset, length, compression) for
+               name, offset, length, compression in
+               member_ranges(transfer.reader(key))]
+    return _s3_extract(transfer, members, dest, hosts, select)
+
+
+def s3_extract_prefix(transfer, prefix, dest, hosts=None, select=None):
+
+    # extracts a snapshot uploaded by the nodes (--direct), whose archives,
+    # schemas.zip and ring_info.txt are separate objects under prefix
+    members = [(obj.key[len(prefix):], obj.key, 0, obj.size, None) for
+               obj in transfer.bucket.objects.filter(Prefix=prefix)]
+    return _s3_extract(transfer, members, dest, hosts, select)
+
+
+def _s3_extract(transfer, members, dest, hosts=None, select=None):
+
+    # members are (name, key, offset, length, compression) byte ranges.
+    # Only the node archives of the given hosts are fetched, in parallel
+    # ranges; with select, zip and plain tar node archives are read by
+    # range as well and only the members select keeps are fetched. Node
+    # archives deflated inside the bundle (zip bundles made before node
+    # archives were stored) are fetched whole, inflated and then filtered.
+    nodes = [m for m in members if is_node_archive(m[0])]
+    snapshot_hosts = set(split_format(m[0])[0] for m in nodes)
+    if hosts and snapshot_hosts & set(hosts): # not inventory group names
+        nodes = [m for m in nodes if split_format(m[0])[0] in hosts]
+
+    _s3_get_ranges(transfer, [(key, offset, length, dest + '/' + name, compression)
+                              for name, key, offset, length, compression in members
+                              if not is_node_archive(name)])
+    manifest = None
+    if os.path.isfile(dest + '/' + MANIFEST_FILE):
+        manifest = read_manifest(dest + '/' + MANIFEST_FILE)
+
+    ranges = [] # (key, start, length, path, compression)
+    filtered = []
+    whole = [] # fetched whole, filtered once extracted
+    for name, key, offset, length, compression in nodes:
+        node, fmt = split_format(name)
+        if select is None or fmt not in ('zip', 'tar') or compression:
+            # compressed tar streams cannot be read by range, nor can
+            # deflated node archives
+            ranges.append((key, offset, length, dest + '/' + name, compression))
+            if select is not None:
+                whole.append(name)
+            continue
+        node_path = dest + '/' + name + '.select'
+        node_ranges = member_ranges(transfer.reader(key, offset, length), select,
+                                    _manifest_offsets(manifest, name, select))
+        print('Selecting %i files from %s' % (len(node_ranges), name))
+        for member, member_offset, member_length, member_compression in node_ranges:
+            ranges.append((key, offset + member_offset, member_length,
+                           node_path + '/' + member, member_compression))
+        filtered.append((name, node_path, fmt))
+    print('Retrieving %i ranges' % len(ranges))
+    print(transfer.report(_s3_get_ranges(transfer, ranges)))
+
+    for name, node_path, fmt in filtered:
+        _archive_selected(dest + '/' + name, node_path, fmt, manifest)
+    for name in whole:
+        print('Selecting %i files from %s' %
+              (len(filter_archive(dest + '/' + name, select)), name))
+    return [m[0] for m in nodes]
+
+
+def _manifest_offsets(manifest, name, select):
+    # header offsets of the selected members of a plain tar node archive,
+    # from the snapshot manifest; None when they are not recorded
+
+    node, fmt = split_format(name)
+    if fmt != 'tar' or not manifest or node not in manifest['nodes']:
+        return None
+    return [entry['offset'] for entry in manifest['nodes'][node]['files']
+            if select(entry['name'])]
+
+
+def _archive_selected(path, node_path, fmt, manifest=None):
+    # archives the selected members of a node archive, fetched into
+    # node_path, as path; they are checked against the manifest as they are
+    # archived again
+
+    index = []
+    write_archive(path, dir_members(node_path), fmt, index=index)
+    shutil.rmtree(node_path, True)
+    name = os.path.basename(path)
+    node = split_format(name)[0]
+    if manifest and node in manifest['nodes']:
+        mismatched = checksum_mismatches(index_checksums(index),
+                                         manifest['nodes'][node]['files'])
+        if mismatched:
+            raise Exception('Checksum mismatch in %s: %s'
+                            % (name, ', '.join(mismatched)))
+
+
+def s3_read_member(transfer, key, name):
+
+    # one member of a snapshot bundle stored in S3, read by range
+    for member, offset, length, compression in member_ranges(transfer.reader(key)):
+        if member == name:
+            data = transfer.get_range(key, offset, length) if length else b''
+            return zlib.decompress(data, -zlib.MAX_WBITS) if compression else data
+    raise KeyError(name)
+
+
+def _s3_get_ranges(transfer, ranges):
+
+    # deflated zip members are fetched as they are stored, then inflated
+    for key, start, length, path, compression in ranges:
+        if not os.path.isdir(os.path.dirname(path)):
+            os.makedirs(os.path.dirname(path))
+    result = transfer.download_ranges(
+        [(key, start, length, path + '.deflate' if compression else path)
+         for key, start, length, path, compression in ranges])
+    for key, start, length, path, compression in ranges:
+        if compression:
+            inflate_file(path + '.deflate', path)
+            os.remove(path + '.deflate')
+    return result
+
 
 def s3_delete_object(s3_bucket, key):
     
@@ -112,10 +247,10 @@ def check_file(f):
     if not os.path.isfile(f):
         raise argparse.ArgumentTypeError('File does not exist')
     if os.access(f, os.R_OK):
-        if zipfile.is_zipfile(f):
+        if is_archive(f):
             return f
         else:
-            raise argparse.ArgumentTypeError('File is not a zip file')
+            raise argparse.ArgumentTypeError('File is not a snapshot archive')
     else:
         raise argparse.ArgumentTypeError('File is not readable')
 
@@ -128,10 +263,88 @@ def zip_dir(root_path, save_path, title): # use shutil.make_archive in python2.7
     for root, dirs, files in os.walk(root_path):
         for f in files:
             filename = os.path.join(root_path, f)
-            z.write(filename, filename[rootlength:])
+            # node archives are already compressed
+            if split_format(f)[1]:
+                compression = zipfile.ZIP_STORED
+            else:
+                compression = zipfile.ZIP_DEFLATED
+            z.write(filename, filename[rootlength:], compression)
     z.close()
 
 
+def bundle_dir(root_path, save_path, title, fmt='zip'):
+
+    # bundles the fetched node archives; tar node archives are already
+    # compressed, so they are bundled into a plain tar, with the manifest
+    # first so listing a snapshot only reads the start of the bundle
+    if fmt == 'zip':
+        zip_dir(root_path, save_path, title)
+        return save_path + '/' + title + '.zip'
+    members = sorted(dir_members(root_path),
+                     key=lambda member: member[1] != MANIFEST_FILE)
+    return write_archive(save_path + '/' + title + '.tar', members, 'tar')
+
+
+def is_node_archive(name):
+    # node archives are saved as <host>.<format> next to schemas.zip
+    return name != 'schemas.zip' and bool(split_format(name)[1])
+
+
+def extract_snapshot(path, dest, select=None):
+
+    # extracts a snapshot bundle; with select, each node archive is cut down
+    # as soon as it is extracted, so only one whole node archive is on disk
+    # at a time. Zip and plain tar bundles are read by range instead.
+    reader = ArchiveReader(path)
+    if select is None:
+        return reader.extractall(dest)
+    if reader.format in ('zip', 'tar'):
+        return _extract_selected(reader, dest, select)
+    names = reader.names()
+    for name in names:
+        reader.extract(dest, lambda member: member == name)
+        if is_node_archive(name):
+            print('Selecting %i files from %s' %
+                  (len(filter_archive(dest + '/' + name, select)), name))
+    return names
+
+
+def _extract_selected(reader, dest, select):
+
+    # the selected members of zip and plain tar node archives stored in the
+    # bundle are copied straight out of it, so no whole node archive is
+    # written or re-encoded; other node archives (tar.zst and tar.lz4, or
+    # deflated inside the bundle) are extracted and filtered
+    with open(reader.path, 'rb') as bundle:
+        members = member_ranges(bundle)
+    ranged = [(name, offset, length) for name, offset, length, compression
+              in members if is_node_archive(name) and not compression and
+              split_format(name)[1] in ('zip', 'tar')]
+    ranged_names = set(m[0] for m in ranged)
+    names = reader.extract(dest, lambda member: member not in ranged_names)
+
+    manifest = None
+    if os.path.isfile(dest + '/' + MANIFEST_FILE):
+        manifest = read_manifest(dest + '/' + MANIFEST_FILE)
+    for name in names:
+        if is_node_archive(name):
+            print('Selecting %i files from %s' %
+                  (len(filter_archive(dest + '/' + name, select)), name))
+
+    with open(reader.path, 'rb') as bundle:
+        for name, offset, length in ranged:
+            node_path = dest + '/' + name + '.select'
+            node_ranges = member_ranges(FileRange(bundle, offset, length), select,
+                                        _manifest_offsets(manifest, name, select))
+            print('Selecting %i files from %s' % (len(node_ranges), name))
+            for member, member_offset, member_length, compression in node_ranges:
+                copy_range(bundle, offset + member_offset, member_length,
+                           node_path + '/' + member, compression)
+            _archive_selected(dest + '/' + name, node_path, split_format(name)[1],
+                              manifest)
+    return names + [m[0] for m in ranged]
+
+
 def clean_dir(path):
 
     # removes all files and directories in a directory
@@ -162,7 +375,53 @@ def prepare_dir(path, output=False):
         clean_dir(path)
 
 
+# Metrics Functions
+def start_run_metrics(command):
+
+    # the controller's own phases, next to the node ones in output_logs
+    return start_metrics('%s/output_logs/%s-controller.metrics.jsonl'
+                         % (sys.path[0], command), 'controller', command)
+
+
+def write_run_report(command, prometheus=None):
+
+    # merges the controller's and every node's phase records in output_logs
+    # into output_logs/<command>-report.json and prints the summary;
+    # prometheus is an optional textfile to write the totals to
+    log_dir = sys.path[0] + '/output_logs'
+    records = []
+    for f in sorted(os.listdir(log_dir)):
+        if f.startswith(command + '-') and f.endswith('.metrics.jsonl'):
+            records.extend(read_metrics(log_dir + '/' + f))
+    report = metrics_report(command, records)
+    with open('%s/%s-report.json' % (log_dir, command), 'w') as f:
+        json.dump(report, f, indent=2, sort_keys=True)
+    print(report_table(report))
+    if prometheus:
+        write_prometheus(prometheus, report)
+        print('Metrics written to %s' % prometheus)
+    return report
+
+
 # Miscellaneous Functions
+def select_snapshot(snapshots, strip=0):
+
+    # prints the snapshots as a table and asks for an index
+    print('\nSnapshots found:')
+    template = '{0:5} | {1:67}'
+    print(template.format('Index', 'Snapshot'))
+    for idx, snap in enumerate(snapshots):
+        print(template.format(idx + 1, snap[strip:]))
+
+    index = 0
+    while index not in range(1, len(snapshots) + 1):
+        try:
+            index = int(raw_input('Enter snapshot index: '))
+        except ValueError:
+            continue
+    return snapshots[index - 1]
+
+
 def confirm(prompt=None):
 
     options = set(['y', 'Y', 'n', 'N'])
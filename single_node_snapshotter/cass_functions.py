@@ -1,6 +1,15 @@
 import yaml
 import os
 import subprocess
+import re
+import atexit
+
+try:
+    # DataStax python driver; optional, cqlsh is used when it is missing
+    from cassandra.cluster import Cluster
+    from cassandra.query import dict_factory
+except ImportError:
+    Cluster = None
 
 _SYSTEM_KEYSPACES = set(['system_schema',
                          'system_auth',
@@ -13,25 +22,164 @@ _YAML_LOCATIONS = ['/etc/cassandra/conf/', # package install on centos
                    '/etc/dse/cassandra/'   # datastax enterprise package
                   ] #TODO tarball install needs install location
 
+_CQLSH = '/bin/cqlsh'
+_NATIVE_PORT = 9042
+
+
+# Cassandra Session
+class CassandraSession(object):
+    # One long-lived connection to a node, shared by every query in a run.
+    # Queries go through the native driver when it is installed, otherwise
+    # each statement (or batch of statements) is fed to a cqlsh process.
+
+    def __init__(self, host, port=_NATIVE_PORT, native=True):
+
+        self.host = host
+        self.port = port
+        self.use_native = native and Cluster is not None
+        self._cluster = None
+        self._session = None
+        self.connect()
+
+    @property
+    def native(self):
+        return self._session is not None
+
+    def connect(self):
+
+        if not self.use_native or self.native:
+            return self.native
+        try:
+            self._cluster = Cluster([self.host], port=self.port)
+            self._session = self._cluster.connect()
+            self._session.row_factory = dict_factory
+        except Exception as e:
+            print('Native connection to %s failed, using cqlsh: %s'
+                  % (self.host, e))
+            self.close()
+        return self.native
+
+    def close(self):
+
+        if self._cluster is not None:
+            try:
+                self._cluster.shutdown()
+            except Exception:
+                pass
+        self._cluster = None
+        self._session = None
+
+    def cqlsh(self, script):
+        # Runs one or more statements in a single cqlsh process and returns
+        # (returncode, output)
+
+        cqlsh = subprocess.Popen((_CQLSH, self.host),
+                                 stdin=subprocess.PIPE,
+                                 stdout=subprocess.PIPE,
+                                 universal_newlines=True)
+        output = cqlsh.communicate(script)[0]
+        return cqlsh.returncode, output
+
+    def execute(self, query):
+        # Returns the result rows as a list of dicts keyed by column name
+
+        if self.native:
+            return list(self._session.execute(query))
+        returncode, output = self.cqlsh(query)
+        if returncode != 0:
+            raise Exception('cqlsh query failed: %s' % query)
+        return parse_cqlsh_rows(output)
+
+    def execute_many(self, statements):
+        # Runs statements that do not return rows; without the native driver
+        # they all share one cqlsh process
+
+        if self.native:
+            for statement in statements:
+                self._session.execute(statement)
+            return 0
+        return self.cqlsh('\n'.join(statements))[0]
+
+    def run_script(self, script):
+        # Runs a .cql script such as a saved schema; cqlsh handles comments
+        # and shell commands that the driver does not understand
+        return self.cqlsh(script)
+
+    def ping(self):
+        # Returns 0 if the node answers queries, like cqlsh's return code
+
+        if self.connect():
+            try:
+                self._session.execute('SELECT release_version FROM system.local')
+                return 0
+            except Exception:
+                self.close()
+                return 1
+        return self.cqlsh('exit')[0]
+
+
+_SESSIONS = {}
+
+
+def get_session(host):
+    # Every caller in a process shares the same session per host
+
+    if host not in _SESSIONS:
+        _SESSIONS[host] = CassandraSession(host)
+    return _SESSIONS[host]
+
+
+def close_sessions():
+
+    for session in _SESSIONS.values():
+        session.close()
+    _SESSIONS.clear()
+
+
+atexit.register(close_sessions)
+
+
+def parse_cqlsh_rows(output):
+    # Turns cqlsh's tabular output into a list of dicts
+
+    '''
+
+     table_name  | id
+    -------------+---------------------------
+     first_table | first_uuid
+     . . .       | . . .
+
+    (num rows)
+    '''
+
+    lines = output.split('\n')
+    for idx, line in enumerate(lines):
+        if idx > 0 and re.match(r'^-+(\+-+)*$', line.strip()):
+            break
+    else:
+        return []
+
+    columns = [c.strip() for c in lines[idx - 1].split('|')]
+    rows = []
+    for line in lines[idx + 1:]:
+        if not line.strip():
+            break
+        values = [v.strip() for v in line.split('|')]
+        rows.append(dict(zip(columns, values)))
+    return rows
+
+
 def cassandra_query(host, query, output=True):
     # This function takes in a cassandra query and returns the output
 
-    if type(query) is str:
-        query = ['echo', query]
-    elif type(query) is not list:
+    if type(query) is list: # command whose output is the query
+        query = subprocess.check_output(query, universal_newlines=True)
+    elif type(query) is not str:
         raise Exception('Query not recognized')
 
-    query_process = subprocess.Popen(query, stdout=subprocess.PIPE)
-    cqlsh = subprocess.Popen(('/bin/cqlsh', host),
-                             stdin=query_process.stdout,
-                             stdout=subprocess.PIPE)
-    query_process.stdout.close()
-
+    returncode, result = get_session(host).cqlsh(query)
     if output:
-
-        output = cqlsh.communicate()[0]
-        query_process.wait()
-        return output
+        return result
 
 
 def get_yaml_var(var):
@@ -61,43 +209,30 @@ def get_rpc_address():
 def get_keyspaces(host, system=False):
     # This function calls Cassandra to find the keyspaces in the database
 
-    keyspaces_string = cassandra_query(host, 'DESCRIBE keyspaces;')
-    keyspaces = set(keyspaces_string.strip().split())
+    rows = get_session(host).execute(
+            'SELECT keyspace_name FROM system_schema.keyspaces;')
+    keyspaces = set(row['keyspace_name'] for row in rows)
     if not system:
         keyspaces = keyspaces - _SYSTEM_KEYSPACES
     return keyspaces
 
+def table_directory(table, uuid):
+    # Data directories are named <table>-<uuid without dashes>
+    return table + '-' + str(uuid).replace('-', '')
+
 def get_table_directories(host, keyspace):
     # This function calls Cassandra to retrieve the tables and their
     # corresponding uuid
 
     cmd = ("SELECT table_name, id FROM system_schema.tables \
             WHERE keyspace_name='%s';" % keyspace)
-    query = cassandra_query(host, cmd).split('\n')
-
-    # format of query is as follows, may need to be updated
-    '''
-
-    table_name  | id
-    ------------+---------------------------
-    first_table | first_uuid
-    . . .       | . . .
-    last_table  | last_uuid
-
-    (num rows)
-    '''
-
-    table_directory = {}
-
-    query = query[3:-3] #TODO check if before and after match regex?
-
-    for row in query:
-
-        table, uuid = row.strip().split(' | ')
-        uuid = uuid.replace('-', '')
-        table_directory[table] = table + '-' + uuid
+    rows = get_session(host).execute(cmd)
 
-    return table_directory
+    table_directories = {}
+    for row in rows:
+        table_directories[row['table_name']] = table_directory(row['table_name'],
+                                                               row['id'])
+    return table_directories
 
 
 def get_dir_structure(host, keyspaces):
@@ -7,9 +7,11 @@ import subprocess
 import shutil
 import time
 
-from cass_functions import (cassandra_query, get_data_dir, get_keyspaces,
+from cass_functions import (get_session, get_data_dir, get_keyspaces,
                             get_table_directories, get_dir_structure)
 from cleaner import data_cleaner
+from loader import LOADERS_PER_NODE, timing_report
+from loader import load_tables as load_sstables
 
 
 def parse_cmd():
@@ -41,6 +43,12 @@ def parse_cmd():
                         action='store_true',
                         help="Destroy existing database without prompt"
     )
+    parser.add_argument('--loaders',
+                        required=False,
+                        type=int,
+                        default=LOADERS_PER_NODE,
+                        help="Concurrent sstableloaders (default %i)" % LOADERS_PER_NODE
+    )
 
     return parser.parse_args()
 
@@ -77,7 +85,7 @@ def restore_schema(host, load_path, keyspace):
         raise Exception('Schema not found: %s' % schema_location)
 
     with open(schema_location, 'r') as f:
-        cassandra_query(host, f.read())
+        get_session(host).run_script(f.read())
 
 
 def destroy_schema(host, flag=None):
@@ -105,9 +113,11 @@ def destroy_schema(host, flag=None):
 
         if destroy:
 
+            statements = []
             for k in keyspaces: # drop old keyspaces
                 print('Dropping keyspace: %s' % k)
-                cassandra_query(host, 'DROP KEYSPACE %s;' % k)
+                statements.append('DROP KEYSPACE %s;' % k)
+            get_session(host).execute_many(statements)
 
             data_dir = get_data_dir()
             active_dirs = os.listdir(data_dir)
@@ -127,7 +137,7 @@ def destroy_schema(host, flag=None):
 
 
 def restore(hosts, load_path, keyspace_arg = None, table_arg = None,
-            y_flag=None):
+            y_flag=None, loaders=LOADERS_PER_NODE):
 
     print('Checking Cassandra status . . .')
     try:
@@ -181,9 +191,9 @@ def restore(hosts, load_path, keyspace_arg = None, table_arg = None,
     # basic schema in a json format
     structure = get_dir_structure(hosts[0], existing_keyspaces)
     
+    load = []
     for keyspace in load_keyspaces:
 
-        print('Loading keyspace "%s"' % keyspace)
         if not table_arg:
             load_tables = filter(
                     lambda x: os.path.isdir(load_path + '/' + keyspace + '/' + x),
@@ -196,12 +206,18 @@ def restore(hosts, load_path, keyspace_arg = None, table_arg = None,
             if table not in existing_tables:
                 raise Exception('Table not in schema, error with snapshot')
 
-            load_table_dir = load_path + '/' + keyspace + '/' + table
-            print('\n\nLoading table: %s' % table)
-            # sstableloader has been more stable than nodetool refresh
-            subprocess.call(['/bin/sstableloader',
-                             '-d', ', '.join(hosts),
-                             load_table_dir])
+            load.append((keyspace + '.' + table,
+                         load_path + '/' + keyspace + '/' + table))
+
+    # sstableloader has been more stable than nodetool refresh
+    print('Loading tables with %i sstableloader(s)' % loaders)
+    start = time.time()
+    results = load_sstables(hosts, load, loaders)
+    print(timing_report(results, time.time() - start))
+
+    failed = [r['table'] for r in results if r['returncode'] != 0]
+    if failed:
+        raise Exception('sstableloader failed for %s' % ', '.join(failed))
 
     print('Restoration complete')
 
@@ -219,7 +235,8 @@ if __name__ == '__main__':
 
     start = time.time()
     check_cassandra(cmds.node[0])
-    restore(cmds.node, load_path, cmds.keyspace, cmds.table, cmds.y)
+    restore(cmds.node, load_path, cmds.keyspace, cmds.table, cmds.y,
+            cmds.loaders)
     end = time.time()
 
     print('Elapsed time: %s' % (end - start))
@@ -7,7 +7,7 @@ import datetime
 import time
 
 from cass_functions import (get_data_dir, get_keyspaces, get_dir_structure,
-                            cassandra_query)
+                            get_session)
 
 # nodetool only works with localhost, cqlsh only works with the node's ip
 
@@ -63,11 +63,10 @@ def write_schema(host, save_path, keyspace = None):
         filename = 'schema.cql'
         query = ("DESCRIBE SCHEMA;")
 
+    # DESCRIBE is a cqlsh command, so this always goes through cqlsh
+    returncode, output = get_session(host).cqlsh(query)
     with open(save_path + '/' + filename, 'w') as f:
-        query_process = subprocess.Popen(['echo', query], stdout=subprocess.PIPE)
-        cqlsh = subprocess.Popen(('/bin/cqlsh', host),
-                                  stdin=query_process.stdout, stdout=f)
-        query_process.stdout.close()
+        f.write(output)
 
     return (save_path + filename)
 